@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Memory-map the exported TF-IDF matrix at server start
+from data.tfidf_matrix import preload_tfidf_matrix
+
+preload_tfidf_matrix()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -93,6 +94,26 @@ DATABASES = {
 }
 
 
+# Cache shared by every worker (listing responses, suggestions, centrality sorts) :
+# files in ./cache by default (GUTENBERG_CACHE_DIR to move them), or a Redis-compatible
+# server (Redis, Valkey, KeyDB...) with GUTENBERG_REDIS_URL=redis://host:port/db (needs the redis package)
+if os.environ.get('GUTENBERG_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['GUTENBERG_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('GUTENBERG_CACHE_DIR', BASE_DIR / 'cache'),
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
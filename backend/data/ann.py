@@ -0,0 +1,210 @@
+import heapq
+import os
+
+import numpy as np
+from scipy import sparse
+
+from data.config import ANN_LEAF_SIZE, ANN_TREES, DOSSIER_ANN_INDEX
+from data.tfidf_matrix import get_tfidf_matrix
+
+ANN_INDEX_FILE = 'ann_index.npz'
+
+
+def normalize_rows(matrix):
+    """L2-normalize the rows of a sparse matrix, cosine becomes a dot product."""
+    matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.csr_matrix(sparse.diags(scale) @ matrix)
+
+
+class AnnIndex:
+    """
+    Approximate nearest-neighbour index over the TF-IDF vectors of the books.
+
+    A forest of random-projection trees (Annoy-like) : each inner node splits
+    its books with the hyperplane equidistant to two random books of the node,
+    each leaf holds at most `leaf_size` books. A query walks every tree
+    best-first on the margin to the hyperplanes until `search_k` candidates are
+    collected, then ranks the candidates by exact cosine similarity.
+    More trees and a larger `search_k` give a better recall, at the cost of
+    build and query time.
+    """
+
+    def __init__(self, vectors, book_ids, roots, pivots, children, leaves, items):
+        self.vectors = vectors     # normalized CSR rows of the books
+        self.book_ids = book_ids
+        self.row_of = {int(book_id): row for row, book_id in enumerate(book_ids)}
+        self.roots = roots         # root node of every tree
+        self.pivots = pivots       # (n_nodes, 2) rows defining the split, -1 for leaves
+        self.children = children   # (n_nodes, 2) left / right nodes
+        self.leaves = leaves       # (n_nodes, 2) [start, end) of the leaf in `items`
+        self.items = items         # rows, leaf by leaf
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @classmethod
+    def build(cls, vectors, book_ids, n_trees=ANN_TREES, leaf_size=ANN_LEAF_SIZE, seed=None):
+        vectors = normalize_rows(vectors)
+        rng = np.random.default_rng(seed)
+        pivots, children, leaves, items = [], [], [], []
+        roots = []
+
+        def new_node():
+            pivots.append((-1, -1))
+            children.append((-1, -1))
+            leaves.append((0, 0))
+            return len(pivots) - 1
+
+        all_rows = np.arange(vectors.shape[0], dtype=np.int64)
+        for _ in range(n_trees):
+            root = new_node()
+            roots.append(root)
+            stack = [(root, all_rows)]
+            while stack:
+                node, rows = stack.pop()
+                split = None
+                if len(rows) > leaf_size:
+                    split = cls._split(vectors, rows, rng)
+                if split is None:
+                    leaves[node] = (len(items), len(items) + len(rows))
+                    items.extend(rows.tolist())
+                    continue
+                (a, b), left_rows, right_rows = split
+                left, right = new_node(), new_node()
+                pivots[node] = (a, b)
+                children[node] = (left, right)
+                stack.append((left, left_rows))
+                stack.append((right, right_rows))
+
+        return cls(
+            vectors,
+            np.asarray(book_ids, dtype=np.int64),
+            np.asarray(roots, dtype=np.int64),
+            np.asarray(pivots, dtype=np.int64),
+            np.asarray(children, dtype=np.int64),
+            np.asarray(leaves, dtype=np.int64),
+            np.asarray(items, dtype=np.int64),
+        )
+
+    @staticmethod
+    def _split(vectors, rows, rng, attempts=3):
+        for _ in range(attempts):
+            a, b = rng.choice(rows, size=2, replace=False)
+            normal = vectors[a] - vectors[b]
+            if normal.nnz == 0:
+                continue
+            margins = np.asarray((vectors[rows] @ normal.T).todense()).ravel()
+            side = margins >= 0
+            if side.all() or not side.any():
+                continue
+            return (int(a), int(b)), rows[~side], rows[side]
+        # Duplicated vectors : split in two halves at random
+        if len(rows) > 1:
+            shuffled = rng.permutation(rows)
+            middle = len(rows) // 2
+            return (-2, -2), shuffled[:middle], shuffled[middle:]
+        return None
+
+    def _row_dot(self, row, query):
+        vectors = self.vectors
+        start, end = vectors.indptr[row], vectors.indptr[row + 1]
+        return float(vectors.data[start:end] @ query[vectors.indices[start:end]])
+
+    def _candidates(self, query, search_k):
+        heap = [(-np.inf, int(root)) for root in self.roots]
+        candidates = set()
+        while heap and len(candidates) < search_k:
+            priority, node = heapq.heappop(heap)
+            a, b = self.pivots[node]
+            if a == -1:
+                start, end = self.leaves[node]
+                candidates.update(self.items[start:end].tolist())
+                continue
+            left, right = self.children[node]
+            if a == -2:
+                # Random split, both sides are as close
+                heapq.heappush(heap, (priority, int(left)))
+                heapq.heappush(heap, (priority, int(right)))
+                continue
+            margin = self._row_dot(a, query) - self._row_dot(b, query)
+            # Min-heap on -priority : explore the side of the query first
+            heapq.heappush(heap, (max(priority, -margin), int(right)))
+            heapq.heappush(heap, (max(priority, margin), int(left)))
+        return candidates
+
+    def query(self, book_id=None, vector=None, k=10, search_k=None):
+        """
+        Return the `k` books most similar to the book `book_id` or to `vector`
+        (dense or sparse, over the TF-IDF matrix columns) as [(book_id, score)].
+        """
+        exclude = None
+        if book_id is not None:
+            row = self.row_of.get(int(book_id))
+            if row is None:
+                return []
+            exclude = row
+            query = self.vectors[row].toarray().ravel()
+        else:
+            query = vector.toarray().ravel() if sparse.issparse(vector) else np.asarray(vector, dtype=np.float32).ravel()
+            norm = np.linalg.norm(query)
+            if norm == 0:
+                return []
+            query = query / norm
+        if search_k is None:
+            search_k = k * self.n_trees
+        candidates = self._candidates(query, search_k + (exclude is not None))
+        candidates.discard(exclude)
+        if not candidates:
+            return []
+        rows = np.fromiter(candidates, dtype=np.int64)
+        scores = self.vectors[rows] @ query
+        best = np.argsort(-scores, kind='stable')[:k]
+        return [(int(self.book_ids[rows[i]]), float(scores[i])) for i in best if scores[i] > 0]
+
+    def exact_query(self, book_id, k=10):
+        """Brute-force top-k, used to measure the recall of the index."""
+        row = self.row_of.get(int(book_id))
+        if row is None:
+            return []
+        scores = np.asarray((self.vectors @ self.vectors[row].T).todense()).ravel()
+        scores[row] = -np.inf
+        best = np.argsort(-scores, kind='stable')[:k]
+        return [(int(self.book_ids[i]), float(scores[i])) for i in best if scores[i] > 0]
+
+    def save(self, directory=DOSSIER_ANN_INDEX):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f"tmp_{ANN_INDEX_FILE}")
+        np.savez(
+            tmp_path,
+            book_ids=self.book_ids,
+            roots=self.roots,
+            pivots=self.pivots,
+            children=self.children,
+            leaves=self.leaves,
+            items=self.items,
+        )
+        os.replace(tmp_path, os.path.join(directory, ANN_INDEX_FILE))
+
+    @classmethod
+    def load(cls, directory=DOSSIER_ANN_INDEX, tfidf_matrix=None):
+        """Load the forest built by buildAnnIndex, None if missing or built on other books."""
+        path = os.path.join(directory, ANN_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        tfidf_matrix = tfidf_matrix or get_tfidf_matrix()
+        with np.load(path) as arrays:
+            if not np.array_equal(arrays['book_ids'], np.asarray(tfidf_matrix.book_ids)):
+                print("The ANN index was built on another TF-IDF matrix, run `python manage.py buildAnnIndex`")
+                return None
+            return cls(
+                normalize_rows(tfidf_matrix.matrix),
+                arrays['book_ids'],
+                arrays['roots'],
+                arrays['pivots'],
+                arrays['children'],
+                arrays['leaves'],
+                arrays['items'],
+            )
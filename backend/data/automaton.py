@@ -0,0 +1,256 @@
+import re
+from bisect import bisect_left
+from functools import lru_cache
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+from data.config import REGEX_CACHE_SIZE
+
+MAX_NFA_STATES = 2000      # larger patterns (big counted repeats...) use the regex fallback
+MAX_DFA_TRANSITIONS = 100000
+
+
+class UnsupportedPattern(Exception):
+    """The pattern uses a construct that the automaton can't represent."""
+
+
+# NFA state kinds
+CHAR, SPLIT, BOL, EOL, MATCH = range(5)
+
+
+def _category_matcher(category, ascii_only):
+    def ascii_guard(predicate):
+        return (lambda c: c.isascii() and predicate(c)) if ascii_only else predicate
+
+    is_digit = ascii_guard(str.isdecimal)
+    is_space = ascii_guard(str.isspace)
+    is_word = ascii_guard(lambda c: c.isalnum() or c == '_')
+    matchers = {
+        sre_constants.CATEGORY_DIGIT: is_digit,
+        sre_constants.CATEGORY_NOT_DIGIT: lambda c: not is_digit(c),
+        sre_constants.CATEGORY_SPACE: is_space,
+        sre_constants.CATEGORY_NOT_SPACE: lambda c: not is_space(c),
+        sre_constants.CATEGORY_WORD: is_word,
+        sre_constants.CATEGORY_NOT_WORD: lambda c: not is_word(c),
+    }
+    if category not in matchers:
+        raise UnsupportedPattern(category)
+    return matchers[category]
+
+
+def _case_variants(c):
+    return {v for v in (c, c.lower(), c.upper()) if len(v) == 1}
+
+
+def _char_matcher(op, av, flags):
+    """Build a predicate on one character for a LITERAL / NOT_LITERAL / ANY / IN item."""
+    ignore_case = flags & sre_constants.SRE_FLAG_IGNORECASE
+    ascii_only = flags & sre_constants.SRE_FLAG_ASCII
+
+    if op is sre_constants.LITERAL or op is sre_constants.NOT_LITERAL:
+        expected = _case_variants(chr(av)) if ignore_case else {chr(av)}
+        if op is sre_constants.LITERAL:
+            return lambda c: c in expected or (ignore_case and c.lower() in expected)
+        return lambda c: not (c in expected or (ignore_case and c.lower() in expected))
+    if op is sre_constants.ANY:
+        if flags & sre_constants.SRE_FLAG_DOTALL:
+            return lambda c: True
+        return lambda c: c != '\n'
+    if op is sre_constants.RANGE:
+        low, high = av
+        if ignore_case:
+            return lambda c: any(low <= ord(v) <= high for v in _case_variants(c))
+        return lambda c: low <= ord(c) <= high
+    if op is sre_constants.CATEGORY:
+        return _category_matcher(av, ascii_only)
+    if op is sre_constants.IN:
+        negate = bool(av) and av[0][0] is sre_constants.NEGATE
+        items = [_char_matcher(item_op, item_av, flags) for item_op, item_av in (av[1:] if negate else av)]
+        if negate:
+            return lambda c: not any(item(c) for item in items)
+        return lambda c: any(item(c) for item in items)
+    raise UnsupportedPattern(op)
+
+
+class RegexAutomaton:
+    """
+    Thompson NFA compiled from the parsed pattern, determinized lazily while
+    walking the vocabulary. Semantics are those of re.search on each token.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.states = []
+        parsed = sre_parse.parse(pattern)
+        match_state = self._new(MATCH)
+        self.start = self._build(parsed, match_state, parsed.state.flags)
+        # DFA states are frozensets of NFA states, transitions are memoized
+        self.transitions = {}
+        self.initial = self._closure({self.start}, at_start=True)
+        # Unanchored search : a match may start at any position
+        self.restart = self._closure({self.start}, at_start=False)
+        # Anchored patterns can't restart after the first character, that's
+        # what lets the walk skip whole subtrees of the vocabulary
+        self.anchored = self.is_dead(self.restart)
+
+    def _new(self, kind, *args):
+        if len(self.states) >= MAX_NFA_STATES:
+            raise UnsupportedPattern('too many states')
+        self.states.append([kind, *args])
+        return len(self.states) - 1
+
+    def _build(self, parsed, next_state, flags):
+        """Compile `parsed` backwards, returning the state that starts it."""
+        for op, av in reversed(list(parsed)):
+            next_state = self._build_item(op, av, next_state, flags)
+        return next_state
+
+    def _build_item(self, op, av, next_state, flags):
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            return self._new(CHAR, _char_matcher(op, av, flags), next_state)
+        if op is sre_constants.SUBPATTERN:
+            _, add_flags, del_flags, sub_pattern = av
+            return self._build(sub_pattern, next_state, (flags | add_flags) & ~del_flags)
+        if op is sre_constants.BRANCH:
+            starts = [self._build(branch, next_state, flags) for branch in av[1]]
+            return self._new(SPLIT, starts)
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            # Greedy and lazy repeats accept the same strings
+            min_repeat, max_repeat, sub_pattern = av
+            if max_repeat is sre_constants.MAXREPEAT:
+                loop = self._new(SPLIT, [])
+                self.states[loop][1] = [self._build(sub_pattern, loop, flags), next_state]
+                next_state = loop
+            else:
+                for _ in range(max_repeat - min_repeat):
+                    next_state = self._new(SPLIT, [self._build(sub_pattern, next_state, flags), next_state])
+            for _ in range(min_repeat):
+                next_state = self._build(sub_pattern, next_state, flags)
+            return next_state
+        if op is sre_constants.AT:
+            if av in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+                return self._new(BOL, next_state)
+            if av in (sre_constants.AT_END, sre_constants.AT_END_STRING):
+                return self._new(EOL, next_state)
+        # Backreferences, lookarounds, word boundaries, atomic groups...
+        raise UnsupportedPattern(op)
+
+    def _closure(self, states, at_start):
+        closure = set()
+        stack = list(states)
+        while stack:
+            state = stack.pop()
+            if state in closure:
+                continue
+            closure.add(state)
+            kind, *args = self.states[state]
+            if kind is SPLIT:
+                stack.extend(args[0])
+            elif kind is BOL and at_start:
+                stack.append(args[0])
+        return frozenset(closure)
+
+    def step(self, dfa_state, c):
+        key = (dfa_state, c)
+        target = self.transitions.get(key)
+        if target is None:
+            moved = {
+                self.states[state][2] for state in dfa_state
+                if self.states[state][0] is CHAR and self.states[state][1](c)
+            }
+            target = self._closure(moved, at_start=False) | self.restart
+            if len(self.transitions) >= MAX_DFA_TRANSITIONS:
+                self.transitions.clear()
+            self.transitions[key] = target
+        return target
+
+    def is_dead(self, dfa_state):
+        """No match can be reached anymore from this state."""
+        return not any(self.states[state][0] in (CHAR, EOL, MATCH) for state in dfa_state)
+
+    def matched(self, dfa_state):
+        """A match was already found in the prefix : every extension matches too."""
+        return any(self.states[state][0] is MATCH for state in dfa_state)
+
+    def accepts_at_end(self, dfa_state, at_start=False):
+        """A match ends exactly at the end of the token."""
+        if self.matched(dfa_state):
+            return True
+        ends = {self.states[state][1] for state in dfa_state if self.states[state][0] is EOL}
+        return ends and self.matched(self._closure(ends, at_start))
+
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_automaton(pattern):
+    """Return the automaton of `pattern`, or None if it can only be run by `re`."""
+    try:
+        return RegexAutomaton(pattern)
+    except (UnsupportedPattern, RecursionError, OverflowError):
+        return None
+
+
+class VocabularyTrie:
+    """
+    Implicit trie over a sorted vocabulary : the tokens sharing a prefix are a
+    contiguous range of the sorted list, so a node is (depth, lo, hi) and a
+    whole subtree can be enumerated by slicing.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = sorted(set(tokens))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def children(self, depth, lo, hi):
+        tokens = self.tokens
+        i = lo
+        # The token equal to the prefix itself sorts first
+        if i < hi and len(tokens[i]) == depth:
+            i += 1
+        while i < hi:
+            c = tokens[i][depth]
+            if ord(c) == 0x10FFFF:
+                j = hi
+            else:
+                j = bisect_left(tokens, tokens[i][:depth] + chr(ord(c) + 1), i + 1, hi)
+            yield c, i, j
+            i = j
+
+    def match(self, automaton):
+        """Return the tokens matched by `automaton`, walking the trie alongside the DFA."""
+        tokens = self.tokens
+        results = []
+        stack = [(0, 0, len(tokens), automaton.initial)]
+        while stack:
+            depth, lo, hi, dfa_state = stack.pop()
+            if automaton.matched(dfa_state):
+                # The whole subtree matches, no need to look at it
+                results.extend(tokens[lo:hi])
+                continue
+            if len(tokens[lo]) == depth and automaton.accepts_at_end(dfa_state, at_start=depth == 0):
+                results.append(tokens[lo])
+            for c, child_lo, child_hi in self.children(depth, lo, hi):
+                child_state = automaton.step(dfa_state, c)
+                if not automaton.is_dead(child_state):
+                    stack.append((depth + 1, child_lo, child_hi, child_state))
+        return results
+
+    def search(self, pattern):
+        """
+        Return the tokens matching `pattern` (re.search semantics), or None if
+        the automaton can't do better than the regex path : unsupported
+        constructs, or unanchored patterns which never prune a subtree.
+        """
+        re.compile(pattern)  # surface re.error for invalid patterns
+        automaton = compile_automaton(pattern)
+        if automaton is None or not automaton.anchored:
+            return None
+        if not self.tokens:
+            return []
+        return self.match(automaton)
@@ -0,0 +1,45 @@
+import json
+
+from data.models import Book, BookCard
+from data.serializers import BookSerializer
+
+
+def encode_card(data):
+    """Compact JSON, the same bytes as the JSONRenderer of DRF."""
+    # DRF escapes the line separators, invalid in JavaScript strings
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+
+
+def serialize_cards(books):
+    """{gutenberg_id: card} of Book objects whose relations are prefetched."""
+    return {card['id']: encode_card(card) for card in BookSerializer(books, many=True).data}
+
+
+def card_strings(book_ids):
+    """
+    {gutenberg_id: card} of the books, the JSON payload of BookSerializer.
+    Precomputed cards are read by primary key, the books without a card
+    (added since the last buildBookCards) are serialized on the fly.
+    """
+    cards = dict(BookCard.objects.filter(book_id__in=book_ids).values_list('book_id', 'data'))
+    missing = [book_id for book_id in book_ids if book_id not in cards]
+    if missing:
+        cards.update(serialize_cards(BookSerializer.setup_eager_loading(Book.objects.filter(gutenberg_id__in=missing))))
+    return cards
+
+
+def cards_json(book_ids, cards=None):
+    """JSON array of the cards of the books, in the order of `book_ids`, without decoding them."""
+    cards = card_strings(book_ids) if cards is None else cards
+    return '[' + ','.join(cards[book_id] for book_id in book_ids if book_id in cards) + ']'
+
+
+def json_object(members):
+    """JSON object of {name: value already encoded in JSON}."""
+    return '{' + ','.join(f'{encode_card(name)}:{value}' for name, value in members.items()) + '}'
+
+
+def book_cards(book_ids, cards=None):
+    """The cards of the books as dicts, in the order of `book_ids`."""
+    cards = card_strings(book_ids) if cards is None else cards
+    return [json.loads(cards[book_id]) for book_id in book_ids if book_id in cards]
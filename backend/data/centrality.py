@@ -1,13 +1,23 @@
 from collections import deque
 from data.graph import WeightedGraph, UnweightedGraph
+from data.config import CENTRALITY_BATCH_SIZE
 from enum import Enum, auto
 import time
+import numpy as np
+from scipy.sparse.csgraph import connected_components
 from django.core.cache import cache
 
 class Centrality(Enum):
     CLOSENESS = auto()
     BETWEENNESS = auto()
 
+# ?sort= value -> Book column of the centrality precomputed by computeCentrality
+CENTRALITY_FIELDS = {
+    'closeness': 'closeness',
+    'betweenness': 'betweenness',
+    'Betweenness': 'betweenness',
+}
+
 def compute_betweenness_centrality(G: UnweightedGraph):
     """Compute betweenness centrality with optimizations and timeout"""
     start_time = time.time()
@@ -108,4 +118,88 @@ def compute_closeness_centrality(G: WeightedGraph):
         # Compute closeness centrality
         node.centrality_measure = 0 if distance == 0 else (n - 1) / distance
     
-    print(f"Closeness centrality calculation completed in {time.time() - start_time:.4f} seconds")
\ No newline at end of file
+    print(f"Closeness centrality calculation completed in {time.time() - start_time:.4f} seconds")
+
+
+def graph_centrality(adjacency, sources=None, batch_size=CENTRALITY_BATCH_SIZE):
+    """
+    (closeness, betweenness) arrays of every node of an undirected unweighted graph,
+    `adjacency` being its symmetric scipy sparse matrix.
+
+    Brandes' algorithm run from `batch_size` sources at once : each level of the
+    breadth-first searches and of the accumulation of the dependencies is one
+    sparse x dense product, the loops are in numpy.
+
+    - closeness : (r - 1) / (n - 1) * (r - 1) / sum of the distances to the r - 1
+      nodes reachable (Wasserman-Faust, the graph isn't connected), 0 for an isolated node
+    - betweenness : normalized by the (n - 1)(n - 2) / 2 pairs of other nodes
+
+    With `sources`, only these nodes are the sources of the searches : the scores
+    are estimated from them (Brandes-Pich pivots), each component scaled by its
+    number of nodes / number of sources. A component without any source gets all
+    its nodes as sources. Without, every node is a source and the scores are exact.
+    """
+    n = adjacency.shape[0]
+    closeness, betweenness = np.zeros(n), np.zeros(n)
+    if n == 0:
+        return closeness, betweenness
+    adjacency = adjacency.tocsr().astype(np.float64)
+    _, labels = connected_components(adjacency, directed=False)
+    sizes = np.bincount(labels)
+    reachable = sizes[labels]
+
+    if sources is None:
+        sources = np.arange(n)
+    else:
+        covered = np.zeros(len(sizes), dtype=bool)
+        covered[labels[sources]] = True
+        sources = np.union1d(sources, np.flatnonzero(~covered[labels]))
+    per_component = np.bincount(labels[sources], minlength=len(sizes))
+
+    # Sum of the distances of each node to the sources, and of each source to every node
+    distances_to_sources = np.zeros(n)
+    source_distances = np.zeros(n)
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        columns = np.arange(len(batch))
+        dist = np.full((n, len(batch)), -1, dtype=np.int32)
+        dist[batch, columns] = 0
+        sigma = np.zeros((n, len(batch)))
+        sigma[batch, columns] = 1
+        # Number of shortest paths to the nodes of the last level, 0 elsewhere
+        frontier = sigma.copy()
+        depth = 0
+        while frontier.any():
+            reached = adjacency @ frontier
+            new = (reached > 0) & (dist < 0)
+            depth += 1
+            dist[new] = depth
+            frontier = np.where(new, reached, 0)
+            sigma += frontier
+
+        found = np.where(dist > 0, dist, 0)
+        source_distances[batch] = found.sum(axis=0)
+        distances_to_sources += found.sum(axis=1)
+
+        # Dependencies, from the farthest level back to the sources
+        delta = np.zeros_like(sigma)
+        for level in range(depth - 1, 0, -1):
+            at_level = dist == level
+            coefficients = np.where(at_level, (1 + delta) / np.where(at_level, sigma, 1), 0)
+            delta += np.where(dist == level - 1, sigma * (adjacency @ coefficients), 0)
+        delta[batch, columns] = 0
+        betweenness += delta.sum(axis=1)
+
+    is_source = np.zeros(n, dtype=bool)
+    is_source[sources] = True
+    # A source knows its distances, the others are estimated from the sources of their component
+    others = np.maximum(per_component[labels] - is_source, 1)
+    total_distances = np.where(is_source, source_distances, distances_to_sources * (reachable - 1) / others)
+    if n > 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            closeness = np.where(reachable > 1, (reachable - 1) ** 2 / ((n - 1) * total_distances), 0.0)
+    # Each pair is counted from both of its ends
+    betweenness *= sizes[labels] / per_component[labels] / 2
+    if n > 2:
+        betweenness /= (n - 1) * (n - 2) / 2
+    return closeness, betweenness
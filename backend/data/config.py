@@ -2,3 +2,60 @@ URL_INIT_BIBLIOTHEQUE = 'http://gutendex.com/books/'
 MIN_NB_LIVRE_BIBLIOTHEQUE = 1664
 MIN_NB_MOTS_LIVRES = 10000
 URL_BASE_DATA = 'data/'
+
+# Regex searches
+REGEX_CACHE_SIZE = 256        # compiled patterns kept in memory
+REGEX_SCAN_LIMIT = 200000     # max entries scanned by a regex without any literal
+
+# Exported book x token TF-IDF matrix (buildTfidfMatrix)
+DOSSIER_TFIDF_MATRIX = 'tfidf_matrix/'
+
+# Approximate nearest-neighbour index over the book vectors (buildAnnIndex)
+DOSSIER_ANN_INDEX = 'ann_index/'
+ANN_TREES = 10         # more trees : better recall, slower build and query
+ANN_LEAF_SIZE = 32     # max books per leaf
+
+# MinHash / LSH candidate generation for the Jaccard graph (createGraphJaccard --mode minhash)
+MINHASH_NUM_PERM = 128   # signature length
+MINHASH_BANDS = 32       # bands of MINHASH_NUM_PERM / MINHASH_BANDS rows
+
+# Blockwise Jaccard engine (createGraphJaccard --mode blockwise)
+JACCARD_BLOCK_SIZE = 256   # books per block, bounds the memory of a block of pairs
+
+# Bulk writes of the Neighbors graph (createGraphJaccard)
+NEIGHBORS_BATCH_SIZE = 10000
+
+# Content-hash manifest of the keyword pipeline, lets each stage only process the changed books
+MANIFEST_PATH = 'pipeline_manifest.json'
+
+# Downloads of initBooks (asyncio engine)
+DOWNLOAD_CONCURRENCY = 64   # books downloaded at once, also the size of the connection pool
+DOWNLOAD_RETRIES = 5        # attempts per request
+DOWNLOAD_TIMEOUT = 30       # seconds to connect / between two chunks of a body
+DOWNLOAD_BACKOFF = 1.0      # seconds, base of the exponential backoff between attempts
+INGEST_BATCH_SIZE = 500     # books buffered before each write of the catalog entries
+DOSSIER_CATALOGUE = 'catalog/'   # cached Gutendex pages and checkpoint of the crawl
+
+# Compressed sharded storage of the book texts (data/storage.py, packBooks)
+DOSSIER_SHARDS = 'shards/'
+SHARD_SIZE = 1 << 28            # bytes of a shard before the next one is started (256 MiB)
+SHARD_COMPRESSION_LEVEL = 6     # gzip level of each text
+
+# Precomputed JSON cards of the books (data/cards.py, buildBookCards)
+CARDS_BATCH_SIZE = 2000   # books serialized per chunk
+
+# Keyset pagination of the book listings (data/pagination.py), only with ?page_size= or ?cursor=
+PAGE_SIZE = 50             # books per page without ?page_size=
+MAX_PAGE_SIZE = 200        # larger ?page_size= are capped
+PAGE_COUNT_LIMIT = 1000    # matching books counted, past it the count is a lower bound
+
+# Response cache of the listings (data/response_cache.py), versioned by the DatasetVersion generation
+RESPONSE_CACHE_TIMEOUT = 4 * 3600   # seconds a listing response is kept
+
+# Global centrality of the books in the Neighbors graph (computeCentrality)
+CENTRALITY_BATCH_SIZE = 64    # sources searched at once, memory : a few (books x batch) float arrays
+
+# Single-flight of the cached computations (data/singleflight.py)
+SINGLEFLIGHT_LOCK_TIMEOUT = 30   # seconds before the shared lock of a crashed worker expires
+SINGLEFLIGHT_WAIT = 5            # seconds waiting for another worker, then the result is computed anyway
+SINGLEFLIGHT_POLL = 0.05         # seconds between two looks at the shared cache
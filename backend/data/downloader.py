@@ -0,0 +1,266 @@
+import asyncio
+import codecs
+import hashlib
+import json
+import os
+import random
+import re
+
+import aiohttp
+
+from data.config import DOWNLOAD_CONCURRENCY, DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT, DOWNLOAD_BACKOFF, DOSSIER_CATALOGUE
+from data.storage import TextPacker
+
+TEXT_FORMAT = 'text/plain; charset=us-ascii'
+READ_CHUNK_SIZE = 1 << 16
+BACKOFF_CAP = 30          # max seconds between two attempts
+KEEPALIVE_TIMEOUT = 30    # idle seconds before a pooled connection is closed
+WORD_RE = re.compile(r'\b\w+\b')
+WORD_CHAR_RE = re.compile(r'\w')
+BOM = '\ufeff'
+
+
+class WordCounter:
+    """Number of words of a text given piece by piece : a word cut between two pieces counts once."""
+
+    def __init__(self):
+        self.count = 0
+        self._in_word = False
+
+    def feed(self, text):
+        if not text:
+            return
+        self.count += len(WORD_RE.findall(text))
+        if self._in_word and WORD_CHAR_RE.match(text):
+            self.count -= 1
+        self._in_word = WORD_CHAR_RE.match(text[-1]) is not None
+
+
+class BookStream:
+    """
+    Decode, count the words and compress a book text as its bytes arrive :
+    only one chunk and the compressed text are held, never the whole text.
+
+    With `min_words`, the words aren't counted anymore once there are enough,
+    and `feed` returns False as soon as the `expected_length` bytes announced
+    can't hold enough words anymore (a word takes at least 2 bytes with its separator).
+    """
+
+    def __init__(self, charset='utf-8', min_words=None, expected_length=None):
+        self.decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        self.counter = WordCounter()
+        self.packer = TextPacker()
+        self.min_words = min_words
+        self.expected_length = expected_length
+        self.received = 0
+        self.started = False
+
+    def _write(self, text):
+        if not self.started and text:
+            self.started = True
+            # Nettoyage du contenu
+            if text[0] == BOM:
+                text = text[1:]
+        if self.min_words is None or self.counter.count < self.min_words:
+            self.counter.feed(text)
+        self.packer.write(text)
+
+    def feed(self, data):
+        """Add a chunk of bytes, False if the book is now known to be too short."""
+        self.received += len(data)
+        self._write(self.decoder.decode(data))
+        if self.min_words is None or self.expected_length is None or self.counter.count >= self.min_words:
+            return True
+        remaining = max(0, self.expected_length - self.received)
+        return self.counter.count + (remaining + 1) // 2 >= self.min_words
+
+    def finish(self):
+        """(PackedText, number of words) of the whole text."""
+        self._write(self.decoder.decode(b'', final=True))
+        return self.packer.finish(), self.counter.count
+
+
+def expected_length(headers):
+    """Bytes of the body announced by the server, None if unknown or compressed on the wire."""
+    if 'Content-Encoding' in headers or 'Content-Length' not in headers:
+        return None
+    return int(headers['Content-Length'])
+
+
+class DownloadError(Exception):
+    """A request still failing after every retry."""
+
+
+class CatalogCache:
+    """On-disk copy of the Gutendex catalog pages, one JSON file per page url."""
+
+    def __init__(self, folder=DOSSIER_CATALOGUE):
+        self.folder = folder
+
+    def path(self, url):
+        return os.path.join(self.folder, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, url):
+        """The cached page, None if it was never fetched."""
+        try:
+            with open(self.path(url), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, page):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = f"{self.path(url)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(page, f)
+        os.replace(tmp_path, self.path(url))
+
+
+class _CrawlDone(Exception):
+    """Raised by a worker once `on_book` asked to stop the crawl."""
+
+
+def backoff_delay(attempt, base=DOWNLOAD_BACKOFF):
+    """Exponential backoff with full jitter : uniform in [0, base * 2^attempt], capped."""
+    return random.uniform(0, min(BACKOFF_CAP, base * 2 ** attempt))
+
+
+def _retryable(error):
+    # Client errors (404, 410...) won't go away, except rate limiting
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return True
+
+
+async def with_retries(request, url, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """Await `request()` until it succeeds, at most `retries` times."""
+    for attempt in range(retries):
+        try:
+            return await request()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt + 1 == retries or not _retryable(e):
+                raise DownloadError(f"Impossible de télécharger {url} après {attempt + 1} tentatives: {type(e).__name__} {e}") from e
+            print(f"Tentative {attempt + 1}/{retries} échouée pour {url}: {type(e).__name__} {e}")
+            await asyncio.sleep(backoff_delay(attempt, backoff))
+
+
+async def fetch_json(session, url, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """A Gutendex catalog page."""
+    async def request():
+        async with session.get(url, raise_for_status=True) as response:
+            return await response.json(content_type=None)
+    return await with_retries(request, url, retries, backoff)
+
+
+async def download_book(session, url, min_words=None, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """
+    Télécharge le livre et compte les mots chunk by chunk, returns (PackedText, nombre_de_mots).
+    With `min_words`, the download stops as soon as the book can't reach it : (None, nombre_de_mots).
+    """
+    async def request():
+        async with session.get(url, raise_for_status=True) as response:
+            stream = BookStream(response.charset or 'utf-8', min_words, expected_length(response.headers))
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                if not stream.feed(chunk):
+                    return None, stream.counter.count
+            return stream.finish()
+    return await with_retries(request, url, retries, backoff)
+
+
+def client_session(concurrency=DOWNLOAD_CONCURRENCY, timeout=DOWNLOAD_TIMEOUT):
+    """One pooled keep-alive session, at most `concurrency` sockets open at once."""
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    # No total timeout : a long book is fine as long as its bytes keep coming
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout),
+    )
+
+
+async def crawl(start_url, accept, on_book, on_page_done=None, local=None, cache=None, offline=False, min_words=None,
+                concurrency=DOWNLOAD_CONCURRENCY, retries=DOWNLOAD_RETRIES, timeout=DOWNLOAD_TIMEOUT,
+                backoff=DOWNLOAD_BACKOFF):
+    """
+    Walk the Gutendex pages from `start_url` and download the text of every book
+    for which `accept(book)` is true.
+
+    The next catalog pages are fetched while the books of the previous ones are
+    downloaded by `concurrency` workers. `await on_book(book, contenu, nombre_de_mots)`
+    is called for each downloaded book, contenu being its PackedText, and stops
+    the crawl by returning True. The books whose download fails after every retry are skipped.
+
+    - `min_words` : the download of a book stops once it can't have `min_words` words,
+      `on_book` gets None for contenu. The count of a longer book stops at `min_words`.
+    - `local(book)` : true if the text of the book is already saved, it isn't
+      downloaded again and `on_book` gets None for contenu and nombre_de_mots.
+    - `cache` : a CatalogCache, the pages are read from it when they were already fetched.
+    - `offline` : nothing is fetched, the crawl stops at the first page missing
+      from the cache and only the local books are handled.
+    - `await on_page_done(next_url)` once every book of a page and of the pages
+      before it was handled, `next_url` being the page to resume from.
+    """
+    # Bounded : the page reader stays a couple of pages ahead of the downloads
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    # [books not handled yet, next url] of each page read, in order
+    pages = []
+    completed = 0
+    lock = asyncio.Lock()
+
+    async def advance():
+        nonlocal completed
+        async with lock:
+            while completed < len(pages) and pages[completed][0] == 0:
+                completed += 1
+                if on_page_done is not None:
+                    await on_page_done(pages[completed - 1][1])
+
+    async with client_session(concurrency, timeout) as session:
+        async def read_pages():
+            url = start_url
+            while url:
+                page = cache.get(url) if cache is not None else None
+                if page is None:
+                    if offline:
+                        print(f"{url} isn't in the catalog cache, end of the offline crawl")
+                        break
+                    page = await fetch_json(session, url, retries, backoff)
+                    if cache is not None:
+                        cache.put(url, page)
+                books = [book for book in page['results'] if accept(book)]
+                pages.append([len(books), page['next']])
+                if not books:
+                    await advance()
+                for book in books:
+                    await queue.put((book, len(pages) - 1))
+                url = page['next']
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def download():
+            while (item := await queue.get()) is not None:
+                book, index = item
+                try:
+                    if local is not None and await asyncio.to_thread(local, book):
+                        stop = await on_book(book, None, None)
+                    elif offline:
+                        stop = False
+                    else:
+                        contenu, nombre_de_mots = await download_book(session, book['formats'][TEXT_FORMAT], min_words, retries, backoff)
+                        stop = await on_book(book, contenu, nombre_de_mots)
+                except DownloadError as e:
+                    print(e)
+                    stop = False
+                if stop:
+                    raise _CrawlDone
+                pages[index][0] -= 1
+                await advance()
+
+        tasks = [asyncio.create_task(read_pages())] + [asyncio.create_task(download()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except _CrawlDone:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,116 @@
+from django.db import transaction
+
+from data.config import INGEST_BATCH_SIZE
+from data.models import Book, BookCard, Language, Person, Subject
+from data.response_cache import bump_dataset_generation
+
+BOOK_FIELDS = ['download_count', 'title', 'cover_image', 'plain_text']
+
+
+class BookWriter:
+    """
+    Single writer of the Gutendex catalog entries : the books are buffered and
+    written by batches of `batch_size`, with their authors, first language and
+    subjects, in one transaction per batch.
+
+    Person, Subject and Language rows are deduplicated in memory (Person and
+    Subject have no unique constraint), books are upserted and the many-to-many
+    rows inserted with ignore_conflicts, so writing a book again is a no-op.
+    The precomputed cards (data/cards.py) of the books written are dropped
+    and each batch starts a new generation of the cached responses.
+    Not thread-safe : every call must come from the same thread.
+    """
+
+    def __init__(self, batch_size=INGEST_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+        # (name, birth_year, death_year) -> Person id, name -> Subject id, code -> Language id
+        self.persons = None
+        self.subjects = None
+        self.languages = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, book):
+        """Buffer a Gutendex book, raises KeyError if a field is missing."""
+        self.pending.append({
+            'book': Book(
+                gutenberg_id=book['id'],
+                download_count=book['download_count'],
+                title=book['title'],
+                cover_image=book['formats']['image/jpeg'],
+                plain_text=book['formats']['text/plain; charset=us-ascii'],
+            ),
+            'authors': [(a['name'], a['birth_year'], a['death_year']) for a in book['authors']],
+            # Only the first language, as before
+            'languages': book['languages'][:1],
+            'subjects': list(book['subjects']),
+        })
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def load(self):
+        # Read by decreasing id : with duplicates already in the table, the oldest row wins
+        self.persons = {
+            (name, birth_year, death_year): pk
+            for pk, name, birth_year, death_year in Person.objects.order_by('-id').values_list('id', 'name', 'birth_year', 'death_year')
+        }
+        self.subjects = {name: pk for pk, name in Subject.objects.order_by('-id').values_list('id', 'name')}
+        self.languages = dict(Language.objects.values_list('code', 'id'))
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.persons is None:
+            self.load()
+        # A book seen twice is written once, with its last entry (an upsert can't touch a row twice)
+        pending = list({entry['book'].gutenberg_id: entry for entry in self.pending}.values())
+        self.pending = []
+
+        try:
+            with transaction.atomic():
+                # New authors, subjects and languages of the batch, each created once
+                new_persons = list(dict.fromkeys(key for entry in pending for key in entry['authors'] if key not in self.persons))
+                created = Person.objects.bulk_create([Person(name=n, birth_year=b, death_year=d) for n, b, d in new_persons])
+                self.persons.update(zip(new_persons, (p.pk for p in created)))
+
+                new_subjects = list(dict.fromkeys(name for entry in pending for name in entry['subjects'] if name not in self.subjects))
+                created = Subject.objects.bulk_create([Subject(name=name) for name in new_subjects])
+                self.subjects.update(zip(new_subjects, (s.pk for s in created)))
+
+                new_languages = {code for entry in pending for code in entry['languages'] if code not in self.languages}
+                if new_languages:
+                    Language.objects.bulk_create([Language(code=code) for code in new_languages], ignore_conflicts=True)
+                    self.languages.update(Language.objects.filter(code__in=new_languages).values_list('code', 'id'))
+
+                # A book already in the database gets the new metadata
+                Book.objects.bulk_create(
+                    [entry['book'] for entry in pending],
+                    update_conflicts=True,
+                    unique_fields=['gutenberg_id'],
+                    update_fields=BOOK_FIELDS,
+                )
+
+                for field, ids, key in (('authors', self.persons, 'person_id'),
+                                        ('languages', self.languages, 'language_id'),
+                                        ('subjects', self.subjects, 'subject_id')):
+                    through = getattr(Book, field).through
+                    rows = [
+                        through(book_id=entry['book'].gutenberg_id, **{key: ids[value]})
+                        for entry in pending for value in entry[field]
+                    ]
+                    through.objects.bulk_create(rows, ignore_conflicts=True)
+
+                # The cards of these books are stale, they're serialized on the fly until the next buildBookCards
+                BookCard.objects.filter(book_id__in=[entry['book'].gutenberg_id for entry in pending]).delete()
+                bump_dataset_generation('books')
+        except Exception:
+            # The ids of the rolled back rows are gone, the maps are read again on the next batch
+            self.persons = self.subjects = self.languages = None
+            raise
+        self.written += len(pending)
@@ -0,0 +1,118 @@
+import concurrent.futures
+import os
+
+import numpy as np
+from scipy import sparse
+
+from data.config import JACCARD_BLOCK_SIZE
+
+# Set in each worker process by _init_worker, shared by all the blocks it computes
+_worker_matrix = None
+_worker_pks = None
+
+
+def occurrence_matrix(books_occurences):
+    """
+    Map the {pk: {token: occurrences}} counters to a sparse book x token matrix.
+
+    Returns the book pks (sorted, row order) and the CSR matrix.
+    """
+    pks = np.asarray(sorted(books_occurences), dtype=np.int64)
+    column_of = {}
+    indptr = [0]
+    indices, data = [], []
+    for pk in pks:
+        for token, occurences in books_occurences[int(pk)].items():
+            if occurences:
+                indices.append(column_of.setdefault(token, len(column_of)))
+                data.append(occurences)
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(pks), len(column_of)),
+    )
+    return pks, matrix
+
+
+def block_distances(matrix, rows, block):
+    """
+    Jaccard distances between the books of `rows` and those of the CSC `block`,
+    with the definition of data.jaccard.jaccard_distance : only the shared tokens
+    count, distance = sum(|k1 - k2|) / sum(max(k1, k2)), 1 when nothing is shared.
+
+    Returns a (len(rows), block.shape[0]) dense array.
+    """
+    distances = np.ones((len(rows), block.shape[0]))
+    for position, row in enumerate(rows):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        columns, counts = matrix.indices[start:end], matrix.data[start:end]
+        shared = block[:, columns]
+        # Stored entries of `shared` are exactly the tokens present in both books
+        other = shared.data
+        mine = counts[np.repeat(np.arange(len(columns)), np.diff(shared.indptr))]
+        numerator = np.bincount(shared.indices, weights=np.abs(mine - other), minlength=block.shape[0])
+        denominator = np.bincount(shared.indices, weights=np.maximum(mine, other), minlength=block.shape[0])
+        np.divide(numerator, denominator, out=distances[position], where=denominator != 0)
+    return distances
+
+
+def _init_worker(matrix, pks):
+    global _worker_matrix, _worker_pks
+    _worker_matrix = matrix
+    _worker_pks = pks
+
+
+def _row_block_edges(rows, first_column, upper, block_size, threshold):
+    """
+    Edges between the books of `rows` and the rows from `first_column` on,
+    one column block at a time. With `upper`, only the pairs i < j are kept.
+    """
+    matrix, pks = _worker_matrix, _worker_pks
+    edges = []
+    for block_start in range(first_column, matrix.shape[0], block_size):
+        block_end = min(block_start + block_size, matrix.shape[0])
+        block = matrix[block_start:block_end].tocsc()
+        distances = block_distances(matrix, rows, block)
+        columns = np.arange(block_start, block_end)[None, :]
+        keep = rows[:, None] < columns if upper else rows[:, None] != columns
+        for i, j in zip(*np.nonzero((distances < threshold) & keep)):
+            pk1, pk2 = int(pks[rows[i]]), int(pks[block_start + j])
+            edges.append((min(pk1, pk2), max(pk1, pk2)))
+    return edges
+
+
+def jaccard_edges(books_occurences, threshold, block_size=JACCARD_BLOCK_SIZE, workers=None, progress=None, only=None):
+    """
+    Every pair of books closer than `threshold`, as a set of (pk1, pk2) with pk1 < pk2.
+    With `only`, just the pairs having at least one book in `only`.
+
+    The pairs are computed by blocks of `block_size` x `block_size` books in a
+    process pool, the memory of a block is bounded by the tokens of its books.
+    `progress` is called with the number of rows done after each row block.
+    """
+    pks, matrix = occurrence_matrix(books_occurences)
+    if only is None:
+        # Row block [start, end) against the rows after it
+        tasks = [(np.arange(start, min(start + block_size, len(pks))), start, True) for start in range(0, len(pks), block_size)]
+    else:
+        # The rows of `only` against every row
+        rows = np.flatnonzero(np.isin(pks, np.asarray(sorted(only), dtype=np.int64)))
+        tasks = [(rows[start:start + block_size], 0, False) for start in range(0, len(rows), block_size)]
+    workers = workers or os.cpu_count() or 1
+    edges = set()
+    if not tasks:
+        return edges
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(1, min(workers, len(tasks))),
+        initializer=_init_worker,
+        initargs=(matrix, pks),
+    ) as executor:
+        futures = {
+            executor.submit(_row_block_edges, rows, first_column, upper, block_size, threshold): len(rows)
+            for rows, first_column, upper in tasks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            edges.update(future.result())
+            if progress is not None:
+                progress(futures[future])
+    return edges
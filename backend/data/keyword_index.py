@@ -0,0 +1,115 @@
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from data.automaton import VocabularyTrie
+from data.models import KeywordBookEnglish, KeywordBookFrench
+from data.regex_search import regex_search
+from data.response_cache import dataset_generation
+from data.trigram import TrigramIndex
+
+# Languages that have a keyword table, keyed by the code used in the `languages` filter
+KEYWORD_LANGUAGES = ('en', 'fr')
+KEYWORD_BOOK_MODELS = {
+    'en': KeywordBookEnglish,
+    'fr': KeywordBookFrench,
+}
+
+# Posting list of a token : the books that contain it, with the matching TF-IDF scores
+Posting = namedtuple('Posting', ['book_ids', 'scores'])
+
+
+class KeywordIndex:
+    """
+    Process-resident inverted index over the keyword tables.
+
+    For each language we keep a sorted token dictionary and, for every token,
+    the posting list of the books containing it along with their tfidf_score.
+    Keyword filters are answered from memory instead of joining
+    KeywordBook{English,French} on every request.
+    """
+
+    def __init__(self, postings, generation=None):
+        # Generation of the keywords the index was built from
+        self.generation = generation
+        # {language: {token: Posting}}
+        self.postings = postings
+        # {language: [token, ...]} sorted, used to enumerate the vocabulary
+        self.tokens = {language: sorted(postings[language]) for language in postings}
+        # {language: VocabularyTrie} walked by the regex automaton for anchored patterns
+        self.tries = {language: VocabularyTrie(tokens) for language, tokens in self.tokens.items()}
+        # {language: TrigramIndex} over the tokens, used to narrow down the matching tokens
+        self.token_grams = {}
+        for language, tokens in self.tokens.items():
+            grams = TrigramIndex()
+            for token in tokens:
+                grams.add(token, token)
+            self.token_grams[language] = grams
+
+    @classmethod
+    def build(cls, generation=None):
+        start_time = time.time()
+        postings = {}
+        for language, model in KEYWORD_BOOK_MODELS.items():
+            book_ids = defaultdict(list)
+            scores = defaultdict(list)
+            rows = model.objects.values_list('keyword__token', 'book_id', 'tfidf_score')
+            for token, book_id, score in rows.iterator(chunk_size=10000):
+                book_ids[token].append(book_id)
+                scores[token].append(score)
+            postings[language] = {
+                token: Posting(tuple(book_ids[token]), tuple(scores[token]))
+                for token in book_ids
+            }
+        index = cls(postings, generation)
+        print(f"Keyword index built in {time.time() - start_time:.4f} seconds "
+              f"({', '.join(f'{lang}: {len(index.tokens[lang])} tokens' for lang in index.tokens)})")
+        return index
+
+    def match_tokens(self, language, keyword, method='icontains'):
+        """Return the tokens of `language` matching `keyword` ('icontains' or 'regex')."""
+        grams = self.token_grams.get(language)
+        if grams is None:
+            return []
+        if method == 'icontains':
+            return sorted(grams.search(keyword))
+        try:
+            tokens = self.tries[language].search(keyword)
+        except re.error:
+            return []
+        if tokens is None:
+            # Unanchored or unsupported pattern : trigram prefiltering instead
+            tokens = regex_search(grams, keyword)
+        return sorted(tokens)
+
+    def posting(self, language, token):
+        return self.postings.get(language, {}).get(token)
+
+    def search(self, keyword, method='icontains', languages=KEYWORD_LANGUAGES):
+        """Return the set of book ids having at least one token matching `keyword`."""
+        book_ids = set()
+        for language in languages:
+            postings = self.postings.get(language, {})
+            for token in self.match_tokens(language, keyword, method):
+                book_ids.update(postings[token].book_ids)
+        return book_ids
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_keyword_index(generation=None):
+    """
+    Return the shared keyword index, built on first use and rebuilt when the
+    generation of the keywords changes (new keywords or scores).
+    """
+    global _index
+    if generation is None:
+        generation = dataset_generation('keywords')
+    if _index is None or _index.generation != generation:
+        with _index_lock:
+            if _index is None or _index.generation != generation:
+                _index = KeywordIndex.build(generation)
+    return _index
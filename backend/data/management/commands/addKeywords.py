@@ -1,55 +1,122 @@
 from django.core.management.base import BaseCommand
 from data.models import *
+from data.manifest import Manifest, folder_hashes
+from data.response_cache import bump_dataset_generation
+from django.db import transaction
 import os
 import json
+import time
 from tqdm import tqdm
 
 dossier_occu = 'keywords'
 MIN_OCCURENCE_THRESHOLD_FRENCH =10
 MIN_OCCURENCE_THRESHOLD_ENGLISH =25
+MIN_OCCURENCE_THRESHOLDS = {
+    'en': MIN_OCCURENCE_THRESHOLD_ENGLISH,
+    'fr': MIN_OCCURENCE_THRESHOLD_FRENCH,
+}
+# Token table and book/token table of each language
+KEYWORD_TABLES = {
+    'en': (KeywordsEnglish, KeywordBookEnglish),
+    'fr': (KeywordsFrench, KeywordBookFrench),
+}
+
+
 class Command(BaseCommand):
     help = 'add keywords'
-    
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Reload every keyword file, not only the new or changed ones')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk insert')
+        parser.add_argument('--checkpoint', type=int, default=200,
+                            help='Keyword files per transaction, recorded in the manifest once committed '
+                                 '(an interrupted load restarts after the last checkpoint), 0 for a single transaction')
+
     def handle(self, *args, **options):
-        keywords = dict()
-        keywords_code = {'en': set(), 'fr': set()}
-        
-        # Get list of files first, then use tqdm to show progress
-        files = os.listdir(dossier_occu)
-        self.stdout.write(f"Processing {len(files)} keyword files...")
-        
-        for nom_fichier in tqdm(files, desc="Reading keyword files"):
-            chemin_fichier = os.path.join(dossier_occu, nom_fichier)
-            pk = int(nom_fichier.split('.')[0])
-            with open(chemin_fichier, 'r') as f:
+        batch_size = options['batch_size']
+
+        # Only the keyword files that changed since the last run
+        stage = Manifest().stage('addKeywords', {
+            'min_occurence_french': MIN_OCCURENCE_THRESHOLD_FRENCH,
+            'min_occurence_english': MIN_OCCURENCE_THRESHOLD_ENGLISH,
+        }, full=options['full'])
+        hashes = folder_hashes(dossier_occu, '.json')
+        changed, removed = stage.changes(hashes)
+        # The keywords of the removed books are dropped
+        with transaction.atomic():
+            for _, keyword_book_model in KEYWORD_TABLES.values():
+                keyword_book_model.objects.filter(book_id__in=removed).delete()
+            if removed:
+                bump_dataset_generation('keywords')
+        for pk in removed:
+            stage.forget(pk)
+        stage.save()
+
+        pks = sorted(changed)
+        self.stdout.write(f"Processing {len(pks)} keyword files ({len(hashes.keys() - changed)} unchanged files carried over)...")
+
+        # Language of every book in one query (first language of the book, as before)
+        languages = {}
+        for book_id, code in Book.languages.through.objects.filter(book_id__in=pks).order_by('id').values_list('book_id', 'language__code'):
+            languages.setdefault(book_id, code)
+        skipped = [pk for pk in pks if languages.get(pk) not in KEYWORD_TABLES]
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"{len(skipped)} books are missing from the database or have no en/fr language, skipped"))
+            pks = [pk for pk in pks if languages.get(pk) in KEYWORD_TABLES]
+
+        # Token -> id of each language, filled as new tokens are inserted
+        token_ids = {
+            code: dict(keywords_model.objects.values_list('token', 'id'))
+            for code, (keywords_model, _) in KEYWORD_TABLES.items()
+        }
+
+        start_time = time.time()
+        checkpoint = options['checkpoint'] or len(pks) or 1
+        rows_count = 0
+        with tqdm(total=len(pks), desc="Loading keyword files") as progress:
+            for start in range(0, len(pks), checkpoint):
+                chunk = pks[start:start + checkpoint]
+                rows_count += self.load_chunk(chunk, languages, token_ids, batch_size)
+                # The chunk is committed : a restart carries it over
+                for pk in chunk:
+                    stage.record(pk, hashes[pk])
+                stage.save()
+                progress.update(len(chunk))
+
+        self.stdout.write(f"{rows_count} keyword rows inserted in {time.time() - start_time:.2f} seconds")
+        self.stdout.write(self.style.SUCCESS('Successfully added keywords'))
+
+    def load_chunk(self, pks, languages, token_ids, batch_size):
+        """Replace the keywords of the books of `pks`, in one transaction."""
+        # (book_id, token, occurence) kept for each language
+        occurences = {code: [] for code in KEYWORD_TABLES}
+        for pk in pks:
+            code = languages[pk]
+            with open(os.path.join(dossier_occu, f"{pk}.json"), 'r') as f:
                 keywords_book = json.load(f)
-                book = Book.objects.get(pk=pk)
-            book_language_code = book.languages.all()[0].code
-            for k, occ in keywords_book.items():
-                if book_language_code == 'fr' and occ < MIN_OCCURENCE_THRESHOLD_FRENCH:
-                    continue
-                elif book_language_code == 'en' and occ < MIN_OCCURENCE_THRESHOLD_ENGLISH:
-                    continue
-                else:
-                    if k not in keywords:
-                        keywords_code[book_language_code].add(k)
-                        keywords[k] = {(book, occ)}
-                    else:
-                        keywords[k].add((book, occ))
-        self.stdout.write(f"Creating English keywords ({len(keywords_code['en'])} tokens)...")
-        for k in tqdm(keywords_code['en'], desc="Creating English keywords"):
-            key_en = KeywordsEnglish.objects.create(token=k)
-            for (b, occu) in keywords[k]:
-                KeywordBookEnglish.objects.create(book=b, occurence=occu, keyword=key_en)
-                key_en.books.add(b)
-        #to put back after treatement
-        self.stdout.write(f"Creating French keywords ({len(keywords_code['fr'])} tokens)...")
-        for k in tqdm(keywords_code['fr'], desc="Creating French keywords"):
-            key_fr = KeywordsFrench.objects.create(token=k)
-            for (b, occu) in keywords[k]:
-                KeywordBookFrench.objects.create(book=b, occurence=occu, keyword=key_fr)
-                key_fr.books.add(b)
-        
-      
-        
-        self.stdout.write(self.style.SUCCESS('Successfully added keywords'))
\ No newline at end of file
+            threshold = MIN_OCCURENCE_THRESHOLDS[code]
+            occurences[code].extend((pk, k, occ) for k, occ in keywords_book.items() if occ >= threshold)
+
+        rows_count = 0
+        with transaction.atomic():
+            for code, (keywords_model, keyword_book_model) in KEYWORD_TABLES.items():
+                keyword_book_model.objects.filter(book_id__in=pks).delete()
+
+                # Each new token is inserted once, then looked up in memory
+                ids = token_ids[code]
+                new_tokens = sorted({k for _, k, _ in occurences[code] if k not in ids})
+                for start in range(0, len(new_tokens), batch_size):
+                    tokens = new_tokens[start:start + batch_size]
+                    keywords_model.objects.bulk_create([keywords_model(token=k) for k in tokens], ignore_conflicts=True)
+                    ids.update(keywords_model.objects.filter(token__in=tokens).values_list('token', 'id'))
+
+                # The book/token rows are also the `books` many-to-many of the token
+                rows = [
+                    keyword_book_model(book_id=pk, keyword_id=ids[k], occurence=occ)
+                    for pk, k, occ in occurences[code]
+                ]
+                keyword_book_model.objects.bulk_create(rows, batch_size=batch_size)
+                rows_count += len(rows)
+            # The keyword searches cached before this chunk are stale
+            bump_dataset_generation('keywords')
+        return rows_count
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from data.ann import AnnIndex
+from data.config import ANN_LEAF_SIZE, ANN_TREES, DOSSIER_ANN_INDEX
+from data.tfidf_matrix import get_tfidf_matrix
+from data.models import Book
+import numpy as np
+import time
+
+class Command(BaseCommand):
+    help = 'Build the approximate nearest-neighbour index over the TF-IDF vectors of the books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trees', type=int, default=ANN_TREES, help='Number of random-projection trees (recall vs build/query time)')
+        parser.add_argument('--leaf-size', type=int, default=ANN_LEAF_SIZE, help='Maximum number of books per leaf')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for reproducible builds')
+        parser.add_argument('--output', type=str, default=DOSSIER_ANN_INDEX, help='Directory of the index')
+        parser.add_argument('--query', type=int, default=None, help='Print the books most similar to this book id')
+        parser.add_argument('--top', type=int, default=10, help='Number of similar books per query')
+        parser.add_argument('--search-k', type=int, default=None, help='Candidates inspected per query (default: top * trees)')
+        parser.add_argument('--evaluate', type=int, default=0, help='Measure recall@top against brute force on N random books')
+
+    def handle(self, *args, **options):
+        tfidf_matrix = get_tfidf_matrix()
+        self.stdout.write('['+time.ctime()+f'] Building {options["trees"]} trees over {tfidf_matrix.matrix.shape[0]} books...')
+        start_time = time.time()
+        index = AnnIndex.build(
+            tfidf_matrix.matrix,
+            tfidf_matrix.book_ids,
+            n_trees=options['trees'],
+            leaf_size=options['leaf_size'],
+            seed=options['seed'],
+        )
+        index.save(options['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f'[{time.ctime()}] ANN index built in {time.time() - start_time:.2f} seconds '
+            f'({len(index.pivots)} nodes) and saved to {options["output"]}'
+        ))
+
+        top = options['top']
+        if options['query'] is not None:
+            results = index.query(book_id=options['query'], k=top, search_k=options['search_k'])
+            titles = Book.objects.in_bulk([book_id for book_id, _ in results])
+            for book_id, score in results:
+                title = titles[book_id].title if book_id in titles else '?'
+                self.stdout.write(f'  {score:.4f}  {title} (ID: {book_id})')
+
+        if options['evaluate']:
+            rng = np.random.default_rng(options['seed'])
+            sample = rng.choice(index.book_ids, size=min(options['evaluate'], len(index.book_ids)), replace=False)
+            found = expected = 0
+            ann_time = exact_time = 0.0
+            for book_id in sample:
+                timer = time.time()
+                approximate = {b for b, _ in index.query(book_id=book_id, k=top, search_k=options['search_k'])}
+                ann_time += time.time() - timer
+                timer = time.time()
+                exact = {b for b, _ in index.exact_query(book_id, k=top)}
+                exact_time += time.time() - timer
+                found += len(approximate & exact)
+                expected += len(exact)
+            recall = found / expected if expected else 1.0
+            self.stdout.write(self.style.SUCCESS(
+                f'Recall@{top} on {len(sample)} books: {recall:.3f} '
+                f'(ANN {1000 * ann_time / len(sample):.2f} ms/query, brute force {1000 * exact_time / len(sample):.2f} ms/query)'
+            ))
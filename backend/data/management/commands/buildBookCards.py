@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from data.cards import serialize_cards
+from data.config import CARDS_BATCH_SIZE
+from data.models import Book, BookCard
+from data.response_cache import bump_dataset_generation
+from data.serializers import BookSerializer
+from tqdm import tqdm
+import time
+
+
+class Command(BaseCommand):
+    help = 'Precompute the JSON card of every book, served by the listings without serializing the books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CARDS_BATCH_SIZE, help='Books serialized per chunk')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        batch_size = options['batch_size']
+        book_ids = list(Book.objects.order_by('gutenberg_id').values_list('gutenberg_id', flat=True))
+
+        # One transaction : the listings see the old cards or the new ones, never none
+        with transaction.atomic():
+            BookCard.objects.all().delete()
+            for i in tqdm(range(0, len(book_ids), batch_size), desc="Building cards"):
+                books = BookSerializer.setup_eager_loading(Book.objects.filter(gutenberg_id__in=book_ids[i:i + batch_size]))
+                cards = serialize_cards(books)
+                BookCard.objects.bulk_create([BookCard(book_id=book_id, data=data) for book_id, data in cards.items()])
+            bump_dataset_generation()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"[{time.ctime()}] {len(book_ids)} cards built in {time.time() - start_time:.2f} seconds"
+        ))
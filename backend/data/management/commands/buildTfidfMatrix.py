@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from data.config import DOSSIER_TFIDF_MATRIX
+from data.response_cache import bump_dataset_generation
+from data.tfidf_matrix import TfidfMatrix
+import time
+
+class Command(BaseCommand):
+    help = 'Export the TF-IDF scores as a memory-mappable CSR matrix used by the cosine similarity search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, default=DOSSIER_TFIDF_MATRIX, help='Directory of the exported matrix')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        self.stdout.write('['+time.ctime()+'] Loading the TF-IDF scores...')
+        matrix = TfidfMatrix.from_database()
+
+        self.stdout.write('['+time.ctime()+'] Writing the matrix...')
+        matrix.save(options['output'])
+        # The servers reload the matrix on the next cosine request
+        bump_dataset_generation('keywords')
+
+        n_books, n_tokens = matrix.matrix.shape
+        self.stdout.write(self.style.SUCCESS(
+            f'[{time.ctime()}] Exported {n_books} books x {n_tokens} tokens '
+            f'({matrix.matrix.nnz} scores) to {options["output"]} in {time.time() - start_time:.2f} seconds'
+        ))
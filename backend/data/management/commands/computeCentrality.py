@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from data.centrality import graph_centrality
+from data.config import CENTRALITY_BATCH_SIZE
+from data.manifest import Manifest
+from data.models import Book, Neighbors
+from data.response_cache import bump_dataset_generation
+from scipy import sparse
+from tqdm import tqdm
+import hashlib
+import numpy as np
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compute the closeness and betweenness of every book in the Neighbors graph, used by the centrality sorts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=0,
+                            help='Books used as sources of the searches, the scores are estimated from them (0 : every book, exact scores)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the choice of the sources')
+        parser.add_argument('--batch-size', type=int, default=CENTRALITY_BATCH_SIZE, help='Sources searched at once')
+        parser.add_argument('--update-batch-size', type=int, default=1000, help='Books per UPDATE')
+        parser.add_argument('--full', action='store_true', help='Recompute the scores even if the graph is unchanged')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        # gutenberg_id, closeness, betweenness of every book
+        books = np.array(Book.objects.order_by('gutenberg_id').values_list('gutenberg_id', 'closeness', 'betweenness'), dtype=np.float64).reshape(-1, 3)
+        book_ids, current = books[:, 0].astype(np.int64), books[:, 1:]
+        # (book, neighbor) of every edge, each edge is stored from both of its ends
+        edges = np.array(
+            Neighbors.neighbors.through.objects.values_list('neighbors__book_id', 'book_id'), dtype=np.int64
+        ).reshape(-1, 2)
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+        # A book added since the list of the books was read isn't in the graph yet
+        edges = edges[np.isin(edges, book_ids).all(axis=1)]
+        self.stdout.write(f"[{time.ctime()}] {len(book_ids)} books, {len(edges)} edges")
+
+        # Nothing to do if the books and the edges are the same as on the last run
+        stage = Manifest().stage('computeCentrality', {'samples': options['samples'], 'seed': options['seed']}, full=options['full'])
+        digest = hashlib.sha256(book_ids.tobytes() + b'|' + edges.tobytes()).hexdigest()
+        if stage.inputs.get('graph') == digest:
+            self.stdout.write("Neighbors graph unchanged since the last run, scores carried over")
+            return
+
+        rows, columns = np.searchsorted(book_ids, edges[:, 0]), np.searchsorted(book_ids, edges[:, 1])
+        n = len(book_ids)
+        adjacency = sparse.csr_matrix(
+            (np.ones(2 * len(edges)), (np.concatenate([rows, columns]), np.concatenate([columns, rows]))), shape=(n, n)
+        )
+        sources = None
+        if 0 < options['samples'] < n:
+            sources = np.sort(np.random.default_rng(options['seed']).choice(n, options['samples'], replace=False))
+        closeness, betweenness = graph_centrality(adjacency, sources, options['batch_size'])
+        self.stdout.write(f"[{time.ctime()}] Centrality computed in {time.time() - start_time:.2f} seconds")
+
+        # Write back only the scores that changed
+        changed = np.flatnonzero(~(np.isclose(current[:, 0], closeness, rtol=0, atol=1e-12)
+                                   & np.isclose(current[:, 1], betweenness, rtol=0, atol=1e-12)))
+        batch_size = options['update_batch_size']
+        with transaction.atomic():
+            for start in tqdm(range(0, len(changed), batch_size), desc="Updating books"):
+                batch = changed[start:start + batch_size]
+                Book.objects.bulk_update(
+                    [Book(gutenberg_id=int(book_ids[i]), closeness=float(closeness[i]), betweenness=float(betweenness[i])) for i in batch],
+                    ['closeness', 'betweenness'],
+                )
+            # The cached centrality sorts are stale
+            bump_dataset_generation()
+        stage.inputs = {'graph': digest}
+        stage.save()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"[{time.ctime()}] {len(changed)} books updated in {time.time() - start_time:.2f} seconds"
+        ))
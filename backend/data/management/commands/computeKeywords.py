@@ -1,100 +1,263 @@
 from django.core.management.base import BaseCommand
 from data.models import Book
-import spacy
+from data.manifest import Manifest
+from data.storage import BookStore
 import os
+import time
 from collections import Counter
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+KEYWORD_MODELS = {
+    'en': 'en_core_web_sm',
+    'fr': 'fr_core_news_sm',
+}
+READ_CHUNK_CHARS = 1 << 20   # characters read at once from a book
+
+
+def load_models():
+    import spacy
+    return {code: spacy.load(model, disable=['parser', 'ner']) for code, model in KEYWORD_MODELS.items()}
+
+
+def _split_long(text, max_chars):
+    """Cut `text` in pieces of at most `max_chars` characters, on whitespace when possible."""
+    while len(text) > max_chars:
+        cut = max(text.rfind(' ', 0, max_chars + 1), text.rfind('\n', 0, max_chars + 1))
+        if cut <= 0:
+            cut = max_chars
+        yield text[:cut]
+        text = text[cut:]
+    yield text
+
+
+def read_paragraphs(fichier, max_chars, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Paragraphs of the book (separated by "\n\n") from its text file object,
+    read `chunk_chars` at a time : only the last, unfinished paragraph is held
+    between two reads. Paragraphs longer than `max_chars` are cut on whitespace.
+    """
+    remainder = ''
+    while True:
+        chunk = fichier.read(chunk_chars)
+        if not chunk:
+            break
+        paragraphs = (remainder + chunk).split("\n\n")
+        remainder = paragraphs.pop()
+        for paragraph in paragraphs:
+            yield from _split_long(paragraph, max_chars)
+        if len(remainder) > max_chars:
+            # Paragraph without end in sight, emit what is already known
+            *pieces, remainder = _split_long(remainder, max_chars)
+            yield from pieces
+    yield from _split_long(remainder, max_chars)
+
+
+def book_batches(store, pk, batch_size, max_chars):
+    """
+    Texts given to spaCy for one book of the store : batches of `batch_size` paragraphs
+    joined with a space, a batch is closed earlier to stay under `max_chars`.
+    """
+    batch, length = [], 0
+    with store.open(pk) as fichier:
+        for paragraph in read_paragraphs(fichier, max_chars):
+            if batch and (len(batch) == batch_size or length + 1 + len(paragraph) > max_chars):
+                yield " ".join(batch)
+                batch, length = [], 0
+            length += len(paragraph) + (1 if batch else 0)
+            batch.append(paragraph)
+    yield " ".join(batch)
+
+
+def doc_keywords(doc):
+    return [
+        token.lemma_.casefold()
+        for token in doc
+        if token.is_alpha and not token.is_stop
+    ]
+
+
+def save_keywords(pk, keywords_counter):
+    output_path = os.path.join("./keywords/", f"{pk}.json")
+    with open(output_path, "w") as fichier:
+        json.dump(keywords_counter, fichier)
+
+
+def book_language(book):
+    """Keyword language of the book, None if it has no keyword model."""
+    languages = list(book.languages.all())
+    if not languages or languages[0].code not in KEYWORD_MODELS:
+        return None
+    return languages[0].code
+
+
 class Command(BaseCommand):
     help = 'Extract keywords from books'
 
     def add_arguments(self, parser):
         parser.add_argument('--batch_size', type=int, default=1000, help='Batch size for text processing')
         parser.add_argument('--max_workers', type=int, default=4, help='Maximum number of worker threads')
+        parser.add_argument('--max_chars', type=int, default=None,
+                            help='Maximum characters of a text given to spaCy (default: max_length of the model)')
+        parser.add_argument('--mode', choices=['threads', 'processes'], default='threads',
+                            help='threads : one book at a time per thread, processes : books streamed through nlp.pipe by language')
+        parser.add_argument('--n_process', type=int, default=os.cpu_count() or 1, help='spaCy processes in processes mode')
+        parser.add_argument('--pipe_batch_size', type=int, default=8, help='Texts per nlp.pipe batch in processes mode')
+        parser.add_argument('--full', action='store_true', help='Process every book, not only the new or changed ones')
 
     def handle(self, *args, **options):
         # Load models once
-        nlp = {
-            'en': spacy.load('en_core_web_sm', disable=['parser', 'ner']), 
-            'fr': spacy.load('fr_core_news_sm', disable=['parser', 'ner'])
-        }
-        
+        nlp = load_models()
+
         # Create output directory if it doesn't exist
         os.makedirs("./keywords/", exist_ok=True)
-        
-        # Get all books at once to avoid multiple DB queries
-        books = list(Book.objects.all().prefetch_related('languages'))
-        
-        with ThreadPoolExecutor(max_workers=options['max_workers']) as executor:
-            futures = []
+
+        # Texts stay under the max_length of the models, whatever the size of the book
+        max_chars = {
+            code: min(options['max_chars'] or model.max_length, model.max_length - 1)
+            for code, model in nlp.items()
+        }
+
+        # Only the books whose text changed since the last run (or whose keywords are missing)
+        stage = Manifest().stage('computeKeywords', {
+            'models': {code: f"{KEYWORD_MODELS[code]}-{model.meta.get('version')}" for code, model in nlp.items()},
+            'batch_size': options['batch_size'],
+            'max_chars': max_chars,
+        }, full=options['full'])
+        # Texts read from the compressed shards, same sha256 as the former books/<pk>.txt files
+        store = BookStore()
+        hashes = store.hashes()
+        # Get all books at once to avoid multiple DB queries. Only the books with a
+        # keyword model are inputs : the others never get a keywords file
+        books = {
+            book.pk: book
+            for book in Book.objects.filter(pk__in=hashes.keys()).prefetch_related('languages')
+            if book_language(book) is not None
+        }
+        hashes = {pk: digest for pk, digest in hashes.items() if pk in books}
+        changed, removed = stage.changes(hashes)
+        for pk in removed:
+            if os.path.exists(os.path.join("./keywords/", f"{pk}.json")):
+                os.remove(os.path.join("./keywords/", f"{pk}.json"))
+            stage.forget(pk)
+        changed |= {pk for pk in hashes if not os.path.exists(os.path.join("./keywords/", f"{pk}.json"))}
+
+        books = [books[pk] for pk in sorted(changed)]
+        self.stdout.write(f"{len(books)} new or changed books, {len(hashes.keys() - changed)} unchanged books carried over")
+
+        start_time = time.time()
+        done = []
+
+        def on_done(pk):
+            stage.record(pk, hashes[pk])
+            done.append(pk)
+
+        try:
+            if options['mode'] == 'processes':
+                self.process_books_pipe(books, store, nlp, options['batch_size'], max_chars, options['n_process'], options['pipe_batch_size'], on_done)
+            else:
+                self.process_books_threads(books, store, nlp, options['batch_size'], max_chars, options['max_workers'], on_done)
+        finally:
+            stage.save()
+        elapsed = time.time() - start_time
+        self.stdout.write(f"{len(done)} books processed in {elapsed:.2f} seconds "
+                          f"({len(done) / elapsed * 60 if elapsed else 0:.1f} books/minute)")
+
+    def process_books_threads(self, books, store, nlp, batch_size, max_chars, max_workers, on_done):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
             for book in books:
-                futures.append(
+                futures[
                     executor.submit(
-                        self.process_book, 
-                        book, 
-                        nlp, 
-                        options['batch_size']
+                        self.process_book,
+                        book,
+                        store,
+                        nlp,
+                        batch_size,
+                        max_chars
                     )
-                )
-            
+                ] = book.pk
+
             # Process with progress bar
             for future in tqdm(as_completed(futures), total=len(futures), desc="Processing books"):
                 try:
-                    future.result()
+                    if future.result():
+                        on_done(futures[future])
                 except Exception as e:
                     self.stdout.write(self.style.ERROR(f"Error processing book: {e}"))
-    
-    def process_book(self, book, nlp_models, batch_size):
+
+    def process_books_pipe(self, books, store, nlp, batch_size, max_chars, n_process, pipe_batch_size, on_done):
+        """
+        Group the books by language and stream their texts through nlp.pipe :
+        spaCy starts `n_process` workers that each get a copy of the model once,
+        instead of threads fighting over the GIL. The texts of a book are
+        contiguous in the stream, its counter is saved when the next book starts.
+        """
+        by_language = {code: [] for code in nlp}
+        for book in books:
+            code = book_language(book)
+            if code is not None and book.pk in store:
+                by_language[code].append(book)
+
+        with tqdm(total=sum(len(language_books) for language_books in by_language.values()), desc="Processing books") as progress:
+            for code, language_books in by_language.items():
+                if not language_books:
+                    continue
+
+                # Books whose text failed partway : the chunks already given
+                # to spaCy make an incomplete counter, it isn't saved
+                failed = set()
+
+                def texts():
+                    for book in language_books:
+                        try:
+                            for text in book_batches(store, book.pk, batch_size, max_chars[code]):
+                                yield text, book.pk
+                        except Exception as e:
+                            failed.add(book.pk)
+                            self.stdout.write(self.style.ERROR(f"Error processing book {book.pk}: {e}"))
+
+                def finish(pk, keywords_counter):
+                    # The stream is read past the book once its last doc comes out
+                    if pk not in failed:
+                        save_keywords(pk, keywords_counter)
+                        on_done(pk)
+                    progress.update()
+
+                current_pk, keywords_counter = None, Counter()
+                for doc, pk in nlp[code].pipe(texts(), as_tuples=True, batch_size=pipe_batch_size, n_process=n_process):
+                    if pk != current_pk:
+                        if current_pk is not None:
+                            finish(current_pk, keywords_counter)
+                        current_pk, keywords_counter = pk, Counter()
+                    keywords_counter.update(doc_keywords(doc))
+                if current_pk is not None:
+                    finish(current_pk, keywords_counter)
+
+    def process_book(self, book, store, nlp_models, batch_size, max_chars):
         try:
             # Get language code
-            languages = list(book.languages.all())
-            if not languages:
-                return
-            
-            code = languages[0].code
-            if code not in ['en', 'fr']:
-                return
-                
-            str_pk = str(book.pk)
-            chemin_fichier = os.path.join('books', f"{str_pk}.txt")
-            
-            # Check if file exists
-            if not os.path.exists(chemin_fichier):
-                return
-                
+            code = book_language(book)
+            if code is None:
+                return False
+
+            # Check if the text is stored
+            if book.pk not in store:
+                return False
+
             # Process in batches to avoid memory issues
             keywords_counter = Counter()
-            
-            with open(chemin_fichier, "r", encoding='utf-8') as fichier:
-                document = fichier.read()
-                
-            # Split into paragraphs
-            texts = document.split("\n\n")
-            
-            # Process in batches
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i+batch_size]
-                batch_text = " ".join(batch)
-                
+            for batch_text in book_batches(store, book.pk, batch_size, max_chars[code]):
                 # Process with spaCy
                 doc = nlp_models[code](batch_text)
-                
-                # Extract keywords more efficiently
-                batch_keywords = [
-                    token.lemma_.casefold() 
-                    for token in doc 
-                    if token.is_alpha and not token.is_stop
-                ]
-                
+
                 # Update counter
-                keywords_counter.update(batch_keywords)
-            
+                keywords_counter.update(doc_keywords(doc))
+
             # Save results
-            output_path = os.path.join("./keywords/", f"{str_pk}.json")
-            with open(output_path, "w") as fichier:
-                json.dump(keywords_counter, fichier)
-                
+            save_keywords(book.pk, keywords_counter)
+            return True
+
         except Exception as e:
-            raise Exception(f"Error processing book {book.pk}: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Error processing book {book.pk}: {str(e)}")
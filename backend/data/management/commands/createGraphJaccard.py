@@ -2,6 +2,13 @@ from django.core.management import BaseCommand
 from data.models import *
 import requests
 from data.jaccard import jaccard_distance
+from data.jaccard_matrix import jaccard_edges
+from data.minhash import MinHashLSH
+from data.manifest import Manifest, folder_hashes
+from data.response_cache import bump_dataset_generation
+from django.db.models import Q
+from data.config import JACCARD_BLOCK_SIZE, MINHASH_BANDS, MINHASH_NUM_PERM, NEIGHBORS_BATCH_SIZE
+from django.db import transaction
 import time
 import json
 import os
@@ -17,23 +24,66 @@ class Command(BaseCommand):
     # Adding a lock for thread safety
     lock = threading.Lock()
 
-    def add_as_neighbor(self, pk1, pk2):
-        l1 = Book.objects.get(pk=pk1)
-        l2 = Book.objects.get(pk=pk2)
-        
-        # print('before')
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['exhaustive', 'blockwise', 'minhash'], default='exhaustive',
+                            help="exhaustive : compare every pair of books, blockwise : same pairs computed "
+                                 "by blocks with numpy in a process pool, minhash : only the LSH candidate pairs, "
+                                 "approximate : pairs sharing few tokens can be missed, see --report-recall for the recall "
+                                 "on the current keywords")
+        parser.add_argument('--block-size', type=int, default=JACCARD_BLOCK_SIZE, help='Books per block in blockwise mode')
+        parser.add_argument('--workers', type=int, default=None, help='Processes of the blockwise mode (default: CPU count)')
+        parser.add_argument('--num-perm', type=int, default=MINHASH_NUM_PERM, help='Length of the MinHash signatures')
+        parser.add_argument('--bands', type=int, default=MINHASH_BANDS,
+                            help='Number of LSH bands : more bands, more candidate pairs and a better recall')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the MinHash permutations')
+        parser.add_argument('--report-recall', action='store_true',
+                            help='Also compute the exhaustive graph (without writing it) and report the recall of the minhash mode')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Delete the current graph and write the new one in the same transaction')
+        parser.add_argument('--batch-size', type=int, default=NEIGHBORS_BATCH_SIZE, help='Rows per bulk insert')
+        parser.add_argument('--full', action='store_true',
+                            help='Recompute every pair, not only the pairs of the new or changed books')
 
-        # Création ou récupération de l'entrée pour l1
-        neighbor_entry1, created1 = Neighbors.objects.get_or_create(book=l1)
-        neighbor_entry1.neighbors.add(l2)  # Ajout de l2 comme voisin de l1
-        neighbor_entry1.save()
+    def write_edges(self, edges, rebuild=False, batch_size=NEIGHBORS_BATCH_SIZE, replace=None):
+        """
+        Write the (pk1, pk2) edges in both directions with bulk inserts, in one
+        transaction. With `rebuild`, the previous graph is deleted in the same
+        transaction so readers never see a half-built graph. With `replace`,
+        only the previous edges of those books are deleted.
+        """
+        through = Neighbors.neighbors.through
+        pks = {pk for edge in edges for pk in edge}
+        existing = set(Book.objects.filter(pk__in=pks).values_list('pk', flat=True))
+        missing = pks - existing
+        if missing:
+            self.stdout.write(self.style.WARNING(f'[{time.ctime()}] {len(missing)} books of the keywords folder are not in the database, their edges are skipped'))
+            edges = [(pk1, pk2) for pk1, pk2 in edges if pk1 in existing and pk2 in existing]
 
-        # Création ou récupération de l'entrée pour l2
-        neighbor_entry2, created2 = Neighbors.objects.get_or_create(book=l2)
-        neighbor_entry2.neighbors.add(l1)  # Ajout de l1 comme voisin de l2
-        neighbor_entry2.save()
-        # print('after')
-        self.stdout.write(self.style.SUCCESS(f'[{time.ctime()}] Successfully added the book {pk1} and book {pk2} as neighbors'))
+        start_time = time.time()
+        with transaction.atomic():
+            if rebuild:
+                through.objects.all().delete()
+                Neighbors.objects.all().delete()
+            elif replace:
+                through.objects.filter(Q(neighbors__book_id__in=replace) | Q(book_id__in=replace)).delete()
+            # One Neighbors entry per book having at least one neighbor
+            Neighbors.objects.bulk_create(
+                [Neighbors(book_id=pk) for pk in sorted(existing)],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+            entry_of = dict(Neighbors.objects.filter(book_id__in=existing).values_list('book_id', 'id'))
+            rows = []
+            for pk1, pk2 in tqdm(sorted(edges), desc="Writing edges"):
+                rows.append(through(neighbors_id=entry_of[pk1], book_id=pk2))
+                rows.append(through(neighbors_id=entry_of[pk2], book_id=pk1))
+                if len(rows) >= batch_size:
+                    through.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+                    rows = []
+            through.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+            # The cached suggestions come from the old graph
+            bump_dataset_generation()
+        self.stdout.write(self.style.SUCCESS(f'[{time.ctime()}] {len(edges)} edges written in {time.time() - start_time:.2f}s'))
 
     def process_book(self, pk, tokens, books_occurences, neighbor):
         book_neighbor = neighbor[pk]
@@ -44,8 +94,6 @@ class Command(BaseCommand):
                 continue
             if jaccard_distance(tokens, books_occurences[pk2]) < JACCARD_DISTANCE_THRESHOLD:
                 # print(pk, pk2)
-                with self.lock:
-                    self.add_as_neighbor(pk, pk2)
                 neighbors_found.append(pk2)
         
         # Update the neighbor dict with thread safety
@@ -56,12 +104,106 @@ class Command(BaseCommand):
                 else:
                     neighbor[pk2].append(pk)
                     
-        return pk
+        return pk, neighbors_found
+
+    def exhaustive_edges(self, books_occurences, only=None):
+        """Compare every pair of books (or the pairs of the books of `only`) with jaccard_distance, in a thread pool."""
+        edges = set()
+        neighbor = {pk : [] for pk in books_occurences.keys()}
+        
+        # Use ThreadPoolExecutor to process books in parallel
+        max_workers = min(32, len(books_occurences))  # Limit number of threads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Create a list of futures
+            futures = []
+            for pk, tokens in books_occurences.items():
+                if only is not None and pk not in only:
+                    continue
+                future = executor.submit(self.process_book, pk, tokens, books_occurences, neighbor)
+                futures.append(future)
             
+            # Process results with progress bar
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Processing books"):
+                pk, neighbors_found = future.result()
+                edges.update((min(pk, pk2), max(pk, pk2)) for pk2 in neighbors_found)
+        return edges
+
+    def blockwise_edges(self, books_occurences, block_size, workers, only=None):
+        """Every pair of books closer than the threshold, same result as the exhaustive mode."""
+        with tqdm(total=len(books_occurences) if only is None else len(only), desc="Blockwise pairs") as progress:
+            return jaccard_edges(books_occurences, JACCARD_DISTANCE_THRESHOLD, block_size, workers, progress.update, only)
+
+    def minhash_edges(self, books_occurences, num_perm, bands, seed, only=None):
+        """
+        Weighted MinHash signatures of the keyword counters, banded with LSH :
+        only the books sharing a band are compared with jaccard_distance.
+        The signatures estimate the weighted Jaccard similarity over the union
+        of the tokens while jaccard_distance only looks at the shared tokens,
+        so pairs sharing few tokens can be missed (see --report-recall).
+        """
+        lsh = MinHashLSH(num_perm=num_perm, bands=bands, seed=seed)
+        start_time = time.time()
+        for pk, tokens in tqdm(books_occurences.items(), desc="MinHash signatures"):
+            lsh.add(pk, tokens)
+        candidates = lsh.candidate_pairs()
+        if only is not None:
+            candidates = {(pk1, pk2) for pk1, pk2 in candidates if pk1 in only or pk2 in only}
+        n = len(books_occurences)
+        self.stdout.write(f'[{time.ctime()}] {len(candidates)} candidate pairs out of {n * (n - 1) // 2} '
+                          f'(signatures in {time.time() - start_time:.2f}s, LSH threshold ~{lsh.threshold:.2f})')
+        return {
+            (pk1, pk2) for pk1, pk2 in tqdm(candidates, desc="Checking candidates")
+            if jaccard_distance(books_occurences[pk1], books_occurences[pk2]) < JACCARD_DISTANCE_THRESHOLD
+        }
+
+    def handle_edges(self, books_occurences, options, only=None, replace=None):
+        """
+        Compute the edges in memory then write them in bulk : all of them, or
+        only the edges of the books of `only` replacing those of `replace`.
+        """
+        start_time = time.time()
+        if options['mode'] == 'minhash':
+            edges = self.minhash_edges(books_occurences, options['num_perm'], options['bands'], options['seed'], only)
+        elif options['mode'] == 'blockwise':
+            edges = self.blockwise_edges(books_occurences, options['block_size'], options['workers'], only)
+        else:
+            edges = self.exhaustive_edges(books_occurences, only)
+        self.stdout.write(f'[{time.ctime()}] {len(edges)} edges found in {time.time() - start_time:.2f}s')
+
+        if options['mode'] == 'minhash' and options['report_recall']:
+            start_time = time.time()
+            expected = self.blockwise_edges(books_occurences, options['block_size'], options['workers'], only)
+            recall = len(edges & expected) / len(expected) if expected else 1.0
+            self.stdout.write(f'[{time.ctime()}] Exhaustive mode : {len(expected)} edges in {time.time() - start_time:.2f}s, '
+                              f'recall of the minhash mode : {recall:.4f}')
+
+        self.write_edges(edges, rebuild=options['rebuild'], batch_size=options['batch_size'], replace=replace)
+
     def handle(self, *args, **options):
         books_occurences = dict()
         #using json file
         dossier_occu = "./keywords/"
+
+        # Only the pairs of the books whose keywords changed since the last run
+        params = {'threshold': JACCARD_DISTANCE_THRESHOLD, 'engine': 'exact'}
+        if options['mode'] == 'minhash':
+            params = {'threshold': JACCARD_DISTANCE_THRESHOLD, 'engine': 'minhash',
+                      'num_perm': options['num_perm'], 'bands': options['bands'], 'seed': options['seed']}
+        full = options['full'] or options['rebuild'] or not Neighbors.objects.exists()
+        stage = Manifest().stage('createGraphJaccard', params, full=full)
+        hashes = folder_hashes(dossier_occu, '.json')
+        changed, removed = stage.changes(hashes)
+        if not stage.inputs:
+            # Every pair again, the edges of the removed books are dropped
+            only, replace = None, removed
+        elif not changed and not removed:
+            self.stdout.write('['+time.ctime()+'] No keyword file changed since the last run, the graph is up to date.')
+            return
+        else:
+            only, replace = changed, changed | removed
+            self.stdout.write(f'[{time.ctime()}] {len(changed)} new or changed books, {len(removed)} removed books, '
+                              f'{len(hashes.keys() - changed)} unchanged books carried over')
+
         self.stdout.write('['+time.ctime()+'] Loading book data...')
         
         # Add tqdm for file loading
@@ -76,20 +218,10 @@ class Command(BaseCommand):
         
 
         self.stdout.write('['+time.ctime()+'] Creating the jaccard graph...')
-        neighbor = {pk : [] for pk in books_occurences.keys()}
-        
-        # Use ThreadPoolExecutor to process books in parallel
-        max_workers = min(32, len(books_occurences))  # Limit number of threads
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Create a list of futures
-            futures = []
-            for pk, tokens in books_occurences.items():
-                future = executor.submit(self.process_book, pk, tokens, books_occurences, neighbor)
-                futures.append(future)
-            
-            # Process results with progress bar
-            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Processing books"):
-                pk = future.result()
-                self.stdout.write(self.style.SUCCESS('['+time.ctime()+'] Successfully added the neighbors for book id="%s"' % pk))
-                
-        self.stdout.write('['+time.ctime()+'] End of Jaccard graph creation.')
\ No newline at end of file
+        self.handle_edges(books_occurences, options, only, replace)
+        for pk in removed:
+            stage.forget(pk)
+        for pk, digest in hashes.items():
+            stage.record(pk, digest)
+        stage.save()
+        self.stdout.write('['+time.ctime()+'] End of Jaccard graph creation.')
@@ -2,139 +2,203 @@ from django.core.management.base import BaseCommand
 from data.models import *
 import json
 import requests
-import re
-from data.config import URL_INIT_BIBLIOTHEQUE, MIN_NB_LIVRE_BIBLIOTHEQUE, MIN_NB_MOTS_LIVRES
+from data.config import URL_INIT_BIBLIOTHEQUE, MIN_NB_LIVRE_BIBLIOTHEQUE, MIN_NB_MOTS_LIVRES, DOWNLOAD_CONCURRENCY, DOWNLOAD_RETRIES, INGEST_BATCH_SIZE, DOSSIER_CATALOGUE
+from data.downloader import TEXT_FORMAT, READ_CHUNK_SIZE, BookStream, CatalogCache, crawl, expected_length
+from data.ingest import BookWriter
+from data.storage import BookStore
+import asyncio
 import time
 import os
+from asgiref.sync import sync_to_async
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-DOM = '\ufeff'
-dossier_book = "books/"
+# Next page to fetch, books saved and books too short so far (asyncio engine)
+checkpoint_path = os.path.join(DOSSIER_CATALOGUE, 'checkpoint.json')
 
-def compter_mots(url_du_livre, max_retries=3):
-    """Télécharge le livre et compte les mots avec une gestion des erreurs de connexion."""
+def compter_mots(url_du_livre, max_retries=3, min_words=None):
+    """
+    Télécharge le livre et compte les mots chunk by chunk avec une gestion des erreurs de connexion,
+    returns (PackedText, nombre_de_mots), (None, nombre_de_mots) if it stopped on a book too short.
+    """
     for attempt in range(max_retries):
         try:
-            fichier = requests.get(url_du_livre, timeout=10, stream=True)  
-            fichier.raise_for_status()
-            contenu = fichier.text
-            mots = re.findall(r'\b\w+\b', contenu)
-            nombre_de_mots = len(mots)
-            return contenu, nombre_de_mots
+            with requests.get(url_du_livre, timeout=10, stream=True) as fichier:
+                fichier.raise_for_status()
+                stream = BookStream(fichier.encoding or 'utf-8', min_words, expected_length(fichier.headers))
+                for chunk in fichier.iter_content(chunk_size=READ_CHUNK_SIZE):
+                    if not stream.feed(chunk):
+                        return None, stream.counter.count
+                return stream.finish()
         except (requests.exceptions.RequestException, requests.exceptions.ChunkedEncodingError) as e:
             print(f"Tentative {attempt+1}/{max_retries} échouée: {e}")
             time.sleep(2)  # Attente avant une nouvelle tentative
     raise Exception(f"Impossible de télécharger {url_du_livre} après {max_retries} tentatives")
 
 
-
-def put_book_db(book):
-    """Make/update the book."""
-    print(book['id'])
-    book_in_db = Book.objects.create(
-        gutenberg_id=book['id'],
-        download_count=book['download_count'],
-        title=book['title'],
-        cover_image=book['formats']['image/jpeg'],
-        plain_text=book['formats']['text/plain; charset=us-ascii']
-
-    )
-
-    """Make/update the authors."""
-
-    authors = []
-    for author in book['authors']:
-        person = Person.objects.filter(
-            name=author['name'],
-            birth_year=author['birth_year'],
-            death_year=author['death_year']
-        )
-        if person.exists():
-            person = person[0]
-        else:
-            person = Person.objects.create(
-                name=author['name'],
-                birth_year=author['birth_year'],
-                death_year=author['death_year']
-            )
-        authors.append(person)
-
-    for author in authors:
-        book_in_db.authors.add(author)
-
-    ''' Make/update the languages. '''
-    if book['languages']:  # Ensure the list is not empty
-        first_language = book['languages'][0]  # Take only the first language
-        language_in_db, created = Language.objects.get_or_create(code=first_language)
-        book_in_db.languages.add(language_in_db)  # Add only the first language
-
-    ''' Make/update subjects. '''
-
-    subjects = []
-    for subject in book['subjects']:
-        subject_in_db = Subject.objects.filter(name=subject)
-        if subject_in_db.exists():
-            subject_in_db = subject_in_db[0]
-        else:
-            subject_in_db = Subject.objects.create(name=subject)
-        subjects.append(subject_in_db)
-
-    for subject in subjects:
-        book_in_db.subjects.add(subject)
-
+def accept_book(book):
+    """Only the french and english books with a plain text version."""
+    return bool(book['languages']) and book['languages'][0] in ('en', 'fr') and TEXT_FORMAT in book['formats']
 
 
 class Command(BaseCommand):
     help = 'Initialise the database'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine',
+            choices=['asyncio', 'threads'],
+            default='asyncio',
+            help='asyncio : one event loop and a pooled keep-alive session ; threads : one requests call per thread'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=DOWNLOAD_CONCURRENCY,
+            help='Books downloaded at once (open connections for asyncio, threads for threads)'
+        )
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=DOWNLOAD_RETRIES,
+            help='Attempts per request before a book is skipped (asyncio engine)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=INGEST_BATCH_SIZE,
+            help='Books buffered before each write to the database'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint and walk the catalog from the first page (cached pages and stored texts are still reused)'
+        )
+        parser.add_argument(
+            '--offline',
+            action='store_true',
+            help='Rebuild the database from the cached catalog pages and the stored texts, without any network access'
+        )
+
     def handle(self, *args, **options):
+        start_time = time.time()
+        # Compressed shards of the texts, a book already stored isn't downloaded again
+        self.store = BookStore()
+        # The remaining buffered books are written when the crawl ends
+        with BookWriter(options['batch_size']) as self.writer:
+            if options['engine'] == 'asyncio':
+                nb_livres = self.handle_asyncio(options)
+            else:
+                nb_livres = self.handle_threads(options)
+        self.store.save()
+        self.stdout.write(self.style.SUCCESS(f'{nb_livres} books added in {time.time() - start_time:.2f} seconds'))
+
+    def save_book(self, book, contenu):
+        """
+        Buffer the book for the database and put its text (a PackedText) in the store
+        (None : already there), False if its metadata is incomplete.
+        """
+        try:
+            self.writer.add(book)
+        except KeyError as e:
+            print(f"Une KeyError s'est produite: {e}")
+            return False
+        if contenu is None:
+            return True
+
+        # Sauvegarde du livre en local
+        self.store.write_packed(book['id'], contenu)
+
+        self.stdout.write(self.style.SUCCESS(f'[{time.ctime()}] Successfully added book id="{book["id"]}"'))
+        return True
+
+    def load_checkpoint(self, options):
+        start = {'next': URL_INIT_BIBLIOTHEQUE, 'saved': [], 'too_short': []}
+        if options['offline'] or options['restart'] or not os.path.exists(checkpoint_path):
+            return start
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        # The pages before the checkpoint are skipped : their books must still be in the database
+        if Book.objects.filter(gutenberg_id__in=checkpoint['saved']).count() != len(checkpoint['saved']):
+            self.stdout.write(self.style.WARNING('Books of the checkpoint are missing from the database, starting from the first page'))
+            return start
+        self.stdout.write(f"Resuming from {checkpoint['next']} ({len(checkpoint['saved'])} books already added)")
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        os.makedirs(DOSSIER_CATALOGUE, exist_ok=True)
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    def handle_asyncio(self, options):
+        """Pages and texts downloaded by one event loop, the books saved one at a time."""
+        offline = options['offline']
+        checkpoint = self.load_checkpoint(options)
+        saved = set(checkpoint['saved'])
+        too_short = set(checkpoint['too_short'])
+
+        def accept(book):
+            return accept_book(book) and book['id'] not in too_short
+
+        def on_book_sync(book, contenu, nb_mot):
+            # nb_mot is None for a text already in the store
+            if nb_mot is not None and nb_mot < MIN_NB_MOTS_LIVRES:
+                too_short.add(book['id'])
+            elif self.save_book(book, contenu):
+                saved.add(book['id'])
+            return len(saved) >= MIN_NB_LIVRE_BIBLIOTHEQUE
+
+        def on_page_done_sync(next_url):
+            # Everything before next_url is committed before the checkpoint moves past it
+            self.writer.flush()
+            self.store.save()
+            if not offline:
+                self.save_checkpoint({'next': next_url, 'saved': sorted(saved), 'too_short': sorted(too_short)})
+
+        # Every call runs in the same thread : the writer is only used by that thread
+        on_book = sync_to_async(on_book_sync, thread_sensitive=True)
+        on_page_done = sync_to_async(on_page_done_sync, thread_sensitive=True)
+
+        if len(saved) < MIN_NB_LIVRE_BIBLIOTHEQUE:
+            asyncio.run(crawl(
+                checkpoint['next'], accept, on_book,
+                on_page_done=on_page_done,
+                # Only the complete texts of the index : a text cut short by an interruption is downloaded again
+                local=lambda book: book['id'] in self.store,
+                cache=CatalogCache(),
+                offline=offline,
+                min_words=MIN_NB_MOTS_LIVRES,
+                concurrency=options['concurrency'], retries=options['retries'],
+            ))
+        return len(saved)
+
+    def handle_threads(self, options):
         nb_livres = 0
         url = URL_INIT_BIBLIOTHEQUE
-        if not os.path.exists(dossier_book):
-            os.makedirs(dossier_book)
 
         while nb_livres < MIN_NB_LIVRE_BIBLIOTHEQUE:
             reponse = requests.get(url)
             json_data = reponse.json()
 
-            with ThreadPoolExecutor(max_workers=5000) as executor:
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
                 futures = {}
 
                 for book in json_data['results']:
-                    if book['languages'][0] == 'en' or book['languages'][0] == 'fr': 
-                        # print(book['languages'][0])
-                        # print(book['languages'])
-                        # if book['languages'][0] in ['es','tl','enm','fy','la','nah']: 
-                        #     continue 
-                        if 'text/plain; charset=us-ascii' in book['formats']:
-                            future = executor.submit(compter_mots, book['formats']['text/plain; charset=us-ascii'])
-                            futures[future] = book
+                    if accept_book(book):
+                        future = executor.submit(compter_mots, book['formats'][TEXT_FORMAT], min_words=MIN_NB_MOTS_LIVRES)
+                        futures[future] = book
 
                 for future in as_completed(futures):
                     book = futures[future]
                     try:
                         contenu, nb_mot = future.result()
-                        if nb_mot >= MIN_NB_MOTS_LIVRES:
-                            executor.submit(put_book_db, book)  #  Parallel DB insertion
-
-                            # Nettoyage du contenu
-                            if contenu and contenu[0] == DOM:
-                                contenu = contenu[1:]
-
-                            # Sauvegarde du livre en local
-                            chemin_fichier = os.path.join(dossier_book, f"{book['id']}.txt")
-                            with open(chemin_fichier, 'w', encoding="utf-8") as fichier:
-                                fichier.write(contenu)
-
+                        if nb_mot >= MIN_NB_MOTS_LIVRES and self.save_book(book, contenu):
                             nb_livres += 1
-                            self.stdout.write(self.style.SUCCESS(f'[{time.ctime()}] Successfully added book id="{book["id"]}"'))
 
                     except requests.exceptions.HTTPError:
                         self.stdout.write(' Request Exception\n')
                         continue
-                    except KeyError as e:
-                        print(f"Une KeyError s'est produite: {e}")
-                        continue
                     except Exception as error:
                         book_json = json.dumps(book, indent=4)
                         self.stdout.write(f'Error while putting this book info in the database:\n{book_json}\n')
@@ -143,4 +207,4 @@ class Command(BaseCommand):
             if json_data['next'] is None:
                 break
             url = json_data['next']
-
+        return nb_livres
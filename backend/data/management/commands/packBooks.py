@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from data.config import DOSSIER_SHARDS
+from data.manifest import file_hash
+from data.storage import BookStore
+from tqdm import tqdm
+import os
+import time
+
+
+def folder_size(folder):
+    if not os.path.isdir(folder):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+class Command(BaseCommand):
+    help = 'Pack the loose texts of books/ into the compressed shards and compact the shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', type=str, default='books', help='Folder of the <gutenberg_id>.txt files to import')
+        parser.add_argument('--remove-files', action='store_true', help='Delete the loose files once they are in the shards')
+        parser.add_argument('--no-compact', action='store_true', help="Don't rewrite the shards without their dead members")
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        folder = options['folder']
+        store = BookStore()
+        loose_size, shards_size = folder_size(folder), folder_size(DOSSIER_SHARDS)
+
+        # Loose files missing from the shards or different from the packed text
+        names = [name for name in os.listdir(folder) if name.endswith('.txt') and name[:-4].isdigit()] if os.path.isdir(folder) else []
+        hashes = store.hashes()
+        imported = []
+        for name in tqdm(sorted(names), desc="Packing books"):
+            pk, path = int(name[:-4]), os.path.join(folder, name)
+            if hashes.get(pk) != file_hash(path):
+                # newline='' : the packed text is byte for byte the file
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    store.write(pk, f.read())
+            imported.append(path)
+        store.save()
+        self.stdout.write(f"{len(imported)} loose books in {folder}/, {len(store)} books in {DOSSIER_SHARDS}")
+
+        if not options['no_compact']:
+            freed = store.compact()
+            self.stdout.write(f"Shards compacted, {freed / 2**20:.1f} MiB freed")
+
+        if options['remove_files']:
+            for path in imported:
+                os.remove(path)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"[{time.ctime()}] Done in {time.time() - start_time:.2f} seconds : "
+            f"{(loose_size + shards_size) / 2**20:.1f} MiB before, "
+            f"{(folder_size(folder) + folder_size(DOSSIER_SHARDS)) / 2**20:.1f} MiB after"
+        ))
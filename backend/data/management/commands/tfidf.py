@@ -1,130 +1,111 @@
+import hashlib
+import os
+import shutil
+import time
+
 import numpy as np
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfTransformer
 from tqdm import tqdm
-from data.models import Book, KeywordBookEnglish, KeywordsEnglish, KeywordBookFrench, KeywordsFrench
+from data.config import DOSSIER_TFIDF_MATRIX
+from data.models import KeywordBookEnglish, KeywordBookFrench
+from data.manifest import Manifest
+from data.response_cache import bump_dataset_generation
+from data.tfidf_matrix import TfidfMatrix
+
+# Column blocks of the count matrix : english keywords then french keywords
+KEYWORD_BOOK_MODELS = (KeywordBookEnglish, KeywordBookFrench)
+
 
 class Command(BaseCommand):
     help = "Compute and store TF-IDF scores for keywords in books"
-    
+
     def add_arguments(self, parser):
         parser.add_argument(
-            '--batch-size', 
-            type=int, 
-            default=1000,
-            help='Number of books to process in each batch'
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of rows per bulk update'
         )
         parser.add_argument(
-            '--max-features', 
-            type=int, 
-            default=10000,
-            help='Maximum number of features for TF-IDF vectorizer'
+            '--full',
+            action='store_true',
+            help='Recompute the scores even if no keyword changed since the last run'
         )
-    
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS("🚀 Starting TF-IDF computation..."))
-        
-        batch_size = options['batch_size']
-        max_features = options['max_features']
-        
-        # Count total books for progress tracking
-        total_books = Book.objects.count()
-        if total_books == 0:
-            self.stdout.write(self.style.WARNING("⚠️ No books found. Aborting."))
-            return
-            
-        self.stdout.write(self.style.SUCCESS(f"📚 Found {total_books} books to process"))
-        
-        # Process books in batches
-        for offset in tqdm(range(0, total_books, batch_size), desc="Processing batches"):
-            self._process_batch(offset, batch_size, max_features)
-            
-        self.stdout.write(self.style.SUCCESS("✅ TF-IDF computation completed successfully!"))
-    
-    def _process_batch(self, offset, batch_size, max_features):
-        # Get a batch of books
-        books_batch = Book.objects.all()[offset:offset+batch_size]
-        book_ids = [book.gutenberg_id for book in books_batch]
-        
-        # Prepare book texts dictionary
-        book_texts = {book_id: "" for book_id in book_ids}
-        
-        # Fetch English keywords in bulk
-        english_keywords = KeywordBookEnglish.objects.filter(
-            book__gutenberg_id__in=book_ids
-        ).select_related('keyword', 'book')
-        
-        # Fetch French keywords in bulk
-        french_keywords = KeywordBookFrench.objects.filter(
-            book__gutenberg_id__in=book_ids
-        ).select_related('keyword', 'book')
-        
-        # Create document representations
-        for kw_book in english_keywords:
-            book_id = kw_book.book.gutenberg_id
-            book_texts[book_id] += f" {kw_book.keyword.token}" * kw_book.occurence
-            
-        for kw_book in french_keywords:
-            book_id = kw_book.book.gutenberg_id
-            book_texts[book_id] += f" {kw_book.keyword.token}" * kw_book.occurence
-        
-        # Skip empty batch
-        if not any(book_texts.values()):
+        start_time = time.time()
+
+        # (id, book_id, keyword_id, occurence, tfidf_score) of every keyword row, per table
+        entries = []
+        for model in KEYWORD_BOOK_MODELS:
+            rows = list(model.objects.order_by('id').values_list('id', 'book_id', 'keyword_id', 'occurence', 'tfidf_score').iterator(chunk_size=20000))
+            entries.append(np.asarray(rows, dtype=np.float64).reshape(-1, 5))
+        total = sum(len(table) for table in entries)
+        if total == 0:
+            self.stdout.write(self.style.WARNING("⚠️ No keywords found. Aborting."))
             return
-            
-        # TF-IDF computation
-        vectorizer = TfidfVectorizer(
-            min_df=1,           # Inclut les termes qui apparaissent au moins une fois
-            max_features=None,  # N'impose pas de limite sur les features
-            norm='l2',          # Normalisation L2 (par défaut)
-            use_idf=True,       # Utiliser l'IDF (par défaut)
-            smooth_idf=True     # Ajouter 1 à tous les document frequencies (évite la division par zéro)
-        )
-        
-        # Get book IDs and texts in consistent order
-        book_ids_ordered = [bid for bid, text in book_texts.items() if text.strip()]
-        texts_ordered = [book_texts[bid].strip() for bid in book_ids_ordered if book_texts[bid].strip()]
-        
-        # Skip if no valid texts
-        if not texts_ordered:
+
+        # The IDF is computed on the whole corpus : any change of the keywords changes every score
+        stage = Manifest().stage('tfidf', {'idf': 'corpus', 'norm': 'l2', 'smooth_idf': True}, full=options['full'])
+        digest = hashlib.sha256()
+        for table in entries:
+            digest.update(table[:, :4].astype(np.int64).tobytes())
+            digest.update(b'|')
+        digest = digest.hexdigest()
+        if stage.inputs.get('corpus') == digest:
+            self.stdout.write("Keywords unchanged since the last run, scores carried over")
             return
-            
-        tfidf_matrix = vectorizer.fit_transform(texts_ordered)
-        feature_names = vectorizer.get_feature_names_out()
-        
-        # Create a {token: tf-idf score} mapping per book
-        book_tfidf = {}
-        for idx, book_id in enumerate(book_ids_ordered):
-            book_tfidf[book_id] = {
-                feature_names[i]: score 
-                for i, score in enumerate(tfidf_matrix[idx].toarray()[0])
-                if score > 0  # Only store non-zero scores
-            }
-        
-        # Update TF-IDF scores in smaller batches
-        with transaction.atomic():
-            # Update English keywords
-            self._update_keyword_scores(english_keywords, book_tfidf)
-            
-            # Update French keywords
-            self._update_keyword_scores(french_keywords, book_tfidf)
-    
-    def _update_keyword_scores(self, keywords, book_tfidf, batch_size=1000):
-        """Update TF-IDF scores in smaller batches"""
-        updates = []
-        
-        for kw_book in keywords:
-            book_id = kw_book.book.gutenberg_id
-            token = kw_book.keyword.token
-            kw_book.tfidf_score = book_tfidf.get(book_id, {}).get(token, 0.0)
-            updates.append(kw_book)
-            
-            # Process in smaller batches to avoid memory issues
-            if len(updates) >= batch_size:
-                kw_book.__class__.objects.bulk_update(updates, ["tfidf_score"])
-                updates = []
-                
-        # Process remaining updates
-        if updates:
-            kw_book.__class__.objects.bulk_update(updates, ["tfidf_score"])
\ No newline at end of file
+
+        # Sparse book x keyword count matrix
+        book_ids, rows = np.unique(np.concatenate([table[:, 1] for table in entries]).astype(np.int64), return_inverse=True)
+        columns, offset = [], 0
+        for table in entries:
+            keyword_ids, table_columns = np.unique(table[:, 2].astype(np.int64), return_inverse=True)
+            columns.append(table_columns + offset)
+            offset += len(keyword_ids)
+        columns = np.concatenate(columns)
+        counts = np.concatenate([table[:, 3] for table in entries])
+        matrix = sparse.csr_matrix((counts, (rows, columns)), shape=(len(book_ids), offset))
+        self.stdout.write(self.style.SUCCESS(f"📚 {len(book_ids)} books x {offset} keywords, {total} rows"))
+
+        # Same weighting as the previous TfidfVectorizer : raw counts, smooth IDF, L2-normalized rows
+        tfidf_matrix = TfidfTransformer(norm='l2', use_idf=True, smooth_idf=True).fit_transform(matrix)
+        scores = np.asarray(tfidf_matrix[rows, columns]).ravel()
+
+        # Write back only the scores that changed
+        start = 0
+        # The new matrix is exported aside, it replaces the one of the servers once the scores are committed
+        export_directory = f"{os.path.normpath(DOSSIER_TFIDF_MATRIX)}.next"
+        try:
+            with transaction.atomic():
+                for model, table in zip(KEYWORD_BOOK_MODELS, entries):
+                    table_scores = scores[start:start + len(table)]
+                    start += len(table)
+                    changed = np.flatnonzero(~np.isclose(table[:, 4], table_scores, rtol=0, atol=1e-12))
+                    for batch_start in tqdm(range(0, len(changed), options['batch_size']), desc=f"Updating {model.__name__}"):
+                        batch = changed[batch_start:batch_start + options['batch_size']]
+                        model.objects.bulk_update(
+                            [model(id=int(table[i, 0]), tfidf_score=float(table_scores[i])) for i in batch],
+                            ['tfidf_score'],
+                        )
+                matrix = TfidfMatrix.from_database()
+                matrix.save(export_directory)
+                transaction.on_commit(lambda: self.publish_export(matrix, export_directory))
+        except Exception:
+            # Rolled back : the export of the servers still matches the database
+            shutil.rmtree(export_directory, ignore_errors=True)
+            raise
+        stage.inputs = {'corpus': digest}
+        stage.save()
+
+        self.stdout.write(self.style.SUCCESS(f"✅ TF-IDF computation completed successfully in {time.time() - start_time:.2f} seconds!"))
+
+    def publish_export(self, matrix, export_directory):
+        TfidfMatrix.replace_export(export_directory)
+        self.stdout.write(f"Exported the TF-IDF matrix ({matrix.matrix.nnz} scores) to {DOSSIER_TFIDF_MATRIX}")
+        # The servers reload the matrix on the next cosine request
+        bump_dataset_generation('keywords')
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+
+from data.config import MANIFEST_PATH
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """sha256 of the content of a file, read by chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def folder_hashes(folder, extension):
+    """{pk: sha256} of the `<pk><extension>` files of a folder."""
+    if not os.path.isdir(folder):
+        return {}
+    return {
+        int(name[:-len(extension)]): file_hash(os.path.join(folder, name))
+        for name in os.listdir(folder)
+        if name.endswith(extension) and name[:-len(extension)].isdigit()
+    }
+
+
+def data_hash(value):
+    """sha256 of any JSON-serializable value, used for the inputs that aren't files."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Stage:
+    """
+    Part of the manifest owned by one pipeline stage : the parameters of the
+    last run and the hash of every input it processed, keyed by book pk.
+    """
+
+    def __init__(self, manifest, name, params):
+        self.manifest = manifest
+        self.name = name
+        self.params = params
+        entry = manifest.stages.get(name, {})
+        # Inputs of the last run, even if they are invalidated : tells which books disappeared
+        self.recorded = dict(entry.get('inputs', {}))
+        # A change of parameters invalidates every result of the stage
+        self.inputs = dict(self.recorded) if entry.get('params') == params else {}
+
+    def changes(self, hashes):
+        """
+        Compare the current input hashes with the recorded ones.
+        Returns (changed, removed) : pks to (re)process and pks that disappeared
+        since the last run, also in full mode or after a change of parameters.
+        """
+        changed = {pk for pk, digest in hashes.items() if self.inputs.get(str(pk)) != digest}
+        removed = {int(pk) for pk in self.recorded if int(pk) not in hashes}
+        return changed, removed
+
+    def record(self, pk, digest):
+        self.inputs[str(pk)] = digest
+
+    def forget(self, pk):
+        self.inputs.pop(str(pk), None)
+
+    def save(self):
+        self.manifest.stages[self.name] = {'params': self.params, 'inputs': self.inputs}
+        self.manifest.save()
+
+
+class Manifest:
+    """
+    Content-hash manifest of the keyword pipeline (computeKeywords, addKeywords,
+    tfidf, createGraphJaccard) : each stage only processes the books whose
+    inputs changed since its last run and carries over the results of the others.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.stages = json.load(f)
+
+    def stage(self, name, params, full=False):
+        """The manifest of a stage, empty if `full` or if its parameters changed (the removed inputs are still known)."""
+        stage = Stage(self, name, params)
+        if full:
+            stage.inputs = {}
+        return stage
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.stages, f)
+        os.replace(tmp_path, self.path)
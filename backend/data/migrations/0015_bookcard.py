@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 01:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0014_keywordbookenglish_tfidf_score_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookCard',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to='data.book')),
+                ('data', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-18 02:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0016_datasetversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='betweenness',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='closeness',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['closeness', 'gutenberg_id'], name='data_book_closene_53956b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['betweenness', 'gutenberg_id'], name='data_book_between_372ec4_idx'),
+        ),
+    ]
@@ -0,0 +1,110 @@
+from collections import defaultdict
+from itertools import combinations
+
+import numpy as np
+
+from data.config import MINHASH_BANDS, MINHASH_NUM_PERM
+
+TOKEN_CHUNK = 4096   # tokens hashed at once, bounds the memory of a signature
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def splitmix64(x):
+    """Vectorized splitmix64 finalizer, a cheap and well-mixed hash of uint64 arrays."""
+    z = np.asarray(x, dtype=np.uint64) + _GOLDEN
+    z = (z ^ (z >> np.uint64(30))) * _MIX_1
+    z = (z ^ (z >> np.uint64(27))) * _MIX_2
+    return z ^ (z >> np.uint64(31))
+
+
+def _uniforms(keys, salt):
+    """Two deterministic uniforms in (0, 1) for every key, from the halves of one hash."""
+    bits = splitmix64(keys ^ np.uint64(salt))
+    high = (bits >> np.uint64(32)).astype(np.float64)
+    low = (bits & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return (high + 0.5) / float(1 << 32), (low + 0.5) / float(1 << 32)
+
+
+def weighted_minhash(token_ids, weights, num_perm=MINHASH_NUM_PERM, seed=0):
+    """
+    Consistent weighted sampling (Ioffe, 2010) of a token -> occurrence counter.
+
+    Two signatures agree on a permutation with probability equal to the
+    weighted Jaccard similarity sum(min) / sum(max) of the counters.
+    Returns one uint64 hash of the sampled (token, t) per permutation.
+    """
+    token_ids = np.asarray(token_ids, dtype=np.uint64)
+    log_weights = np.log(np.asarray(weights, dtype=np.float64))
+    perms = np.arange(num_perm, dtype=np.uint64)
+    seed = np.uint64(seed)
+
+    best_log_a = np.full(num_perm, np.inf)
+    best_hash = np.zeros(num_perm, dtype=np.uint64)
+    for start in range(0, len(token_ids), TOKEN_CHUNK):
+        tokens = token_ids[start:start + TOKEN_CHUNK, None]
+        keys = splitmix64(tokens * np.uint64(num_perm) + perms[None, :]) ^ seed
+        # r, c ~ Gamma(2, 1) and beta ~ U(0, 1), fixed per (token, permutation)
+        u1, u2 = _uniforms(keys, 1)
+        u3, u4 = _uniforms(keys, 2)
+        beta, _ = _uniforms(keys, 3)
+        r = -np.log(u1 * u2)
+        c = -np.log(u3 * u4)
+        t = np.floor(log_weights[start:start + TOKEN_CHUNK, None] / r + beta)
+        # log(a) with a = c / (y * exp(r)) and y = exp(r * (t - beta))
+        log_a = np.log(c) - r * (t - beta + 1)
+
+        rows = np.argmin(log_a, axis=0)
+        chunk_best = log_a[rows, np.arange(num_perm)]
+        better = chunk_best < best_log_a
+        sampled = splitmix64(tokens[rows, 0] ^ splitmix64(t[rows, np.arange(num_perm)].astype(np.int64).astype(np.uint64)))
+        best_log_a = np.where(better, chunk_best, best_log_a)
+        best_hash = np.where(better, sampled, best_hash)
+    return best_hash
+
+
+class MinHashLSH:
+    """
+    Banding of the MinHash signatures : two books become candidates as soon
+    as all the rows of one of the `bands` bands are equal. With r rows per
+    band, pairs above a similarity of about (1 / bands) ** (1 / r) are likely
+    to collide.
+    """
+
+    def __init__(self, num_perm=MINHASH_NUM_PERM, bands=MINHASH_BANDS, seed=0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.seed = seed
+        self.vocabulary = {}
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+
+    @property
+    def threshold(self):
+        return (1 / self.bands) ** (1 / self.rows)
+
+    def signature(self, occurences):
+        token_ids = [self.vocabulary.setdefault(token, len(self.vocabulary)) for token, occ in occurences.items() if occ > 0]
+        weights = [occ for occ in occurences.values() if occ > 0]
+        if not token_ids:
+            return None
+        return weighted_minhash(token_ids, weights, self.num_perm, self.seed)
+
+    def add(self, key, occurences):
+        signature = self.signature(occurences)
+        if signature is None:
+            return
+        for band, rows in enumerate(signature.reshape(self.bands, self.rows)):
+            self.buckets[band][rows.tobytes()].append(key)
+
+    def candidate_pairs(self):
+        pairs = set()
+        for buckets in self.buckets:
+            for keys in buckets.values():
+                if len(keys) > 1:
+                    pairs.update(combinations(sorted(keys), 2))
+        return pairs
@@ -15,13 +15,32 @@ class Book(models.Model):
     title = models.CharField(blank=True, max_length=1024, null=True)
     cover_image = models.URLField(max_length=1024,blank=True, null=True)
     plain_text = models.URLField(max_length=1024, blank=True, null=True)
+    # Centrality of the book in the whole Neighbors graph (computeCentrality), 0 for a book without neighbors
+    closeness = models.FloatField(default=0.0)
+    betweenness = models.FloatField(default=0.0)
     
     class Meta:
         indexes = [
-            models.Index(fields=['title'])
+            models.Index(fields=['title']),
+            # ORDER BY <centrality>, gutenberg_id of the centrality sorts and of their pages
+            models.Index(fields=['closeness', 'gutenberg_id']),
+            models.Index(fields=['betweenness', 'gutenberg_id']),
         ]
 
 
+class BookCard(models.Model):
+    # Serialized BookSerializer payload of the book, stored as compact JSON (buildBookCards)
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='card')
+    data = models.TextField()
+
+
+class DatasetVersion(models.Model):
+    # Generation of the data served by the API, bumped by the commands that change it : the responses
+    # cached for an older generation are never served again. One row per part of the data (GENERATION_ROWS
+    # of data/response_cache.py), the in-memory indexes are rebuilt only when their part changes
+    generation = models.PositiveBigIntegerField(default=0)
+
+
 class Person(models.Model):
     birth_year = models.SmallIntegerField(blank=True, null=True)
     death_year = models.SmallIntegerField(blank=True, null=True)
@@ -0,0 +1,113 @@
+import base64
+import binascii
+import json
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+
+from data.centrality import CENTRALITY_FIELDS
+from data.config import PAGE_SIZE, MAX_PAGE_SIZE, PAGE_COUNT_LIMIT
+
+CURSOR_PARAM = 'cursor'
+PAGE_SIZE_PARAM = 'page_size'
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """The key of the last book of the previous page, NotFound if the cursor is malformed."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError, binascii.Error):
+        raise NotFound('Invalid cursor')
+    # Counts and ids are ints, centralities floats
+    if not isinstance(key, list) or len(key) != length or \
+            not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in key):
+        raise NotFound('Invalid cursor')
+    return key
+
+
+class KeysetPaginator:
+    """
+    Cursor pagination of a book listing on a stable key : (sort field, gutenberg_id),
+    the sort field being download_count, closeness or betweenness.
+
+    A page is read with `WHERE key after the cursor ORDER BY key LIMIT page_size + 1`,
+    so its cost depends on the page size, not on the position of the page nor on
+    the number of matching books. The cursor is the key of the last book of the
+    page, books added or removed between two pages don't shift the next ones.
+    The count stops at `count_limit` books, past it it's a lower bound.
+    """
+
+    page_size = PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    count_limit = PAGE_COUNT_LIMIT
+
+    def __init__(self, request, field=None, descending=False):
+        self.request = request
+        self.fields = [field, 'gutenberg_id'] if field else ['gutenberg_id']
+        self.descending = descending
+        try:
+            self.page_size = max(1, min(int(request.GET.get(PAGE_SIZE_PARAM, self.page_size)), self.max_page_size))
+        except ValueError:
+            pass
+        cursor = request.GET.get(CURSOR_PARAM)
+        self.after = decode_cursor(cursor, len(self.fields)) if cursor else None
+        self.next_cursor = None
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        The paginator of the sort asked by the request, None without ?page_size= nor ?cursor= :
+        the existing clients still get the whole listing.
+        """
+        if PAGE_SIZE_PARAM not in request.GET and CURSOR_PARAM not in request.GET:
+            return None
+        sort, descending = request.GET.get('sort'), request.GET.get('order', 'descending') == 'descending'
+        if sort == 'download_count':
+            return cls(request, 'download_count', descending)
+        if sort in CENTRALITY_FIELDS:
+            return cls(request, CENTRALITY_FIELDS[sort], descending)
+        return cls(request)
+
+    def _after_cursor(self):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        lookup = 'lt' if self.descending else 'gt'
+        return reduce(or_, (
+            Q(**{field: value for field, value in zip(self.fields[:i], self.after)},
+              **{f'{self.fields[i]}__{lookup}': self.after[i]})
+            for i in range(len(self.fields))
+        ))
+
+    def page_ids(self, queryset):
+        """gutenberg_ids of the books of the page, in order."""
+        queryset = queryset.order_by(*(f"-{field}" if self.descending else field for field in self.fields))
+        if self.after is not None:
+            queryset = queryset.filter(self._after_cursor())
+        # One more book tells if there is a next page
+        keys = list(queryset.values_list(*self.fields)[:self.page_size + 1])
+        if len(keys) > self.page_size:
+            keys = keys[:self.page_size]
+            self.next_cursor = encode_cursor(list(keys[-1]))
+        return [key[-1] for key in keys]
+
+    def count(self, queryset):
+        """(number of matching books, True if exact) : at most `count_limit` rows are counted."""
+        count = queryset.order_by()[:self.count_limit + 1].count()
+        return min(count, self.count_limit), count <= self.count_limit
+
+    def next_link(self):
+        if self.next_cursor is None:
+            return None
+        params = self.request.GET.copy()
+        params[CURSOR_PARAM] = self.next_cursor
+        return self.request.build_absolute_uri(f"{self.request.path}?{params.urlencode()}")
+
+    def links(self, queryset):
+        """count, count_exact and next of the page, read once `page_ids` was called."""
+        count, exact = self.count(queryset)
+        return {'count': count, 'count_exact': exact, 'next': self.next_link()}
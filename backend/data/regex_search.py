@@ -0,0 +1,107 @@
+import re
+from functools import lru_cache
+from itertools import islice
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+from data.config import REGEX_CACHE_SIZE, REGEX_SCAN_LIMIT
+from data.trigram import ngrams, normalize
+
+_REPEATS = {
+    sre_constants.MAX_REPEAT,
+    sre_constants.MIN_REPEAT,
+    getattr(sre_constants, 'POSSESSIVE_REPEAT', sre_constants.MAX_REPEAT),
+}
+# Python < 3.11 has no atomic groups
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_pattern(pattern):
+    """Compiled patterns are cached, popular searches don't recompile them."""
+    return re.compile(pattern)
+
+
+def _literals(parsed):
+    """Collect the literal strings that any match of `parsed` must contain."""
+    literals = []
+    current = []
+
+    def flush():
+        if current:
+            literals.append(''.join(current))
+            current.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+        elif op is sre_constants.AT:
+            # Anchors don't consume characters, the literal run goes on
+            continue
+        elif op is sre_constants.SUBPATTERN:
+            # (group, add_flags, del_flags, sub_pattern)
+            flush()
+            literals.extend(_literals(av[-1]))
+        elif op is _ATOMIC_GROUP:
+            # The sub pattern itself, without a group number
+            flush()
+            literals.extend(_literals(av))
+        elif op in _REPEATS:
+            flush()
+            min_repeat, _, sub_pattern = av
+            if min_repeat >= 1:
+                literals.extend(_literals(sub_pattern))
+        else:
+            # Alternations, classes, wildcards... nothing is guaranteed
+            flush()
+    flush()
+    return literals
+
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def required_literals(pattern):
+    """
+    Return the literal substrings required by `pattern`, or () if it can't be
+    parsed : the search then falls back to the bounded scan.
+    """
+    try:
+        return tuple(_literals(sre_parse.parse(pattern)))
+    except Exception:
+        # sre_parse is internal to `re`, its output isn't a stable API
+        return ()
+
+
+def regex_search(index, pattern, scan_limit=REGEX_SCAN_LIMIT):
+    """
+    Return the ids of the entries of the TrigramIndex `index` whose original
+    text matches `pattern` (re.search semantics, like SQLite's REGEXP).
+
+    The trigrams of the literals required by the pattern narrow the candidates
+    down before the regex runs. Without any usable literal we fall back to a
+    scan of at most `scan_limit` entries.
+    """
+    try:
+        compiled = compile_pattern(pattern)
+    except re.error:
+        return set()
+
+    grams = set()
+    for literal in required_literals(pattern):
+        grams |= ngrams(normalize(literal))
+
+    if grams:
+        candidates = index.candidates_for(grams)
+    else:
+        candidates = index.texts.keys()
+        if len(candidates) > scan_limit:
+            print(f"Regex '{pattern}' has no literal to prefilter on, "
+                  f"scanning only {scan_limit} of {len(candidates)} entries")
+            candidates = islice(candidates, scan_limit)
+
+    texts = index.texts
+    return {entry_id for entry_id in candidates if compiled.search(texts[entry_id])}
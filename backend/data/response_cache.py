@@ -0,0 +1,62 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.db.models import F
+
+from data.models import DatasetVersion
+
+DATASET_VERSION_PK = 1
+# Rows of DatasetVersion : the generation of all the data, used as the version of the
+# cached responses, and the generations of the parts the in-memory indexes are built
+# from, only bumped by the commands that change them
+GENERATION_ROWS = {
+    'data': DATASET_VERSION_PK,
+    'books': 2,      # titles and authors (data/trigram.py)
+    'keywords': 3,   # keyword tables and TF-IDF scores (data/keyword_index.py, data/tfidf_matrix.py)
+}
+
+
+def dataset_generation(scope='data'):
+    """
+    Current generation of the data (or of one part of it, see GENERATION_ROWS),
+    read from the database at each request : every worker sees a bump at once,
+    whatever the cache backend. Used as the `version` of the cache entries.
+    """
+    return DatasetVersion.objects.filter(pk=GENERATION_ROWS[scope]).values_list('generation', flat=True).first() or 0
+
+
+def dataset_generations():
+    """{scope: generation} of every part of the data, in one query."""
+    rows = dict(DatasetVersion.objects.filter(pk__in=GENERATION_ROWS.values()).values_list('pk', 'generation'))
+    return {scope: rows.get(pk, 0) for scope, pk in GENERATION_ROWS.items()}
+
+
+def request_generations(request):
+    """The generations of a request, read once : its indexes and its cache entries see the same data."""
+    generations = getattr(request, '_dataset_generations', None)
+    if generations is None:
+        generations = request._dataset_generations = dataset_generations()
+    return generations
+
+
+def bump_dataset_generation(*scopes):
+    """
+    Start a new generation of the data : the entries cached before are ignored.
+    `scopes` are the parts of the data that changed, their in-memory indexes are
+    built again; the others are kept. Called in the transaction of the change,
+    so a response computed on the old data can't be cached under the new generation.
+    """
+    pks = [DATASET_VERSION_PK, *(GENERATION_ROWS[scope] for scope in scopes)]
+    DatasetVersion.objects.bulk_create([DatasetVersion(pk=pk) for pk in pks], ignore_conflicts=True)
+    DatasetVersion.objects.filter(pk__in=pks).update(generation=F('generation') + 1)
+
+
+def normalized_query(request, params):
+    """Query string of the parameters of `params` only, sorted : their order and the other parameters don't matter."""
+    return urlencode(sorted((name, value) for name in params for value in request.GET.getlist(name)))
+
+
+def response_cache_key(prefix, request, params):
+    # The host is part of the key, the responses hold absolute links (next page)
+    query = f"{request.get_host()}?{normalized_query(request, params)}"
+    return f"{prefix}_{hashlib.sha256(query.encode('utf-8')).hexdigest()}"
@@ -42,6 +42,11 @@ class BookSerializer(serializers.ModelSerializer):
             'download_count'
         )
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """The related rows of every book in 3 queries, whatever the number of books."""
+        return queryset.prefetch_related('authors', 'languages', 'subjects')
+
     def get_id(self, book):
         return book.gutenberg_id
 
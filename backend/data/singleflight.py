@@ -0,0 +1,91 @@
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+from data.config import SINGLEFLIGHT_LOCK_TIMEOUT, SINGLEFLIGHT_WAIT, SINGLEFLIGHT_POLL
+
+
+class _Call:
+    """A computation in flight in this process, shared by the callers of its key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls = {}
+_calls_lock = threading.Lock()
+
+
+def single_flight(key, compute, lookup=None, version=None, lock_timeout=SINGLEFLIGHT_LOCK_TIMEOUT,
+                  wait=SINGLEFLIGHT_WAIT, poll=SINGLEFLIGHT_POLL):
+    """
+    `compute()` run once for the concurrent callers of `key` instead of once per caller.
+
+    In the process, the first caller runs it and the others wait for its result
+    (or its exception). Between workers, this caller takes a lock in the shared
+    cache (`cache.add`, atomic with Redis, best effort with the file cache) : while
+    another worker holds it, `lookup()` is polled until it returns the result that
+    worker cached, for at most `wait` seconds before computing anyway. `compute`
+    is expected to cache its result where `lookup` reads it, under `version`; a
+    result it doesn't cache (incomplete...) is only handed to the workers waiting.
+    """
+    with _calls_lock:
+        call = _calls.get((key, version))
+        leader = call is None
+        if leader:
+            call = _calls[key, version] = _Call()
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _shared_flight(key, compute, lookup, version, lock_timeout, wait, poll)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key, version]
+        call.done.set()
+
+
+def _shared_flight(key, compute, lookup, version, lock_timeout, wait, poll):
+    lock_key = f"singleflight_{key}"
+    result_key = f"singleflight_result_{key}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    waited = False
+    while not cache.add(lock_key, token, timeout=lock_timeout, version=version):
+        waited = True
+        result = lookup() if lookup is not None else None
+        if result is None:
+            result = cache.get(result_key, version=version)
+        if result is not None:
+            return result
+        if time.monotonic() > deadline:
+            print(f"Single flight {key}: still locked by another worker after {wait}s, computed anyway")
+            return compute()
+        time.sleep(poll)
+    try:
+        # Another worker may have finished just before the lock was taken
+        result = lookup() if lookup is not None else None
+        if result is None and waited:
+            result = cache.get(result_key, version=version)
+        if result is not None:
+            return result
+        result = compute()
+        if lookup is not None and lookup() is None:
+            # Not cached by `compute` : kept just long enough for the workers polling for it
+            cache.set(result_key, result, timeout=wait, version=version)
+        return result
+    finally:
+        # Only our own lock, it may have expired and been taken by another worker
+        if cache.get(lock_key, version=version) == token:
+            cache.delete(lock_key, version=version)
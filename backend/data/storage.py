@@ -0,0 +1,178 @@
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+import zlib
+from collections import namedtuple
+
+from data.config import DOSSIER_SHARDS, SHARD_SIZE, SHARD_COMPRESSION_LEVEL
+
+INDEX_NAME = 'index.json'
+SHARD_EXTENSION = '.gz'
+
+# A text ready to be appended : its gzip member, the size and the sha256 of its UTF-8 bytes
+PackedText = namedtuple('PackedText', ['member', 'size', 'sha256'])
+
+
+class TextPacker:
+    """Compress a text given piece by piece into one gzip member, only the compressed bytes are kept."""
+
+    def __init__(self, compression_level=SHARD_COMPRESSION_LEVEL):
+        self._compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._digest = hashlib.sha256()
+        self._size = 0
+        self._parts = []
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self._digest.update(data)
+        self._size += len(data)
+        self._parts.append(self._compressor.compress(data))
+
+    def finish(self):
+        self._parts.append(self._compressor.flush())
+        return PackedText(b''.join(self._parts), self._size, self._digest.hexdigest())
+
+
+class BookStore:
+    """
+    Texts of the books packed in compressed shard files.
+
+    Each text is an independent gzip member appended to the current shard
+    (a new shard is started past `shard_size` bytes), the index maps each
+    book pk to [shard, offset, length, size, sha256] : its member in the
+    shard, the size and the sha256 of its UTF-8 text. A text is read back
+    from a memory-mapped shard without touching the other books.
+
+    Writing a book again appends a new member, the old one is only dropped
+    by `compact` (python manage.py packBooks). The index is written by
+    `save` : a member appended but not saved in the index is ignored.
+    Reads are thread-safe, writes must come from a single thread.
+    """
+
+    def __init__(self, folder=DOSSIER_SHARDS, shard_size=SHARD_SIZE, compression_level=SHARD_COMPRESSION_LEVEL):
+        self.folder = folder
+        self.shard_size = shard_size
+        self.compression_level = compression_level
+        self.index = {}
+        index_path = os.path.join(folder, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                self.index = {int(pk): entry for pk, entry in json.load(f).items()}
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def shard_path(self, shard):
+        return os.path.join(self.folder, f"{shard:05d}{SHARD_EXTENSION}")
+
+    def shards(self):
+        """Numbers of the shard files of the folder, referenced by the index or not."""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(name[:-len(SHARD_EXTENSION)]) for name in os.listdir(self.folder)
+                      if name.endswith(SHARD_EXTENSION) and name[:-len(SHARD_EXTENSION)].isdigit())
+
+    def __contains__(self, pk):
+        """True if the book is in the index and its member is complete in its shard."""
+        entry = self.index.get(pk)
+        if entry is None:
+            return False
+        shard, offset, length = entry[:3]
+        path = self.shard_path(shard)
+        return os.path.exists(path) and os.path.getsize(path) >= offset + length
+
+    def __len__(self):
+        return len(self.index)
+
+    def pks(self):
+        return sorted(self.index)
+
+    def hashes(self):
+        """{pk: sha256 of the UTF-8 text}, the same as the sha256 of a books/<pk>.txt file."""
+        return {pk: entry[4] for pk, entry in self.index.items()}
+
+    def _member(self, pk):
+        """The compressed bytes of the book."""
+        shard, offset, length = self.index[pk][:3]
+        with self._lock:
+            mapped = self._maps.get(shard)
+            # A shard still being written may have grown since it was mapped
+            if mapped is None or len(mapped) < offset + length:
+                if mapped is not None:
+                    mapped.close()
+                with open(self.shard_path(shard), 'rb') as f:
+                    mapped = self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped[offset:offset + length]
+
+    def read(self, pk):
+        """The whole text of the book."""
+        return gzip.decompress(self._member(pk)).decode('utf-8')
+
+    def open(self, pk):
+        """The text of the book as a file object, decompressed as it is read."""
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(self._member(pk)), mode='rb'), encoding='utf-8')
+
+    def write(self, pk, text):
+        """Append the text of the book, returns the sha256 of its UTF-8 text."""
+        packer = TextPacker(self.compression_level)
+        packer.write(text)
+        return self.write_packed(pk, packer.finish())
+
+    def write_packed(self, pk, packed):
+        """Append a text compressed by a TextPacker, returns its sha256."""
+        shards = self.shards()
+        shard = shards[-1] if shards else 0
+        if shards and os.path.getsize(self.shard_path(shard)) >= self.shard_size:
+            shard += 1
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.shard_path(shard), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(packed.member)
+        self.index[pk] = [shard, offset, len(packed.member), packed.size, packed.sha256]
+        return packed.sha256
+
+    def save(self):
+        tmp_path = os.path.join(self.folder, f"{INDEX_NAME}.tmp")
+        os.makedirs(self.folder, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({str(pk): entry for pk, entry in sorted(self.index.items())}, f)
+        os.replace(tmp_path, os.path.join(self.folder, INDEX_NAME))
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = {}
+
+    def compact(self):
+        """
+        Copy the members of the index into new shards, then drop the old shards :
+        the texts written again and the members missing from the index are removed.
+        Returns the number of bytes freed.
+        """
+        old_shards = self.shards()
+        before = sum(os.path.getsize(self.shard_path(shard)) for shard in old_shards)
+        shard = old_shards[-1] + 1 if old_shards else 0
+        index, shard_file, written = {}, None, 0
+        for pk in self.pks():
+            member = self._member(pk)
+            if shard_file is None or written >= self.shard_size:
+                if shard_file is not None:
+                    shard_file.close()
+                    shard += 1
+                shard_file, written = open(self.shard_path(shard), 'wb'), 0
+            shard_file.write(member)
+            index[pk] = [shard, written, len(member)] + self.index[pk][3:]
+            written += len(member)
+        if shard_file is not None:
+            shard_file.close()
+        self.close()
+        # The new index only references the new shards, the old ones can go
+        self.index = index
+        self.save()
+        for old in old_shards:
+            os.remove(self.shard_path(old))
+        return before - sum(os.path.getsize(self.shard_path(shard)) for shard in self.shards())
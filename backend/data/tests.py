@@ -1,3 +1,1482 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+
+from data import downloader
+from data.ann import AnnIndex
+from data.management.commands import computeKeywords, createGraphJaccard
+from data.automaton import VocabularyTrie
+from data.cards import book_cards, cards_json
+from data.centrality import graph_centrality
+from data.ingest import BookWriter
+from data.jaccard import jaccard_distance
+from data.jaccard_matrix import block_distances, jaccard_edges, occurrence_matrix
+from data.manifest import Manifest
+from data.keyword_index import get_keyword_index
+from data.storage import BookStore
+from data.tfidf_matrix import TfidfMatrix, get_tfidf_matrix
+from data.pagination import KeysetPaginator
+from data.response_cache import bump_dataset_generation
+from data.regex_search import regex_search, required_literals
+from data.singleflight import _shared_flight, single_flight
+from data.models import (
+    Book, BookCard, KeywordBookEnglish, KeywordBookFrench, KeywordsEnglish, KeywordsFrench, Language, Neighbors,
+    Person, Subject,
+)
+from data.serializers import BookSerializer
+from data.sort import suggestion
+from data.trigram import TrigramIndex, get_book_text_index
+from data.views import BookViewSet
+
+
+# The tests clear the cache : never the one of the server (./cache or Redis)
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Stand-in for Gutendex and gutenberg.org : serves the `routes` of the server."""
+
+    def do_GET(self):
+        failures = self.server.failures
+        if failures.get(self.path, 0) > 0:
+            failures[self.path] -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path not in self.server.routes:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content_type, body = self.server.routes[self.path]
+        self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServerMixin:
+    """Two catalog pages of two books : 1 and 3 in english/french, 2 in german, 4 without text."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+        self.server.failures = {}
+        self.server.hits = {}
+        self.server.routes = {}
+        self.texts = {1: 'one two three ' * 5, 2: 'eins zwei', 3: '﻿un deux trois', 4: ''}
+        books = [self.book(1, 'en'), self.book(2, 'de'), self.book(3, 'fr'), self.book(4, 'en', text=False)]
+        self.add_route('/books/', 'application/json', {'next': f'{self.base}/books/?page=2', 'results': books[:2]})
+        self.add_route('/books/?page=2', 'application/json', {'next': None, 'results': books[2:]})
+        for pk, text in self.texts.items():
+            self.server.routes[f'/{pk}.txt'] = ('text/plain; charset=utf-8', text.encode('utf-8'))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def add_route(self, path, content_type, data):
+        self.server.routes[path] = (content_type, json.dumps(data).encode('utf-8'))
+
+    def book(self, pk, language, text=True):
+        formats = {'image/jpeg': f'{self.base}/{pk}.jpg'}
+        if text:
+            formats[downloader.TEXT_FORMAT] = f'{self.base}/{pk}.txt'
+        return {
+            'id': pk, 'title': f'Book {pk}', 'download_count': pk, 'languages': [language], 'formats': formats,
+            'authors': [{'name': 'Hugo, Victor', 'birth_year': 1802, 'death_year': 1885}], 'subjects': ['Fiction'],
+        }
+
+
+class CrawlTests(FixtureServerMixin, SimpleTestCase):
+
+    def crawl(self, stop_after=None, **kwargs):
+        downloaded = {}
+
+        async def on_book(book, contenu, nombre_de_mots):
+            text = gzip.decompress(contenu.member).decode('utf-8') if contenu is not None else None
+            downloaded[book['id']] = (text, nombre_de_mots)
+            return stop_after is not None and len(downloaded) >= stop_after
+
+        accept = lambda book: book['languages'][0] in ('en', 'fr') and downloader.TEXT_FORMAT in book['formats']
+        asyncio.run(downloader.crawl(f'{self.base}/books/', accept, on_book, backoff=0.01, **kwargs))
+        return downloaded
+
+    def test_downloads_accepted_books_of_every_page(self):
+        downloaded = self.crawl(concurrency=2)
+        # The byte order mark is dropped
+        self.assertEqual(downloaded, {1: (self.texts[1], 15), 3: ('un deux trois', 3)})
+
+    def test_stops_counting_and_downloading_on_min_words(self):
+        downloaded = self.crawl(concurrency=2, min_words=4)
+        self.assertEqual(downloaded, {1: (self.texts[1], 15), 3: (None, 3)})
+
+    def test_retries_server_errors(self):
+        self.server.failures = {'/books/?page=2': 2, '/1.txt': 1}
+        with mock.patch('builtins.print'):
+            downloaded = self.crawl(concurrency=2, retries=3)
+        self.assertEqual(set(downloaded), {1, 3})
+
+    def test_skips_books_failing_every_attempt(self):
+        del self.server.routes['/3.txt']
+        self.server.failures = {'/1.txt': 5}
+        with mock.patch('builtins.print'):
+            downloaded = self.crawl(concurrency=2, retries=2)
+        self.assertEqual(downloaded, {})
+        # 404 isn't retried
+        self.assertNotIn('/3.txt', self.server.hits)
+
+    def test_stops_once_asked(self):
+        downloaded = self.crawl(stop_after=1, concurrency=1)
+        self.assertEqual(list(downloaded), [1])
+
+
+class BookStreamTests(SimpleTestCase):
+
+    def test_counts_words_cut_between_chunks(self):
+        rng = random.Random(0)
+        pieces = ['mot', 'é', 'l\'été', ' ', '\n', '--', '_x', '42', 'œuvre ', '\r\n']
+        for _ in range(200):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 60)))
+            data = text.encode('utf-8')
+            stream = downloader.BookStream()
+            position = 0
+            while position < len(data):
+                # Cuts also fall inside the multibyte characters
+                size = rng.randint(1, 7)
+                self.assertTrue(stream.feed(data[position:position + size]))
+                position += size
+            packed, count = stream.finish()
+            self.assertEqual(count, len(re.findall(r'\b\w+\b', text)))
+            self.assertEqual(gzip.decompress(packed.member), data)
+            self.assertEqual(packed.sha256, hashlib.sha256(data).hexdigest())
+
+    def test_stops_once_too_short_or_long_enough(self):
+        stream = downloader.BookStream(min_words=5, expected_length=8)
+        # 2 words, 3 more fit in the 5 bytes left
+        self.assertTrue(stream.feed(b'a b'))
+        # 3 words, only 1 more fits in the 2 bytes left
+        self.assertFalse(stream.feed(b' c '))
+
+        stream = downloader.BookStream(min_words=2, expected_length=10 ** 6)
+        stream.feed(b'one two three')
+        stream.feed(b' four')
+        # Not counted anymore once there are enough words
+        self.assertEqual(stream.finish()[1], 3)
+
+
+class InitBooksTests(FixtureServerMixin, TransactionTestCase):
+    """The command runs in a temporary folder : shards/ and catalog/ are written there."""
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+        super().tearDown()
+
+    def init_books(self, **options):
+        with mock.patch('data.management.commands.initBooks.URL_INIT_BIBLIOTHEQUE', f'{self.base}/books/'), \
+                mock.patch('data.management.commands.initBooks.MIN_NB_MOTS_LIVRES', 3), \
+                mock.patch('builtins.print'):
+            call_command('initBooks', stdout=io.StringIO(), **{'concurrency': 2, **options})
+
+    def test_asyncio_engine_fills_database_and_books_folder(self):
+        self.init_books()
+        store = BookStore()
+        self.assertEqual(store.pks(), [1, 3])
+        self.assertEqual(store.read(3), 'un deux trois')
+        self.assertEqual(sorted(Book.objects.values_list('gutenberg_id', flat=True)), [1, 3])
+        self.assertEqual(Book.objects.get(gutenberg_id=3).languages.get().code, 'fr')
+
+    def test_threads_engine(self):
+        self.init_books(engine='threads')
+        self.assertEqual(sorted(Book.objects.values_list('gutenberg_id', flat=True)), [1, 3])
+        self.assertEqual(BookStore().read(3), 'un deux trois')
+
+    def test_resumes_without_downloading_again(self):
+        with mock.patch('data.management.commands.initBooks.MIN_NB_LIVRE_BIBLIOTHEQUE', 1):
+            self.init_books(concurrency=1)
+        self.assertEqual(list(Book.objects.values_list('gutenberg_id', flat=True)), [1])
+        self.init_books()
+        self.init_books(restart=True)
+        self.assertEqual(sorted(Book.objects.values_list('gutenberg_id', flat=True)), [1, 3])
+        self.assertEqual(self.server.hits, {'/books/': 1, '/books/?page=2': 1, '/1.txt': 1, '/3.txt': 1})
+
+    def test_downloads_again_a_truncated_text(self):
+        self.init_books(concurrency=1)
+        store = BookStore()
+        shard = store.shard_path(store.index[3][0])
+        # The end of the last member is lost
+        os.truncate(shard, os.path.getsize(shard) - 1)
+        self.init_books(restart=True)
+        self.assertEqual(self.server.hits, {'/books/': 1, '/books/?page=2': 1, '/1.txt': 1, '/3.txt': 2})
+        self.assertEqual(BookStore().read(3), 'un deux trois')
+
+    def test_offline_rebuild(self):
+        self.init_books()
+        Book.objects.all().delete()
+        self.server.routes = {}
+        self.init_books(offline=True)
+        self.assertEqual(sorted(Book.objects.values_list('gutenberg_id', flat=True)), [1, 3])
+
+    def test_checkpoint_of_a_missing_database_is_ignored(self):
+        self.init_books()
+        Book.objects.all().delete()
+        self.init_books()
+        self.assertEqual(sorted(Book.objects.values_list('gutenberg_id', flat=True)), [1, 3])
+        self.assertEqual(self.server.hits['/1.txt'], 1)
+
+
+class BookWriterTests(TestCase):
+
+    def entry(self, pk, authors, subjects, language='en'):
+        return {
+            'id': pk, 'title': f'Book {pk}', 'download_count': pk, 'languages': [language, 'de'],
+            'formats': {'image/jpeg': f'{pk}.jpg', downloader.TEXT_FORMAT: f'{pk}.txt'},
+            'authors': [{'name': name, 'birth_year': 1800, 'death_year': None} for name in authors],
+            'subjects': subjects,
+        }
+
+    def write(self, entries, batch_size=2):
+        with BookWriter(batch_size) as writer:
+            for entry in entries:
+                writer.add(entry)
+
+    def test_deduplicates_and_is_idempotent(self):
+        entries = [
+            self.entry(1, ['Hugo'], ['Fiction', 'Paris']),
+            self.entry(2, ['Hugo', 'Dumas'], ['Fiction'], 'fr'),
+            self.entry(3, ['Dumas'], ['Paris'], 'fr'),
+        ]
+        self.write(entries)
+        self.write(entries, batch_size=10)
+        self.assertEqual(Book.objects.count(), 3)
+        self.assertEqual(sorted(Person.objects.values_list('name', flat=True)), ['Dumas', 'Hugo'])
+        self.assertEqual(Subject.objects.count(), 2)
+        # Only the first language of each book
+        self.assertEqual(sorted(Language.objects.values_list('code', flat=True)), ['en', 'fr'])
+        book = Book.objects.get(gutenberg_id=2)
+        self.assertEqual(sorted(book.authors.values_list('name', flat=True)), ['Dumas', 'Hugo'])
+        self.assertEqual(list(book.languages.values_list('code', flat=True)), ['fr'])
+        self.assertEqual(Book.authors.through.objects.count(), 4)
+
+    def test_updates_known_books_and_reuses_existing_rows(self):
+        hugo = Person.objects.create(name='Hugo', birth_year=1800, death_year=None)
+        Book.objects.create(gutenberg_id=1, title='Old title')
+        entry = self.entry(1, ['Hugo'], ['Fiction'])
+        self.write([entry])
+        self.assertEqual(Book.objects.get(gutenberg_id=1).title, 'Book 1')
+        self.assertEqual(list(Book.objects.get(gutenberg_id=1).authors.all()), [hugo])
+
+    def test_incomplete_entry_raises_key_error(self):
+        entry = self.entry(1, ['Hugo'], [])
+        del entry['formats']['image/jpeg']
+        with self.assertRaises(KeyError):
+            BookWriter().add(entry)
+
+
+class BookStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def test_round_trip_across_shards(self):
+        texts = {pk: f'Livre {pk}\r\n\r\nété ' + 'mot ' * pk * 100 for pk in range(1, 30)}
+        store = BookStore(self.folder.name, shard_size=100)
+        for pk, text in texts.items():
+            store.write(pk, text)
+        store.save()
+        store = BookStore(self.folder.name)
+        self.assertGreater(len(store.shards()), 1)
+        self.assertEqual(store.pks(), list(texts))
+        for pk, text in texts.items():
+            self.assertEqual(store.read(pk), text)
+            with store.open(pk) as f:
+                self.assertEqual(f.read(), text.replace('\r\n', '\n'))
+        self.assertEqual(store.hashes()[1], hashlib.sha256(texts[1].encode('utf-8')).hexdigest())
+        store.close()
+
+    def test_unsaved_members_are_ignored_and_compacted(self):
+        store = BookStore(self.folder.name)
+        store.write(1, 'first')
+        store.save()
+        store.write(1, 'second')
+        store.write(2, 'lost')
+        self.assertEqual(BookStore(self.folder.name).pks(), [1])
+        store.save()
+        store.write(3, 'not saved')
+        store = BookStore(self.folder.name)
+        size = os.path.getsize(store.shard_path(0))
+        self.assertGreater(store.compact(), 0)
+        self.assertLess(sum(os.path.getsize(store.shard_path(shard)) for shard in store.shards()), size)
+        store = BookStore(self.folder.name)
+        self.assertEqual({pk: store.read(pk) for pk in store.pks()}, {1: 'second', 2: 'lost'})
+        store.close()
+
+
+STOP_WORDS = {'the', 'of', 'and', 'a'}
+
+
+class StubNlp:
+    """Stands for a spaCy model : one token per word, the word is its lemma."""
+
+    max_length = 1000
+    meta = {'version': 'stub'}
+
+    def __call__(self, text):
+        return [SimpleNamespace(lemma_=word, is_alpha=word.isalpha(), is_stop=word.casefold() in STOP_WORDS)
+                for word in text.split()]
+
+    def pipe(self, texts, as_tuples=False, batch_size=None, n_process=1):
+        for text, context in texts:
+            yield self(text), context
+
+
+def book_text(pk, paragraphs=40):
+    rng = random.Random(pk)
+    words = ['The', 'sea', 'whale', 'of', 'Ship', 'and', 'a', 'storm', 'mer', 'Été', '42']
+    return "\n\n".join(" ".join(rng.choice(words) for _ in range(rng.randint(0, 30))) for _ in range(paragraphs))
+
+
+def per_book_counter(nlp, text, batch_size):
+    """The counter of computeKeywords before the streaming : the whole text split in paragraphs, joined by batches."""
+    texts = text.split("\n\n")
+    counter = Counter()
+    for i in range(0, len(texts), batch_size):
+        counter.update(computeKeywords.doc_keywords(nlp(" ".join(texts[i:i + batch_size]))))
+    return counter
+
+
+class ComputeKeywordsTests(TestCase):
+    """The command runs in a temporary folder : the shards, the keyword files and the manifest are there."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        self.nlp = {'en': StubNlp(), 'fr': StubNlp()}
+        for patcher in (mock.patch('sys.stderr', io.StringIO()),
+                        mock.patch.object(computeKeywords, 'load_models', return_value=self.nlp)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        languages = {code: Language.objects.create(code=code) for code in ('en', 'fr', 'de')}
+        store = BookStore()
+        self.texts = {}
+        for pk, code in ((1, 'en'), (2, 'fr'), (3, 'en'), (4, 'de'), (5, 'en')):
+            Book.objects.create(gutenberg_id=pk, title=f'Book {pk}').languages.add(languages[code])
+            self.texts[pk] = book_text(pk)
+            store.write(pk, self.texts[pk])
+        store.save()
+        store.close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def run_command(self, **options):
+        stdout = io.StringIO()
+        call_command('computeKeywords', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def keywords(self):
+        counters = {}
+        for name in os.listdir('keywords'):
+            with open(os.path.join('keywords', name)) as f:
+                counters[int(name[:-len('.json')])] = json.load(f)
+        return counters
+
+    def test_same_counters_as_per_book(self):
+        expected = {pk: dict(per_book_counter(self.nlp['en'], self.texts[pk], 3)) for pk in (1, 2, 3, 5)}
+        for mode in ('threads', 'processes'):
+            with self.subTest(mode=mode):
+                self.run_command(mode=mode, batch_size=3, n_process=1, full=True)
+                self.assertEqual(self.keywords(), expected)
+
+    def test_other_languages_are_not_inputs(self):
+        self.run_command(batch_size=3)
+        self.assertEqual(sorted(self.keywords()), [1, 2, 3, 5])
+        self.assertEqual(sorted(Manifest().stages['computeKeywords']['inputs']), ['1', '2', '3', '5'])
+        self.assertIn('0 new or changed books, 4 unchanged books carried over', self.run_command(batch_size=3))
+        # A book now in german : its keywords are removed
+        Book.objects.get(pk=5).languages.set(Language.objects.filter(code='de'))
+        self.run_command(batch_size=3)
+        self.assertEqual(sorted(self.keywords()), [1, 2, 3])
+
+    def test_paragraphs_cut_between_reads(self):
+        text = "one two\n\n\n\nthree\n\nfour five six seven eight nine ten\n\n" + "x" * 25 + "\n\nend\n"
+        expected = text.split("\n\n")
+        for chunk_chars in (1, 2, 3, 7, 1000):
+            with self.subTest(chunk_chars=chunk_chars):
+                paragraphs = list(computeKeywords.read_paragraphs(io.StringIO(text), 1000, chunk_chars=chunk_chars))
+                self.assertEqual(paragraphs, expected)
+                # Long paragraphs cut on whitespace, a word longer than max_chars where it must
+                paragraphs = list(computeKeywords.read_paragraphs(io.StringIO(text), 10, chunk_chars=chunk_chars))
+                self.assertTrue(all(len(paragraph) <= 10 for paragraph in paragraphs))
+                self.assertEqual("".join(paragraphs), "".join(expected))
+                self.assertEqual(" ".join(paragraphs).split(), " ".join(expected[:4]).split() + ["x" * 10, "x" * 10, "x" * 5, "end"])
+
+    def test_batches_stay_under_max_chars(self):
+        store = BookStore()
+        for batch_size, max_chars in ((3, 1000), (1000, 60), (5, 25)):
+            with self.subTest(batch_size=batch_size, max_chars=max_chars):
+                batches = list(computeKeywords.book_batches(store, 1, batch_size, max_chars))
+                self.assertTrue(all(len(batch) <= max_chars for batch in batches))
+                self.assertEqual(" ".join(batches).split(), self.texts[1].split())
+                if max_chars == 1000:
+                    paragraphs = self.texts[1].split("\n\n")
+                    self.assertEqual(batches, [" ".join(paragraphs[i:i + 3]) for i in range(0, len(paragraphs), 3)])
+        store.close()
+        # Short texts for spaCy, same counters
+        self.run_command(mode='processes', batch_size=4, max_chars=30, n_process=1)
+        self.assertEqual(self.keywords()[1], dict(per_book_counter(self.nlp['en'], self.texts[1], 4)))
+
+    def test_failed_book_is_not_recorded(self):
+        book_batches = computeKeywords.book_batches
+
+        def failing_batches(store, pk, batch_size, max_chars):
+            batches = book_batches(store, pk, batch_size, max_chars)
+            if pk == 3:
+                yield next(batches)
+                raise OSError('truncated shard')
+            yield from batches
+
+        with mock.patch.object(computeKeywords, 'book_batches', failing_batches):
+            output = self.run_command(mode='processes', batch_size=3, n_process=1)
+        self.assertIn('Error processing book 3: truncated shard', output)
+        self.assertEqual(sorted(self.keywords()), [1, 2, 5])
+        self.assertNotIn('3', Manifest().stages['computeKeywords']['inputs'])
+        # The next run computes the book again, and only it
+        self.assertIn('1 books processed', self.run_command(mode='processes', batch_size=3, n_process=1))
+        self.assertEqual(self.keywords()[3], dict(per_book_counter(self.nlp['en'], self.texts[3], 3)))
+
+
+class AddKeywordsTests(TestCase):
+    """The command runs in a temporary folder : the keyword files and the manifest are there."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.mkdir('keywords')
+        patcher = mock.patch('sys.stderr', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        languages = {code: Language.objects.create(code=code) for code in ('en', 'fr', 'de')}
+        for pk, code in ((1, 'en'), (2, 'en'), (3, 'fr'), (4, 'de')):
+            Book.objects.create(gutenberg_id=pk, title=f'Book {pk}').languages.add(languages[code])
+        # The english tokens are kept from 25 occurences, the french ones from 10
+        self.write_keywords({
+            1: {'sea': 30, 'whale': 25, 'ship': 24},
+            2: {'sea': 100, 'storm': 40},
+            3: {'mer': 10, 'guerre': 9, 'sea': 50},
+            4: {'meer': 99},
+            5: {'sea': 99},
+        })
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def write_keywords(self, books):
+        for pk, tokens in books.items():
+            with open(os.path.join('keywords', f'{pk}.json'), 'w') as f:
+                json.dump(tokens, f)
+
+    def run_command(self, **options):
+        stdout = io.StringIO()
+        call_command('addKeywords', stdout=stdout, checkpoint=2, batch_size=2, **options)
+        return stdout.getvalue()
+
+    def rows(self):
+        return (set(KeywordBookEnglish.objects.values_list('book_id', 'keyword__token', 'occurence')),
+                set(KeywordBookFrench.objects.values_list('book_id', 'keyword__token', 'occurence')))
+
+    def test_loads_the_keyword_files(self):
+        output = self.run_command()
+        self.assertIn('2 books are missing from the database or have no en/fr language, skipped', output)
+        self.assertIn('6 keyword rows inserted', output)
+        expected = ({(1, 'sea', 30), (1, 'whale', 25), (2, 'sea', 100), (2, 'storm', 40)}, {(3, 'mer', 10), (3, 'sea', 50)})
+        self.assertEqual(self.rows(), expected)
+        self.assertEqual(sorted(KeywordsEnglish.objects.values_list('token', flat=True)), ['sea', 'storm', 'whale'])
+        self.assertEqual(sorted(KeywordsFrench.objects.values_list('token', flat=True)), ['mer', 'sea'])
+        self.assertEqual(KeywordsEnglish.objects.get(token='sea').books.count(), 2)
+        # Nothing changed : only the skipped files are looked at again, a full run loads everything again without duplicates
+        output = self.run_command()
+        self.assertIn('Processing 2 keyword files (3 unchanged files carried over)', output)
+        self.assertIn('0 keyword rows inserted', output)
+        self.assertEqual(self.rows(), expected)
+        self.run_command(full=True)
+        self.assertEqual(self.rows(), expected)
+        self.assertEqual((KeywordBookEnglish.objects.count(), KeywordBookFrench.objects.count()), (4, 2))
+        self.assertEqual((KeywordsEnglish.objects.count(), KeywordsFrench.objects.count()), (3, 2))
+
+    def test_changed_and_removed_files(self):
+        self.run_command()
+        self.write_keywords({1: {'sea': 26, 'ship': 25}})
+        os.remove(os.path.join('keywords', '3.json'))
+        self.assertIn('Processing 3 keyword files (1 unchanged files carried over)', self.run_command())
+        self.assertEqual(self.rows(), ({(1, 'sea', 26), (1, 'ship', 25), (2, 'sea', 100), (2, 'storm', 40)}, set()))
+        # A skipped book added to the database afterwards is loaded by the next run
+        Book.objects.create(gutenberg_id=5, title='Book 5').languages.add(Language.objects.get(code='en'))
+        self.run_command()
+        self.assertEqual(list(KeywordBookEnglish.objects.filter(book_id=5).values_list('keyword__token', 'occurence')), [('sea', 99)])
+        # The tokens stay, without books
+        self.assertEqual(KeywordsEnglish.objects.count(), 4)
+        self.assertEqual(KeywordsEnglish.objects.get(token='whale').books.count(), 0)
+
+
+class KeywordIndexTests(TestCase):
+    """The index answers like the ORM filters it replaces. Each test starts from a new shared index."""
+
+    TOKENS = {
+        'en': ['paris', 'parisian', 'war', 'peace', 'sea', 'seaman', 'whale'],
+        'fr': ['paris', 'guerre', 'paix', 'mer', 'baleine', 'été'],
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        books = [Book.objects.create(gutenberg_id=pk, title=f'Book {pk}') for pk in range(1, 21)]
+        for language, keyword_model, keyword_book_model in (('en', KeywordsEnglish, KeywordBookEnglish),
+                                                            ('fr', KeywordsFrench, KeywordBookFrench)):
+            for token in cls.TOKENS[language]:
+                keyword = keyword_model.objects.create(token=token)
+                keyword_book_model.objects.bulk_create(
+                    keyword_book_model(keyword=keyword, book=book, occurence=1, tfidf_score=rng.random())
+                    for book in rng.sample(books, 5)
+                )
+
+    def setUp(self):
+        patcher = mock.patch('data.keyword_index._index', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        printer = mock.patch('builtins.print')
+        printer.start()
+        self.addCleanup(printer.stop)
+
+    def orm_search(self, keyword, method, languages):
+        # The filters of BookViewSet before the index
+        condition = Q()
+        for language in languages:
+            table = 'keywordbookenglish' if language == 'en' else 'keywordbookfrench'
+            condition |= Q(**{f'{table}__keyword__token__{method}': keyword})
+        return set(Book.objects.filter(condition).values_list('gutenberg_id', flat=True))
+
+    def test_same_books_as_the_orm(self):
+        index = get_keyword_index()
+        patterns = {
+            # Substrings, ignoring case, shorter than a trigram or not
+            'icontains': ['par', 'PARIS', 'a', 'ea', 'été', 'x', ''],
+            # Anchored (trie), exact, unanchored and unsupported patterns
+            'regex': ['^par', '^sea', '^war$', 'paris$', '^(war|peace)$', 'a.e', '^s[a-e]+', '(?>pa)r', r'(a)\1', 'PARIS', '^[p'],
+        }
+        for method, keywords in patterns.items():
+            for keyword in keywords:
+                for languages in (('en',), ('fr',), ('en', 'fr')):
+                    with self.subTest(method=method, keyword=keyword, languages=languages):
+                        if keyword == '^[p':
+                            # An invalid pattern matches nothing instead of raising
+                            self.assertEqual(index.search(keyword, method, languages), set())
+                            continue
+                        self.assertEqual(index.search(keyword, method, languages), self.orm_search(keyword, method, languages))
+
+    def test_match_tokens(self):
+        index = get_keyword_index()
+        for method, keyword in (('icontains', 'SEA'), ('regex', '^sea'), ('regex', 'a.e'), ('regex', '^paris$')):
+            with self.subTest(method=method, keyword=keyword):
+                expected = KeywordsEnglish.objects.filter(**{f'token__{method}': keyword}).order_by('token')
+                self.assertEqual(index.match_tokens('en', keyword, method), list(expected.values_list('token', flat=True)))
+        posting = index.posting('fr', 'paix')
+        rows = KeywordBookFrench.objects.filter(keyword__token='paix')
+        self.assertEqual(dict(zip(posting.book_ids, posting.scores)), dict(rows.values_list('book_id', 'tfidf_score')))
+
+    def test_rebuilt_for_a_new_generation(self):
+        index = get_keyword_index()
+        self.assertIs(get_keyword_index(), index)
+        keyword = KeywordsEnglish.objects.create(token='moby')
+        KeywordBookEnglish.objects.create(keyword=keyword, book_id=3, occurence=1, tfidf_score=1)
+        self.assertEqual(get_keyword_index().search('moby'), set())
+        # A change of the graph or of the cards keeps the index
+        bump_dataset_generation()
+        self.assertIs(get_keyword_index(), index)
+        bump_dataset_generation('keywords')
+        self.assertEqual(get_keyword_index().search('moby'), {3})
+
+
+class BookTextIndexTests(TestCase):
+    """The trigram candidates, once verified, are the books icontains finds. Each test starts from a new shared index."""
+
+    TITLES = ['The War of the Worlds', 'War and Peace', 'Peace', 'Moby Dick', 'Les Misérables', 'A', 'Warwick', 'Dick Tracy']
+
+    @classmethod
+    def setUpTestData(cls):
+        people = [Person.objects.create(name=name) for name in ('Wells, H. G.', 'Tolstoy, Leo', 'Melville, Herman', 'Hugo, Victor')]
+        for pk, title in enumerate(cls.TITLES, start=1):
+            Book.objects.create(gutenberg_id=pk, title=title).authors.add(people[pk % len(people)])
+        Book.objects.create(gutenberg_id=99, title=None)
+
+    def setUp(self):
+        patcher = mock.patch('data.trigram._index', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        printer = mock.patch('builtins.print')
+        printer.start()
+        self.addCleanup(printer.stop)
+
+    def test_same_books_as_icontains(self):
+        index = get_book_text_index()
+        # Longer and shorter than a trigram, other case, across words, absent, empty
+        for query in ('war', 'WAR', 'peace', 'r a', 'of the', 'misérables', 'ck', 'a', '', 'zzz', 'Dick Tracy!'):
+            with self.subTest(query=query):
+                titles = Book.objects.filter(title__icontains=query).values_list('gutenberg_id', flat=True)
+                self.assertEqual(index.search_titles(query), set(titles))
+                authors = Book.objects.filter(authors__name__icontains=query).values_list('gutenberg_id', flat=True)
+                self.assertEqual(index.search_authors(query), set(authors))
+
+    def test_candidates_are_verified(self):
+        index = TrigramIndex()
+        index.add(1, 'abc bcd')
+        index.add(2, 'abcd')
+        # Both texts have every trigram of 'abcd', only one contains it
+        self.assertEqual(set(index.candidates_for({'abc', 'bcd'})), {1, 2})
+        self.assertEqual(index.search('ABCD'), {2})
+        # No trigram in the query : every entry is a candidate
+        self.assertEqual(set(index.candidates_for(set())), {1, 2})
+        self.assertEqual(index.search('d'), {1, 2})
+        self.assertEqual(index.search(' '), {1})
+
+    def test_rebuilt_for_a_new_generation(self):
+        index = get_book_text_index()
+        self.assertIs(get_book_text_index(), index)
+        with BookWriter() as writer:
+            writer.add({
+                'id': 50, 'title': 'Twenty Thousand Leagues', 'download_count': 1, 'authors': [{'name': 'Verne, Jules', 'birth_year': 1828, 'death_year': 1905}],
+                'languages': ['fr'], 'subjects': [], 'formats': {'image/jpeg': 'c', 'text/plain; charset=us-ascii': 't'},
+            })
+        index = get_book_text_index()
+        self.assertEqual(index.search_titles('leagues'), {50})
+        self.assertEqual(index.search_authors('verne'), {50})
+        # New keywords keep the index
+        bump_dataset_generation('keywords')
+        self.assertIs(get_book_text_index(), index)
+
+
+class TfidfMatrixTests(TestCase):
+    """The commands run in a temporary folder : the manifest and the exported matrix are written there."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        for patcher in (mock.patch('data.tfidf_matrix._matrix', None), mock.patch('builtins.print'),
+                        mock.patch('data.management.commands.tfidf.tqdm', lambda iterable, **kwargs: iterable)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        rng = random.Random(0)
+        books = [Book.objects.create(gutenberg_id=pk, title=f'Book {pk}') for pk in range(1, 16)]
+        for keyword_model, keyword_book_model, tokens in ((KeywordsEnglish, KeywordBookEnglish, ['sea', 'ship', 'whale', 'war']),
+                                                          (KeywordsFrench, KeywordBookFrench, ['mer', 'guerre'])):
+            for token in tokens:
+                keyword = keyword_model.objects.create(token=token)
+                keyword_book_model.objects.bulk_create(
+                    keyword_book_model(keyword=keyword, book=book, occurence=rng.randint(1, 9), tfidf_score=rng.random())
+                    for book in rng.sample(books, 8)
+                )
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def orm_similarities(self, book_ids, keywords):
+        """
+        The scores of the cosine view before the matrix : each book containing the keywords is a source, every book
+        sharing a keyword with a source gets its best cosine to the sources, the vectors read row by row from the ORM.
+        """
+        models = {'english': KeywordBookEnglish, 'french': KeywordBookFrench}
+        vectors = {}
+        for book_id in book_ids:
+            vector = []
+            for language, token in keywords:
+                row = models[language].objects.filter(book_id=book_id, keyword__token=token).first()
+                vector.append(row.tfidf_score if row else 0.0)
+            if np.linalg.norm(vector) > 0:
+                vectors[book_id] = np.array(vector)
+        similarities = {}
+        for source in vectors.values():
+            for book_id, target in vectors.items():
+                if np.dot(source > 0, target > 0):
+                    similarity = np.dot(source, target) / (np.linalg.norm(source) * np.linalg.norm(target))
+                    similarities[book_id] = max(similarities.get(book_id, 0.0), float(similarity))
+        return similarities
+
+    def test_same_similarities_as_the_orm(self):
+        matrix = TfidfMatrix.from_database()
+        matrix.save('export')
+        book_ids = set(range(1, 16)) - {4}
+        for keywords in ([('english', 'sea')], [('english', 'sea'), ('english', 'whale')],
+                         [('english', 'war'), ('french', 'guerre'), ('french', 'mer')]):
+            expected = self.orm_similarities(sorted(book_ids), keywords)
+            for loaded in (matrix, TfidfMatrix.load('export')):
+                columns = [column for language, token in keywords for column in loaded.columns_for(language, [token])]
+                similarities = loaded.keyword_similarities(book_ids, columns)
+                with self.subTest(keywords=keywords):
+                    self.assertEqual(similarities.keys(), expected.keys())
+                    for book_id, similarity in expected.items():
+                        self.assertAlmostEqual(similarities[book_id], similarity, places=5)
+
+    def test_weak_matches_are_returned(self):
+        # "sea" also matches "overseas", a book where it scores little is returned all the same, whatever min_score
+        Book.objects.update(download_count=1)
+        keyword = KeywordsEnglish.objects.create(token='overseas')
+        KeywordBookEnglish.objects.create(keyword=keyword, book_id=4, occurence=1, tfidf_score=0.001)
+        expected = sorted([*KeywordBookEnglish.objects.filter(keyword__token='sea').values_list('book_id', flat=True), 4])
+        with mock.patch('data.keyword_index._index', None):
+            for min_score in ('0', '0.3', '1'):
+                response = self.client.get('/data/books/keywords/cosine-similarity/',
+                                           {'keyword': 'sea', 'top': 0, 'min_score': min_score})
+                self.assertEqual([book['id'] for book in response.json()], expected)
+            response = self.client.get('/data/books/keywords/cosine-similarity/', {'keyword': 'sea', 'min_score': 1.1})
+            self.assertEqual(response.json(), [])
+            response = self.client.get('/data/books/keywords/cosine-similarity/', {'keyword': 'nothing'})
+            self.assertEqual((response['Content-Type'], response.json()), ('application/json', []))
+
+    def test_tfidf_rewrites_the_export(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('tfidf', stdout=io.StringIO())
+        matrix = get_tfidf_matrix()
+        self.assertIsNotNone(TfidfMatrix.load())
+        self.assertEqual(matrix.columns_for('english', ['moby']), [])
+        keyword = KeywordsEnglish.objects.create(token='moby')
+        KeywordBookEnglish.objects.create(keyword=keyword, book_id=3, occurence=4)
+        self.assertIs(get_tfidf_matrix(), matrix)
+        # New scores : exported once committed, then the bump of the generation reloads the export
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('tfidf', stdout=io.StringIO())
+            self.assertEqual(TfidfMatrix.load().columns_for('english', ['moby']), [])
+            self.assertIs(get_tfidf_matrix(), matrix)
+        matrix = get_tfidf_matrix()
+        self.assertEqual(matrix.book_ids.filename, os.path.realpath(os.path.join('tfidf_matrix', 'book_ids.npy')))
+        columns = matrix.columns_for('english', ['moby'])
+        self.assertEqual(list(matrix.keyword_similarities([3, 4], columns)), [3])
+        self.assertFalse(os.path.exists('tfidf_matrix.next'))
+
+    def test_rolled_back_tfidf_keeps_the_export(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('tfidf', stdout=io.StringIO())
+        scores = list(KeywordBookEnglish.objects.order_by('id').values_list('tfidf_score', flat=True))
+        exported = TfidfMatrix.load().matrix.toarray()
+        KeywordBookEnglish.objects.filter(book_id=3).update(occurence=50)
+        save = TfidfMatrix.save
+
+        def failing_save(matrix, directory):
+            save(matrix, directory)
+            raise OSError('disk full')
+
+        with mock.patch.object(TfidfMatrix, 'save', failing_save), self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(OSError):
+                call_command('tfidf', stdout=io.StringIO())
+        self.assertEqual(callbacks, [])
+        self.assertEqual(list(KeywordBookEnglish.objects.order_by('id').values_list('tfidf_score', flat=True)), scores)
+        np.testing.assert_array_equal(TfidfMatrix.load().matrix.toarray(), exported)
+        self.assertFalse(os.path.exists('tfidf_matrix.next'))
+
+    def test_scores_of_a_tfidf_vectorizer(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('tfidf', stdout=io.StringIO())
+        # Each book is the list of its keywords, repeated `occurence` times, the languages in their own columns
+        documents = {}
+        for language, model in (('english', KeywordBookEnglish), ('french', KeywordBookFrench)):
+            for book_id, token, occurence in model.objects.values_list('book_id', 'keyword__token', 'occurence'):
+                documents.setdefault(book_id, []).extend([f'{language}_{token}'] * occurence)
+        book_ids = sorted(documents)
+        vectorizer = TfidfVectorizer(analyzer=lambda document: document)
+        expected = vectorizer.fit_transform([documents[book_id] for book_id in book_ids])
+        for language, model in (('english', KeywordBookEnglish), ('french', KeywordBookFrench)):
+            for book_id, token, score in model.objects.values_list('book_id', 'keyword__token', 'tfidf_score'):
+                column = vectorizer.vocabulary_[f'{language}_{token}']
+                self.assertAlmostEqual(score, expected[book_ids.index(book_id), column], places=10)
+
+@override_settings(CACHES=TEST_CACHES)
+class ListingQueryCountTests(TestCase):
+    """The listings cost a fixed number of queries, whatever the number of books returned : the ids, then their cards."""
+
+    @classmethod
+    def setUpTestData(cls):
+        english = Language.objects.create(code='en')
+        subjects = [Subject.objects.create(name=f'Subject {i}') for i in range(3)]
+        cls.books = []
+        for pk in range(1, 31):
+            book = Book.objects.create(gutenberg_id=pk, title=f'Book {pk}', download_count=pk)
+            book.authors.add(Person.objects.create(name=f'Author {pk}'), Person.objects.create(name=f'Other {pk}'))
+            book.languages.add(english)
+            book.subjects.add(*subjects[:pk % 3 + 1])
+            cls.books.append(book)
+        for book in cls.books[:2]:
+            Neighbors.objects.create(book=book).neighbors.add(*[b for b in cls.books if b != book])
+        call_command('buildBookCards', stdout=io.StringIO())
+
+    def setUp(self):
+        cache.clear()
+
+    def test_book_view_set(self):
+        request = RequestFactory().get('/', {'languages': 'en'})
+        with self.assertNumQueries(2):
+            response = BookViewSet().get(request)
+        books = json.loads(response.content)
+        self.assertEqual(len(books), 30)
+        self.assertEqual(len(books[0]['authors']), 2)
+
+    def test_books_list(self):
+        # The generation of the data, the ids and the cards (the suggestions run in another thread, on their own connection)
+        with mock.patch('data.views.suggestion', return_value=[]), self.assertNumQueries(3):
+            response = self.client.get('/server/books/', {'sort': 'download_count'})
+        self.assertEqual([book['id'] for book in response.json()['result']], list(range(30, 0, -1)))
+
+    def test_books_list_pages(self):
+        # The generation, the page, its cards and the count, whatever the number of books matching
+        url, ids = '/server/books/?sort=download_count&order=ascending&page_size=7', []
+        with mock.patch('data.views.suggestion', return_value=[]):
+            while url:
+                with self.assertNumQueries(4):
+                    page = self.client.get(url).json()
+                self.assertEqual((page['count'], page['count_exact']), (30, True))
+                self.assertLessEqual(len(page['result']), 7)
+                ids += [book['id'] for book in page['result']]
+                url = page['next']
+        self.assertEqual(ids, list(range(1, 31)))
+
+    def test_book_view_set_pages(self):
+        # The page size is capped, the count stops at its limit
+        with mock.patch.object(KeysetPaginator, 'max_page_size', 10), mock.patch.object(KeysetPaginator, 'count_limit', 20):
+            page = json.loads(BookViewSet().get(RequestFactory().get('/', {'page_size': 1000})).content)
+            self.assertEqual([book['id'] for book in page['results']], list(range(1, 11)))
+            self.assertEqual((page['count'], page['count_exact']), (20, False))
+            page = json.loads(BookViewSet().get(RequestFactory().get(page['next'])).content)
+            self.assertEqual([book['id'] for book in page['results']], list(range(11, 21)))
+        # A cursor is the base64 JSON key of the last book : [1] is valid without a sort, [1, 2] isn't
+        with mock.patch('data.views.suggestion', return_value=[]):
+            self.assertEqual(self.client.get('/server/books/', {'cursor': 'WzFd'}).status_code, 200)
+            self.assertEqual(self.client.get('/server/books/', {'cursor': 'WzEsMl0='}).status_code, 404)
+
+    def test_books_list_centrality(self):
+        Book.objects.filter(gutenberg_id__lte=10).update(closeness=0.5, betweenness=0.1)
+        Book.objects.filter(gutenberg_id=20).update(closeness=0.9)
+        # An ORDER BY on the precomputed scores : no graph built, whatever the number of books
+        with mock.patch('data.views.suggestion', return_value=[]), self.assertNumQueries(3):
+            response = self.client.get('/server/books/', {'sort': 'closeness'})
+        self.assertEqual([book['id'] for book in response.json()['result']][:12], [20, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 30])
+        with mock.patch('data.views.suggestion', return_value=[]):
+            page = self.client.get('/server/books/', {'sort': 'betweenness', 'order': 'ascending', 'page_size': 25}).json()
+            self.assertEqual([book['id'] for book in page['result']][:3], [11, 12, 13])
+            page = self.client.get(page['next']).json()
+        self.assertEqual([book['id'] for book in page['result']], [6, 7, 8, 9, 10])
+
+    def test_neighbors(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/data/books/neighbors/1')
+        self.assertEqual(len(response.json()), 29)
+
+    def test_cosine_similarity_without_keyword(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/data/books/keywords/cosine-similarity/')
+        self.assertEqual(len(response.json()), 30)
+
+    def test_cosine_similarity(self):
+        keyword_index = mock.Mock(**{'match_tokens.return_value': ['token']})
+        tfidf_matrix = mock.Mock(**{
+            'columns_for.return_value': [0],
+            'keyword_similarities.side_effect': lambda book_ids, columns: {pk: pk / 100 for pk in book_ids},
+        })
+        with mock.patch('data.views.get_keyword_index', return_value=keyword_index), \
+                mock.patch('data.views.get_tfidf_matrix', return_value=tfidf_matrix):
+            for sort in ('', 'download_count'):
+                # The generations, the base ids and the cards, the download counts are read only to sort by them
+                with self.assertNumQueries(4 if sort else 3):
+                    response = self.client.get('/data/books/keywords/cosine-similarity/',
+                                               {'keyword': 'token', 'top': 0, 'min_score': 0, 'sort': sort, 'order': 'ascending'})
+                ids = [book['id'] for book in response.json()]
+                self.assertEqual(ids, list(range(1, 31)) if sort else list(range(30, 0, -1)))
+
+    def test_suggestion(self):
+        # The generation of the data, book 3 has no neighbors (2 queries), the neighbors of book 1 fill the suggestions (4 queries)
+        with self.assertNumQueries(7):
+            suggestions = suggestion([3, 1])
+        self.assertEqual(len(suggestions), 10)
+
+
+class BookCardTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        english = Language.objects.create(code='en')
+        for pk in range(1, 4):
+            book = Book.objects.create(gutenberg_id=pk, title=f'Livre n°{pk} \u2028', download_count=pk, cover_image='c', plain_text='t')
+            book.authors.add(Person.objects.create(name=f'Émile {pk}', birth_year=1800))
+            book.languages.add(english)
+            book.subjects.add(Subject.objects.create(name=f'Subject {pk}'))
+        call_command('buildBookCards', stdout=io.StringIO())
+
+    def test_cards_are_the_serializer_output(self):
+        books = BookSerializer.setup_eager_loading(Book.objects.order_by('-gutenberg_id'))
+        expected = BookSerializer(books, many=True).data
+        self.assertEqual(book_cards([3, 2, 1]), expected)
+        # Byte for byte what the JSON renderer of DRF gives
+        self.assertEqual(cards_json([3, 2, 1]).encode('utf-8'), JSONRenderer().render(expected))
+
+    def test_missing_cards_are_serialized(self):
+        BookCard.objects.filter(book_id=2).delete()
+        with self.assertNumQueries(5):
+            cards = book_cards([1, 2, 3, 4])
+        self.assertEqual([card['id'] for card in cards], [1, 2, 3])
+        self.assertEqual(cards[1]['authors'], [{'name': 'Émile 2', 'birth_year': 1800, 'death_year': None}])
+
+    def test_ingestion_drops_stale_cards(self):
+        with BookWriter() as writer:
+            writer.add({
+                'id': 2, 'title': 'Nouveau titre', 'download_count': 9, 'authors': [], 'languages': ['en'], 'subjects': [],
+                'formats': {'image/jpeg': 'c', 'text/plain; charset=us-ascii': 't'},
+            })
+        self.assertFalse(BookCard.objects.filter(book_id=2).exists())
+        self.assertEqual(book_cards([2])[0]['title'], 'Nouveau titre')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ResponseCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        english = Language.objects.create(code='en')
+        for pk in range(1, 4):
+            Book.objects.create(gutenberg_id=pk, title=f'Book {pk}', download_count=pk).languages.add(english)
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, query):
+        with mock.patch('data.views.suggestion', return_value=[]):
+            return self.client.get(f'/server/books/?{query}').json()
+
+    def test_normalized_key(self):
+        first = self.get('sort=download_count&languages=en')
+        # Same parameters in another order, with a parameter the view doesn't read : only the generation is read
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get('languages=en&_=123&sort=download_count'), first)
+        self.assertNotEqual(self.get('sort=download_count&languages=en&order=ascending'), first)
+
+    def test_new_generation(self):
+        self.assertEqual(len(self.get('sort=download_count')['result']), 3)
+        with BookWriter() as writer:
+            writer.add({
+                'id': 4, 'title': 'Book 4', 'download_count': 4, 'authors': [], 'languages': ['en'], 'subjects': [],
+                'formats': {'image/jpeg': 'c', 'text/plain; charset=us-ascii': 't'},
+            })
+        self.assertEqual([book['id'] for book in self.get('sort=download_count')['result']], [4, 3, 2, 1])
+
+    def test_new_generation_reaches_the_searches(self):
+        # Start from new shared indexes, the other tests built theirs on other books
+        for name in ('data.keyword_index._index', 'data.trigram._index', 'data.tfidf_matrix._matrix'):
+            patcher = mock.patch(name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The TF-IDF matrix comes from the database, not from an export of the working directory
+        patcher = mock.patch.object(TfidfMatrix, 'load', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        queries = ('title=leagues', 'author_name=verne', 'keyword=nautilus&keyword_type=classique')
+        with mock.patch('builtins.print'):
+            for query in queries:
+                self.assertEqual(self.get(query)['result'], [])
+            # initBooks writes the book, addKeywords its keywords : each bumps the generation
+            with BookWriter() as writer:
+                writer.add({
+                    'id': 4, 'title': 'Twenty Thousand Leagues', 'download_count': 4, 'languages': ['en'], 'subjects': [],
+                    'authors': [{'name': 'Verne, Jules', 'birth_year': 1828, 'death_year': 1905}],
+                    'formats': {'image/jpeg': 'c', 'text/plain; charset=us-ascii': 't'},
+                })
+            keyword = KeywordsEnglish.objects.create(token='nautilus')
+            KeywordBookEnglish.objects.create(keyword=keyword, book_id=4, occurence=3, tfidf_score=0.5)
+            bump_dataset_generation('keywords')
+            for query in queries:
+                self.assertEqual([book['id'] for book in self.get(query)['result']], [4])
+            response = self.client.get('/data/books/keywords/cosine-similarity/', {'keyword': 'nautilus', 'min_score': 0})
+            self.assertEqual([book['id'] for book in response.json()], [4])
+            # The generations are read once per request, whatever the indexes : then the ids, the cards, and the
+            # new book serialized without its card (4 queries)
+            query = 'title=leagues&author_name=verne&keyword=nautilus&keyword_type=classique'
+            with mock.patch('data.views.suggestion', return_value=[]), self.assertNumQueries(7):
+                self.assertEqual([book['id'] for book in self.get(query)['result']], [4])
+
+    def test_incomplete_response_not_cached(self):
+        with mock.patch('data.views.suggestion', side_effect=RuntimeError):
+            self.client.get('/server/books/')
+        with mock.patch('data.views.suggestion', return_value=[{'id': 9}]):
+            self.assertEqual(self.client.get('/server/books/').json()['suggestions'], [{'id': 9}])
+
+
+def undirected(n, edges):
+    rows = [a for a, b in edges] + [b for a, b in edges]
+    columns = [b for a, b in edges] + [a for a, b in edges]
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(n, n))
+
+
+class CentralityTests(SimpleTestCase):
+
+    def test_path_and_isolated_node(self):
+        # 0 - 1 - 2   3
+        closeness, betweenness = graph_centrality(undirected(4, [(0, 1), (1, 2)]), batch_size=2)
+        # Wasserman-Faust : (r - 1) / (n - 1) * (r - 1) / sum of the distances
+        np.testing.assert_allclose(closeness, [2 / 3 * 2 / 3, 2 / 3 * 2 / 2, 2 / 3 * 2 / 3, 0])
+        # 1 is on the only path 0 - 2, out of 3 pairs of other nodes
+        np.testing.assert_allclose(betweenness, [0, 1 / 3, 0, 0])
+
+    def test_star(self):
+        closeness, betweenness = graph_centrality(undirected(5, [(0, i) for i in range(1, 5)]))
+        np.testing.assert_allclose(betweenness, [1, 0, 0, 0, 0])
+        np.testing.assert_allclose(closeness, [1, 4 / 7, 4 / 7, 4 / 7, 4 / 7])
+
+    def test_sources(self):
+        adjacency = undirected(8, [(0, 1), (1, 2), (2, 3), (3, 0), (2, 4), (5, 6), (6, 7)])
+        exact = graph_centrality(adjacency)
+        # Every node as a source gives the exact scores
+        np.testing.assert_allclose(graph_centrality(adjacency, np.arange(8), batch_size=3), exact)
+        # The component 5 - 6 - 7 has no source : all its nodes become sources, its scores are exact
+        closeness, betweenness = graph_centrality(adjacency, np.array([0, 2]))
+        np.testing.assert_allclose(closeness[5:], exact[0][5:])
+        np.testing.assert_allclose(betweenness[5:], exact[1][5:])
+        np.testing.assert_allclose(closeness[[0, 2]], exact[0][[0, 2]])
+
+
+class ComputeCentralityTests(TestCase):
+    """The command runs in a temporary folder : the manifest is written there."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        books = [Book.objects.create(gutenberg_id=pk, title=f'Book {pk}', download_count=pk) for pk in (10, 20, 30, 40)]
+        # 10 - 20 - 30, 40 without neighbors
+        for book, neighbors in ((books[0], [books[1]]), (books[1], [books[0], books[2]]), (books[2], [books[1]])):
+            Neighbors.objects.create(book=book).neighbors.add(*neighbors)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def test_scores_stored(self):
+        out = io.StringIO()
+        call_command('computeCentrality', stdout=out)
+        scores = Book.objects.order_by('gutenberg_id').values_list('closeness', 'betweenness')
+        np.testing.assert_allclose(list(scores), [(4 / 9, 0), (2 / 3, 1 / 3), (4 / 9, 0), (0, 0)])
+        # Same graph : nothing recomputed
+        call_command('computeCentrality', stdout=out)
+        self.assertIn('unchanged', out.getvalue())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_callers_share_one_computation(self):
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight('key', compute))) for _ in range(8)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 8)
+        # Nothing is left in flight, the lock of the shared cache is released
+        self.assertEqual(single_flight('key', lambda: 'again'), 'again')
+        self.assertIsNone(cache.get('singleflight_key'))
+
+    def test_errors_reach_every_caller(self):
+        with self.assertRaises(ValueError):
+            single_flight('key', mock.Mock(side_effect=ValueError))
+        self.assertIsNone(cache.get('singleflight_key'))
+
+    def test_waits_for_another_worker(self):
+        # Another worker holds the lock, then caches its result
+        cache.add('singleflight_key', 'other', version=3)
+        threading.Timer(0.1, lambda: cache.set('key', 'cached', version=3)).start()
+        compute = mock.Mock(return_value='computed')
+        result = single_flight('key', compute, lookup=lambda: cache.get('key', version=3), version=3, poll=0.01)
+        self.assertEqual(result, 'cached')
+        compute.assert_not_called()
+
+    def test_waiting_workers_get_an_uncached_result(self):
+        started, release = threading.Event(), threading.Event()
+
+        def compute():
+            started.set()
+            release.wait(5)
+            return 'incomplete'
+
+        # Another worker computes a result it doesn't cache (suggestions timed out)
+        other_worker = threading.Thread(target=_shared_flight, args=('key', compute, lambda: None, 3, 30, 5, 0.01))
+        other_worker.start()
+        started.wait(5)
+        threading.Timer(0.1, release.set).start()
+        computed = mock.Mock(return_value='computed')
+        self.assertEqual(single_flight('key', computed, lookup=lambda: None, version=3, poll=0.01), 'incomplete')
+        computed.assert_not_called()
+        other_worker.join()
+        # Only the waiting workers get it, the next request computes again
+        self.assertEqual(single_flight('key', computed, lookup=lambda: None, version=3), 'computed')
+
+    def test_computes_after_waiting_too_long(self):
+        cache.add('singleflight_key', 'stuck')
+        with mock.patch('builtins.print'):
+            self.assertEqual(single_flight('key', lambda: 'computed', lookup=lambda: None, wait=0.05, poll=0.01), 'computed')
+        # The lock of the other worker isn't ours to release
+        self.assertEqual(cache.get('singleflight_key'), 'stuck')
+
+
+class RegexSearchTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        for pk, title in enumerate(['abcd', 'abd', 'Les Misérables', 'xyz']):
+            self.index.add(pk, title)
+
+    def test_atomic_group(self):
+        self.assertEqual(required_literals('(?>abc)d'), ('abc', 'd'))
+        self.assertEqual(regex_search(self.index, '(?>abc)d'), {0})
+        self.assertEqual(regex_search(self.index, '(?>ab)'), {0, 1, 2})
+
+    def test_unparsable_pattern_falls_back_to_the_scan(self):
+        required_literals.cache_clear()
+        self.addCleanup(required_literals.cache_clear)
+        with mock.patch('data.regex_search._literals', side_effect=TypeError):
+            self.assertEqual(required_literals('Mis.rables'), ())
+            self.assertEqual(regex_search(self.index, 'Mis.rables'), {2})
+        # No literal required by an alternation : only the first 3 titles are scanned, 'xyz' isn't
+        with mock.patch('builtins.print'):
+            self.assertEqual(regex_search(self.index, '(?>ab|xy)', scan_limit=3), {0, 1, 2})
+
+
+class AutomatonTests(SimpleTestCase):
+    """The trie walk finds the tokens `re` finds, unsupported patterns go back to the regex path."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = random.Random(0)
+        alphabet = 'abcdeéèçz_1 '
+        vocabulary = {''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 7))) for _ in range(1000)}
+        cls.vocabulary = sorted(vocabulary | {'a', 'ab', 'abc', 'École', 'été', 'Été'})
+        cls.trie = VocabularyTrie(cls.vocabulary)
+
+    def test_anchored_patterns(self):
+        patterns = [
+            '^a', '^ab$', '^a.c', '^(ab|cd)e?', '^a*b', '^a{2,3}', '^[^a]b', r'^\d', r'^\w+$', r'^\s', '^(?i:É)t',
+            '(?i)^ÉT', '^[é-ÿ]', '^\\Aab', '^a|^b', '^é.+?$', '^(a|)b', '^[ab]{0,2}c$', '^a\\Z', '^ab(?#comment)',
+        ]
+        for pattern in patterns:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(sorted(self.trie.search(pattern)), [token for token in self.vocabulary if re.search(pattern, token)])
+
+    def test_full_matches(self):
+        for pattern in ('ab', '[a-c]+', 'a.*z', '.{3}', '(ab|cd)e?', '(?:ab)+', 'é?[^ ]*1'):
+            with self.subTest(pattern=pattern):
+                self.assertEqual(sorted(self.trie.search(f'^(?:{pattern})$')),
+                                 [token for token in self.vocabulary if re.fullmatch(pattern, token)])
+
+    def test_unsupported_patterns_fall_back(self):
+        index = TrigramIndex()
+        for token in self.vocabulary:
+            index.add(token, token)
+        # Atomic groups, backreferences, word boundaries, lookarounds, and unanchored patterns which prune nothing
+        for pattern in ('^(?>ab)c', r'^(a)\1', r'^a\b', '^(?=a)b', '^a(?!b)', '^(?<=a)b', 'ab', 'é$'):
+            with self.subTest(pattern=pattern):
+                self.assertIsNone(self.trie.search(pattern))
+                expected = {token for token in self.vocabulary if re.search(pattern, token)}
+                self.assertEqual(regex_search(index, pattern, scan_limit=len(self.vocabulary)), expected)
+        with self.assertRaises(re.error):
+            self.trie.search('^[a')
+
+
+class AnnIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        # Books around 40 topics : the tokens of their topic, weighted at random, and a few other tokens
+        rng = np.random.default_rng(0)
+        n_books, n_tokens = 600, 400
+        topics = sparse.random(40, n_tokens, density=0.05, random_state=1).toarray()
+        vectors = topics[rng.integers(0, 40, n_books)] * (1 + 0.3 * rng.random((n_books, n_tokens)))
+        vectors += (rng.random((n_books, n_tokens)) < 0.01) * rng.random((n_books, n_tokens))
+        self.matrix = sparse.csr_matrix(vectors)
+        self.book_ids = np.arange(1000, 1000 + n_books)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def recall(self, index, sample, k=10):
+        found = expected = 0
+        for book_id in sample:
+            exact = {b for b, _ in index.exact_query(book_id, k=k)}
+            found += len(exact & {b for b, _ in index.query(book_id=book_id, k=k)})
+            expected += len(exact)
+        return found / expected
+
+    def test_recall_against_exact_search(self):
+        sample = self.book_ids[::20]
+        index = AnnIndex.build(self.matrix, self.book_ids, n_trees=10, leaf_size=16, seed=0)
+        self.assertGreaterEqual(self.recall(index, sample), 0.95)
+        # A single tree inspects fewer candidates
+        single = AnnIndex.build(self.matrix, self.book_ids, n_trees=1, leaf_size=16, seed=0)
+        self.assertLess(self.recall(single, sample), self.recall(index, sample))
+        # The scores are exact cosines, the book itself isn't returned
+        results = index.query(book_id=1000, k=5)
+        self.assertNotIn(1000, [book_id for book_id, _ in results])
+        self.assertEqual(results[0], index.exact_query(1000, k=5)[0])
+
+    def test_save_and_load(self):
+        index = AnnIndex.build(self.matrix, self.book_ids, n_trees=4, leaf_size=16, seed=0)
+        index.save(self.folder.name)
+        tfidf_matrix = mock.Mock(matrix=self.matrix, book_ids=self.book_ids)
+        loaded = AnnIndex.load(self.folder.name, tfidf_matrix=tfidf_matrix)
+        for book_id in self.book_ids[:50]:
+            self.assertEqual(loaded.query(book_id=book_id, k=10), index.query(book_id=book_id, k=10))
+        vector = self.matrix[3]
+        self.assertEqual(loaded.query(vector=vector, k=5), index.query(vector=vector, k=5))
+        # Missing, or built on other books
+        self.assertIsNone(AnnIndex.load(os.path.join(self.folder.name, 'missing'), tfidf_matrix=tfidf_matrix))
+        with mock.patch('builtins.print'):
+            other = mock.Mock(matrix=self.matrix, book_ids=self.book_ids + 1)
+            self.assertIsNone(AnnIndex.load(self.folder.name, tfidf_matrix=other))
+
+
+def random_counters(n_books, seed=0):
+    """Keyword counters of books on 10 topics, each with a few tokens of other books."""
+    rng = random.Random(seed)
+    books = {}
+    for pk in range(1, n_books + 1):
+        topic = pk % 10
+        tokens = {f'topic{topic}_{i}': rng.randint(5, 8) for i in rng.sample(range(20), 15)}
+        tokens.update({f'word{rng.randrange(500)}': rng.randint(1, 3) for _ in range(5)})
+        books[pk] = tokens
+    return books
+
+
+def exact_edges(books, threshold):
+    return {(pk1, pk2) for pk1 in books for pk2 in books if pk1 < pk2 and jaccard_distance(books[pk1], books[pk2]) < threshold}
+
+
+class MinHashTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('data.management.commands.createGraphJaccard.tqdm', lambda iterable, **kwargs: iterable)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.command = createGraphJaccard.Command(stdout=io.StringIO())
+        self.books = random_counters(200)
+        self.expected = exact_edges(self.books, createGraphJaccard.JACCARD_DISTANCE_THRESHOLD)
+
+    def recall(self, edges):
+        return len(edges & self.expected) / len(self.expected)
+
+    def test_recall_against_the_exact_graph(self):
+        edges = self.command.minhash_edges(self.books, 128, 32, 0)
+        # The candidates are checked with jaccard_distance : no false edge
+        self.assertLessEqual(edges, self.expected)
+        self.assertGreater(self.recall(edges), 0.5)
+        # More bands, more candidates : the recall goes up
+        more_bands = self.command.minhash_edges(self.books, 128, 128, 0)
+        self.assertGreater(self.recall(more_bands), max(0.9, self.recall(edges)))
+        # Books of the same topic are found, the misses are pairs sharing a few tokens only
+        same_topic = {(pk1, pk2) for pk1, pk2 in self.expected if pk1 % 10 == pk2 % 10}
+        self.assertEqual(self.command.minhash_edges(self.books, 128, 64, 0) & same_topic, same_topic)
+
+    def test_only_the_changed_books(self):
+        only = {1, 2, 3}
+        edges = self.command.minhash_edges(self.books, 128, 128, 0, only=only)
+        self.assertTrue(all(pk1 in only or pk2 in only for pk1, pk2 in edges))
+        self.assertEqual(edges, {edge for edge in self.command.minhash_edges(self.books, 128, 128, 0) if set(edge) & only})
+
+
+class JaccardMatrixTests(SimpleTestCase):
+    """Same distances and edges as the pure-Python jaccard_distance loop."""
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.books = {
+            pk: {f'w{rng.randrange(12)}': rng.randint(1, 4) for _ in range(rng.randint(1, 6))}
+            for pk in range(1, 31)
+        }
+        # Books sharing no token with any other one, and an empty counter
+        self.books[40] = {'alone': 3}
+        self.books[41] = {'other': 1, 'unique': 2}
+        self.books[42] = {}
+
+    def test_block_distances(self):
+        pks, matrix = occurrence_matrix(self.books)
+        rows = np.arange(len(pks))
+        # Partial last block : 33 books by blocks of 8
+        for start in range(0, len(pks), 8):
+            block = matrix[start:start + 8].tocsc()
+            distances = block_distances(matrix, rows, block)
+            expected = [[jaccard_distance(self.books[pk1], self.books[pk2]) for pk2 in pks[start:start + 8]] for pk1 in pks]
+            np.testing.assert_allclose(distances, expected)
+        # Nothing shared : distance 1, even to itself for the empty counter
+        alone, empty = list(pks).index(40), list(pks).index(42)
+        distances = block_distances(matrix, [alone, empty], matrix.tocsc())
+        self.assertEqual(distances[0].tolist(), [0.0 if row == alone else 1.0 for row in rows])
+        self.assertEqual(distances[1].tolist(), [1.0] * len(pks))
+
+    def test_edges(self):
+        expected = exact_edges(self.books, 0.5)
+        self.assertTrue(expected)
+        for block_size in (4, 7, 100):
+            with self.subTest(block_size=block_size):
+                self.assertEqual(jaccard_edges(self.books, 0.5, block_size=block_size, workers=2), expected)
+        only = {3, 40, 42}
+        self.assertEqual(jaccard_edges(self.books, 0.5, block_size=7, workers=1, only=only),
+                         {edge for edge in expected if set(edge) & only})
+
+
+class WriteEdgesTests(TestCase):
+    """The command runs in a temporary folder : the keyword files and the manifest are there."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.mkdir('keywords')
+        # Progress bars of the command
+        patcher = mock.patch('sys.stderr', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for pk in range(1, 7):
+            Book.objects.create(gutenberg_id=pk, title=f'Book {pk}')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def graph(self):
+        through = Neighbors.neighbors.through
+        return set(through.objects.values_list('neighbors__book_id', 'book_id'))
+
+    def write_keywords(self, books):
+        for name in os.listdir('keywords'):
+            os.remove(os.path.join('keywords', name))
+        for pk, tokens in books.items():
+            with open(os.path.join('keywords', f'{pk}.json'), 'w') as f:
+                json.dump(tokens, f)
+
+    def test_both_directions(self):
+        command = createGraphJaccard.Command(stdout=io.StringIO())
+        # Book 99 isn't in the database : its edge is skipped
+        command.write_edges({(1, 2), (2, 3), (3, 99)}, batch_size=1)
+        self.assertEqual(self.graph(), {(1, 2), (2, 1), (2, 3), (3, 2)})
+        self.assertEqual(set(Neighbors.objects.values_list('book_id', flat=True)), {1, 2, 3})
+        # Written again : nothing duplicated
+        command.write_edges({(1, 2)})
+        self.assertEqual(Neighbors.neighbors.through.objects.count(), 4)
+        # Only the edges of book 3 replaced
+        command.write_edges({(3, 4)}, replace={3})
+        self.assertEqual(self.graph(), {(1, 2), (2, 1), (3, 4), (4, 3)})
+
+    def test_rebuild_replaces_the_graph(self):
+        self.write_keywords({1: {'a': 2, 'b': 1}, 2: {'a': 2, 'b': 1}, 3: {'c': 1}, 4: {'c': 1, 'd': 5}})
+        options = ['--mode', 'blockwise', '--workers', '1']
+        call_command('createGraphJaccard', *options, stdout=io.StringIO())
+        self.assertEqual(self.graph(), {(1, 2), (2, 1), (3, 4), (4, 3)})
+        self.write_keywords({1: {'a': 2}, 5: {'a': 2}, 6: {'e': 1}})
+        call_command('createGraphJaccard', *options, '--rebuild', stdout=io.StringIO())
+        self.assertEqual(self.graph(), {(1, 5), (5, 1)})
+        self.assertEqual(set(Neighbors.objects.values_list('book_id', flat=True)), {1, 5})
+
+    def test_full_run_drops_the_removed_books(self):
+        options = ['--mode', 'blockwise', '--workers', '1']
+        self.write_keywords({1: {'a': 2}, 2: {'a': 2}, 3: {'a': 2}})
+        call_command('createGraphJaccard', *options, stdout=io.StringIO())
+        self.write_keywords({1: {'a': 2}, 2: {'a': 2}})
+        call_command('createGraphJaccard', *options, '--full', stdout=io.StringIO())
+        self.assertEqual(self.graph(), {(1, 2), (2, 1)})
+
+
+class ManifestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.path = os.path.join(self.folder.name, 'manifest.json')
+        stage = Manifest(self.path).stage('stage', {'threshold': 0.5})
+        for pk, digest in ((1, 'a'), (2, 'b'), (3, 'c')):
+            stage.record(pk, digest)
+        stage.save()
+
+    def test_changes(self):
+        stage = Manifest(self.path).stage('stage', {'threshold': 0.5})
+        # 2 changed, 3 removed, 4 new
+        self.assertEqual(stage.changes({1: 'a', 2: 'B', 4: 'd'}), ({2, 4}, {3}))
+        self.assertEqual(stage.changes({1: 'a', 2: 'b', 3: 'c'}), (set(), set()))
+        stage.forget(3)
+        stage.record(4, 'd')
+        stage.save()
+        self.assertEqual(Manifest(self.path).stage('stage', {'threshold': 0.5}).inputs, {'1': 'a', '2': 'b', '4': 'd'})
+        # The other stages are kept
+        Manifest(self.path).stage('other', {}).save()
+        self.assertEqual(set(Manifest(self.path).stages), {'stage', 'other'})
+
+    def test_full_run_still_reports_removed_inputs(self):
+        stage = Manifest(self.path).stage('stage', {'threshold': 0.5}, full=True)
+        self.assertEqual(stage.inputs, {})
+        self.assertEqual(stage.changes({1: 'a', 2: 'b'}), ({1, 2}, {3}))
+
+    def test_new_parameters_invalidate_the_inputs(self):
+        stage = Manifest(self.path).stage('stage', {'threshold': 0.4})
+        self.assertEqual(stage.inputs, {})
+        self.assertEqual(stage.changes({1: 'a', 2: 'b'}), ({1, 2}, {3}))
+        stage.record(1, 'a')
+        stage.save()
+        # Saved with its new parameters, the old inputs are gone
+        self.assertEqual(Manifest(self.path).stages['stage'], {'params': {'threshold': 0.4}, 'inputs': {'1': 'a'}})
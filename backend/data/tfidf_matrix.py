@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from django.db import DatabaseError
+from scipy import sparse
+
+from data.config import DOSSIER_TFIDF_MATRIX
+from data.models import KeywordBookEnglish, KeywordBookFrench
+from data.response_cache import dataset_generation
+
+# Column blocks of the matrix, in order : english tokens then french tokens
+MATRIX_LANGUAGES = {
+    'english': KeywordBookEnglish,
+    'french': KeywordBookFrench,
+}
+ARRAY_FILES = ('data', 'indices', 'indptr', 'book_ids')
+COLUMNS_FILE = 'columns.json'
+
+
+class TfidfMatrix:
+    """
+    Book x token matrix of the tfidf_score values, stored as CSR.
+
+    Rows are books (`book_ids[row]`), columns are the english tokens followed
+    by the french tokens (`columns[language][token]`). The arrays exported by
+    the buildTfidfMatrix command are memory-mapped, not read in memory.
+    """
+
+    def __init__(self, matrix, book_ids, tokens):
+        # Generation of the keywords when the shared matrix was loaded
+        self.generation = None
+        self.matrix = matrix
+        self.book_ids = book_ids
+        self.row_of = {int(book_id): row for row, book_id in enumerate(book_ids)}
+        # {language: [token, ...]} in column order
+        self.tokens = tokens
+        self.columns = {}
+        offset = 0
+        for language in MATRIX_LANGUAGES:
+            language_tokens = tokens.get(language, [])
+            self.columns[language] = {token: offset + i for i, token in enumerate(language_tokens)}
+            offset += len(language_tokens)
+
+    @classmethod
+    def from_database(cls):
+        """Build the matrix in memory from the KeywordBook tables."""
+        rows, cols, values = [], [], []
+        tokens = {}
+        offset = 0
+        for language, model in MATRIX_LANGUAGES.items():
+            column_of = {}
+            queryset = model.objects.filter(tfidf_score__gt=0).values_list('book_id', 'keyword__token', 'tfidf_score')
+            for book_id, token, score in queryset.iterator(chunk_size=10000):
+                col = column_of.setdefault(token, offset + len(column_of))
+                rows.append(book_id)
+                cols.append(col)
+                values.append(score)
+            tokens[language] = list(column_of)
+            offset += len(column_of)
+
+        book_ids, row_index = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), (row_index, np.asarray(cols, dtype=np.int64))),
+            shape=(len(book_ids), offset),
+        )
+        matrix.sum_duplicates()
+        return cls(matrix, book_ids, tokens)
+
+    @classmethod
+    def load(cls, directory=DOSSIER_TFIDF_MATRIX):
+        """Memory-map an exported matrix, None if it hasn't been exported."""
+        paths = {name: os.path.join(directory, f"{name}.npy") for name in ARRAY_FILES}
+        columns_path = os.path.join(directory, COLUMNS_FILE)
+        if not all(os.path.exists(path) for path in [*paths.values(), columns_path]):
+            return None
+        arrays = {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+        with open(columns_path, 'r', encoding='utf-8') as f:
+            tokens = json.load(f)
+        n_columns = sum(len(language_tokens) for language_tokens in tokens.values())
+        matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(len(arrays['book_ids']), n_columns),
+            copy=False,
+        )
+        return cls(matrix, arrays['book_ids'], tokens)
+
+    def save(self, directory=DOSSIER_TFIDF_MATRIX):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {
+            'data': self.matrix.data.astype(np.float32),
+            'indices': self.matrix.indices.astype(np.int32),
+            'indptr': self.matrix.indptr.astype(np.int64),
+            'book_ids': np.asarray(self.book_ids, dtype=np.int64),
+        }
+        # Write next to the final files then swap them in
+        for name, array in arrays.items():
+            tmp_path = os.path.join(directory, f"{name}.tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+        tmp_path = os.path.join(directory, f"{COLUMNS_FILE}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.tokens, f)
+        os.replace(tmp_path, os.path.join(directory, COLUMNS_FILE))
+
+    @staticmethod
+    def replace_export(source, directory=DOSSIER_TFIDF_MATRIX):
+        """Move the matrix exported in `source` in place of the one of `directory`, then remove `source`."""
+        os.makedirs(directory, exist_ok=True)
+        for name in [*(f"{name}.npy" for name in ARRAY_FILES), COLUMNS_FILE]:
+            os.replace(os.path.join(source, name), os.path.join(directory, name))
+        os.rmdir(source)
+
+    def columns_for(self, language, tokens):
+        column_of = self.columns.get(language, {})
+        return [column_of[token] for token in tokens if token in column_of]
+
+    def rows_for(self, book_ids):
+        return [self.row_of[book_id] for book_id in book_ids if book_id in self.row_of]
+
+    def keyword_similarities(self, book_ids, columns):
+        """
+        Similarity score of the books of `book_ids` containing the keyword
+        columns, as the cosine search has always scored them : the best cosine
+        between a book and the books containing the keywords. Every such book
+        is one of them, so its best match is itself and its score is 1.0.
+
+        Returns {book_id: similarity} for the books with a non-zero vector.
+        """
+        rows = np.asarray(sorted(self.rows_for(book_ids)), dtype=np.int64)
+        if not len(rows) or not columns:
+            return {}
+        vectors = self.matrix[rows][:, np.asarray(sorted(set(columns)), dtype=np.int64)]
+        sources = np.asarray(abs(vectors).sum(axis=1)).ravel() > 0
+        return {int(self.book_ids[row]): 1.0 for row in rows[sources]}
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def _load_matrix():
+    start_time = time.time()
+    matrix = TfidfMatrix.load()
+    if matrix is None:
+        print("No exported TF-IDF matrix, building it from the database "
+              "(run `python manage.py buildTfidfMatrix` to export it)")
+        matrix = TfidfMatrix.from_database()
+    print(f"TF-IDF matrix loaded in {time.time() - start_time:.4f} seconds "
+          f"({matrix.matrix.shape[0]} books x {matrix.matrix.shape[1]} tokens)")
+    return matrix
+
+
+def get_tfidf_matrix(generation=None):
+    """
+    Return the shared TF-IDF matrix : the exported one if buildTfidfMatrix was
+    run, otherwise one built in memory from the database. Reloaded when the
+    generation of the keywords changes, `tfidf` rewrites the export before
+    bumping it.
+    """
+    global _matrix
+    if generation is None:
+        generation = dataset_generation('keywords')
+    if _matrix is None or _matrix.generation != generation:
+        with _matrix_lock:
+            if _matrix is None or _matrix.generation != generation:
+                matrix = _load_matrix()
+                matrix.generation = generation
+                _matrix = matrix
+    return _matrix
+
+
+def preload_tfidf_matrix():
+    """Memory-map the exported matrix at server start, if there is one."""
+    global _matrix
+    try:
+        generation = dataset_generation('keywords')
+    except DatabaseError:
+        # Database not migrated yet : the first request loads the matrix again
+        generation = None
+    matrix = TfidfMatrix.load()
+    if matrix is not None:
+        matrix.generation = generation
+        with _matrix_lock:
+            _matrix = matrix
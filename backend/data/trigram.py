@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import defaultdict
+
+from data.models import Book
+from data.response_cache import dataset_generation
+
+NGRAM_SIZE = 3
+
+
+def normalize(text):
+    """Normalization applied to both the indexed texts and the queries."""
+    return text.casefold()
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class TrigramIndex:
+    """
+    Trigram index over short texts (titles, author names, ...).
+
+    Every entry is indexed under the trigrams of its normalized text. A
+    substring query only has to verify the entries sharing all the trigrams
+    of the query instead of scanning every text. Queries shorter than three
+    characters have no trigram and are verified against every entry.
+    """
+
+    def __init__(self):
+        self.texts = {}                    # entry id -> original text
+        self.normalized = {}               # entry id -> normalized text
+        self.postings = defaultdict(set)   # trigram -> entry ids
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, entry_id, text):
+        normalized = normalize(text)
+        self.texts[entry_id] = text
+        self.normalized[entry_id] = normalized
+        for gram in ngrams(normalized):
+            self.postings[gram].add(entry_id)
+
+    def candidates_for(self, grams):
+        """Entries containing every n-gram of `grams` (all entries if `grams` is empty)."""
+        if not grams:
+            return self.normalized.keys()
+        posting_lists = []
+        for gram in grams:
+            entries = self.postings.get(gram)
+            if not entries:
+                return set()
+            posting_lists.append(entries)
+        # Intersect starting from the rarest trigram
+        posting_lists.sort(key=len)
+        candidates = set(posting_lists[0])
+        for entries in posting_lists[1:]:
+            candidates &= entries
+            if not candidates:
+                break
+        return candidates
+
+    def search(self, query):
+        """Return the ids of the entries whose text contains `query`, ignoring case."""
+        needle = normalize(query)
+        return {
+            entry_id for entry_id in self.candidates_for(ngrams(needle))
+            if needle in self.normalized[entry_id]
+        }
+
+
+class BookTextIndex:
+    """Trigram indexes over book titles and author names."""
+
+    def __init__(self, titles, authors, author_books, generation=None):
+        self.generation = generation      # generation of the books the indexes were built from
+        self.titles = titles              # TrigramIndex keyed by book id
+        self.authors = authors            # TrigramIndex keyed by person id
+        self.author_books = author_books  # person id -> book ids
+
+    @classmethod
+    def build(cls, generation=None):
+        start_time = time.time()
+        titles = TrigramIndex()
+        for book_id, title in Book.objects.exclude(title__isnull=True).values_list('gutenberg_id', 'title'):
+            titles.add(book_id, title)
+
+        authors = TrigramIndex()
+        author_books = defaultdict(list)
+        rows = Book.authors.through.objects.values_list('person_id', 'person__name', 'book_id')
+        for person_id, name, book_id in rows.iterator(chunk_size=10000):
+            if person_id not in authors.texts:
+                authors.add(person_id, name)
+            author_books[person_id].append(book_id)
+
+        print(f"Title/author trigram index built in {time.time() - start_time:.4f} seconds "
+              f"({len(titles)} titles, {len(authors)} authors)")
+        return cls(titles, authors, author_books, generation)
+
+    def search_titles(self, query):
+        return self.titles.search(query)
+
+    def books_for_authors(self, person_ids):
+        book_ids = set()
+        for person_id in person_ids:
+            book_ids.update(self.author_books[person_id])
+        return book_ids
+
+    def search_authors(self, query):
+        return self.books_for_authors(self.authors.search(query))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_book_text_index(generation=None):
+    """
+    Return the shared title/author index, built on first use and rebuilt when
+    the generation of the books changes (books added by initBooks).
+    """
+    global _index
+    if generation is None:
+        generation = dataset_generation('books')
+    if _index is None or _index.generation != generation:
+        with _index_lock:
+            if _index is None or _index.generation != generation:
+                _index = BookTextIndex.build(generation)
+    return _index
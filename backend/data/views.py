@@ -1,20 +1,28 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.core.cache import cache
-from django.db.models import Q
-from data.models import Book, KeywordsEnglish, KeywordsFrench, KeywordBookEnglish, KeywordBookFrench, Neighbors
-from data.serializers import BookSerializer
-from data.sort import sort_by_centrality, suggestion
-from data.centrality import Centrality
-import numpy as np
-from collections import defaultdict
+from data.models import Book, Neighbors
+from data.cards import card_strings, cards_json, encode_card, json_object
+from data.pagination import KeysetPaginator
+from data.response_cache import request_generations, response_cache_key
+from data.singleflight import single_flight
+from data.config import RESPONSE_CACHE_TIMEOUT
+from data.sort import suggestion
+from data.centrality import CENTRALITY_FIELDS
+from data.keyword_index import KEYWORD_LANGUAGES, get_keyword_index
+from data.trigram import get_book_text_index
+from data.regex_search import regex_search
+from data.tfidf_matrix import get_tfidf_matrix
 import time
 from concurrent.futures import ThreadPoolExecutor
 
-# Thread pool for background tasks
-executor = ThreadPoolExecutor(max_workers=2)
+# Query parameters read by BooksList, the others don't change its response
+BOOKS_LIST_PARAMS = (
+    'languages', 'author_name', 'author_name_type', 'title', 'title_type', 'keyword', 'keyword_type',
+    'sort', 'order', 'page_size', 'cursor',
+)
 
 class BookViewSet(APIView):
     
@@ -24,14 +32,21 @@ class BookViewSet(APIView):
         # Call the processing function
         queryset = self.process_book_query(request)
         
-        # Serialize and return the response
-        serializer = BookSerializer(queryset, many=True)
+        # Join the precomputed cards of the books, nothing is serialized
+        paginator = KeysetPaginator.from_request(request)
+        if paginator is None:
+            content = cards_json(list(queryset.values_list('gutenberg_id', flat=True)))
+        else:
+            # Only the books of the page, then the count and the link of the next page
+            results = cards_json(paginator.page_ids(queryset))
+            links = {name: encode_card(value) for name, value in paginator.links(queryset).items()}
+            content = json_object({**links, 'results': results})
         
         end_time = time.time()
         execution_time = end_time - start_time
         print(f"BookViewSet query execution time: {execution_time:.4f} seconds")
         
-        return Response(serializer.data)
+        return HttpResponse(content, content_type='application/json')
     
     def process_book_query(self, request):
         # Initialize base queryset
@@ -64,9 +79,14 @@ class BookViewSet(APIView):
             search_name_authors_type = "classique" if search_name_authors_type is None else search_name_authors_type
             
             if search_name_authors_type == "classique":
-                queryset = queryset.filter(authors__name__icontains=search_name_author)
+                # Candidate books come from the trigram index over author names
+                book_ids = get_book_text_index(request_generations(request)['books']).search_authors(search_name_author)
+                queryset = queryset.filter(gutenberg_id__in=book_ids)
             else:
-                queryset = queryset.filter(authors__name__regex=search_name_author)
+                # Regex runs only on the author names sharing the pattern's literals
+                text_index = get_book_text_index(request_generations(request)['books'])
+                person_ids = regex_search(text_index.authors, search_name_author)
+                queryset = queryset.filter(gutenberg_id__in=text_index.books_for_authors(person_ids))
         return queryset
     
     def _filter_by_title(self, request, queryset):
@@ -76,9 +96,13 @@ class BookViewSet(APIView):
             search_title_type = "classique" if search_title_type is None else search_title_type
             
             if search_title_type == "classique":
-                queryset = queryset.filter(title__icontains=search_title)
+                # Candidate books come from the trigram index over titles
+                book_ids = get_book_text_index(request_generations(request)['books']).search_titles(search_title)
+                queryset = queryset.filter(gutenberg_id__in=book_ids)
             else:
-                queryset = queryset.filter(title__regex=search_title)
+                # Regex runs only on the titles sharing the pattern's literals
+                book_ids = regex_search(get_book_text_index(request_generations(request)['books']).titles, search_title)
+                queryset = queryset.filter(gutenberg_id__in=book_ids)
         return queryset
     
     def _filter_by_keyword(self, request, queryset, language):
@@ -86,21 +110,14 @@ class BookViewSet(APIView):
         if search_keyword is not None:
             search_keywords_type = request.GET.get('keyword_type')
             search_method = 'icontains' if search_keywords_type == 'classique' else 'regex'
-            
-            # Define language-specific filters
-            filters = {
-                'en': {'keywordbookenglish__keyword__token__{}'.format(search_method): search_keyword},
-                'fr': {'keywordbookfrench__keyword__token__{}'.format(search_method): search_keyword},
-            }
-            
-            # Apply language-specific filter or both if language is not specified
-            if language in filters:
-                queryset = queryset.filter(**filters[language])
-            else:
-                # For other languages or no language specified, search in both English and French
-                english_filter = Q(**{'keywordbookenglish__keyword__token__{}'.format(search_method): search_keyword})
-                french_filter = Q(**{'keywordbookfrench__keyword__token__{}'.format(search_method): search_keyword})
-                queryset = queryset.filter(english_filter | french_filter)
+
+            # Search only the requested language, or both English and French
+            # for other languages or when no language is specified
+            languages = [language] if language in KEYWORD_LANGUAGES else KEYWORD_LANGUAGES
+
+            # Resolve the matching books from the in-memory inverted index
+            book_ids = get_keyword_index(request_generations(request)['keywords']).search(search_keyword, search_method, languages)
+            queryset = queryset.filter(gutenberg_id__in=book_ids)
         return queryset
     
     def _apply_sorting(self, request, queryset):
@@ -112,6 +129,13 @@ class BookViewSet(APIView):
                 queryset = queryset.order_by('-download_count')
             else:
                 queryset = queryset.order_by('download_count')
+        elif sort in CENTRALITY_FIELDS:
+            # Centrality in the whole Neighbors graph, precomputed by computeCentrality
+            field = CENTRALITY_FIELDS[sort]
+            if request.GET.get('order', 'descending') == "descending":
+                queryset = queryset.order_by(f'-{field}', '-gutenberg_id')
+            else:
+                queryset = queryset.order_by(field, 'gutenberg_id')
         return queryset
 
 
@@ -129,92 +153,73 @@ class NeighboorsBook(APIView):
         except Neighbors.DoesNotExist:
             return Response([])
 
-        voisins = book_voisins.neighbors.all()
-        serializer = BookSerializer(voisins, many=True)
+        content = cards_json(list(book_voisins.neighbors.values_list('gutenberg_id', flat=True)))
         execution_time = time.time() - start_time
         print(f"NeighboorsBook query execution time: {execution_time:.4f} seconds")
-        return Response(serializer.data)
+        return HttpResponse(content, content_type='application/json')
 
 
 class BooksList(APIView):
     def get(self, request, format=None):
         start_time = time.time()
         
-        # Generate cache key based on request parameters
-        cache_key = f"books_list_{request.get_full_path()}"
-        cached_results = cache.get(cache_key)
+        # Generate cache key based on the normalized request parameters,
+        # the entries of an older generation of the data are ignored
+        generation = request_generations(request)['data']
+        cache_key = response_cache_key('books_list', request, BOOKS_LIST_PARAMS)
+        cached_response = cache.get(cache_key, version=generation)
+        if cached_response is not None:
+            print(f"BookList cached response in {time.time() - start_time:.4f} seconds")
+            return HttpResponse(cached_response, content_type='application/json')
+        
+        # Computed once for the concurrent requests of the same search, in every worker
+        response_data = single_flight(
+            cache_key,
+            lambda: self._build_response(request, generation, cache_key),
+            lookup=lambda: cache.get(cache_key, version=generation),
+            version=generation,
+        )
+        
+        execution_time = time.time() - start_time
+        print(f"BookList query execution time: {execution_time:.4f} seconds")
+        return HttpResponse(response_data, content_type='application/json')
+    
+    def _build_response(self, request, generation, cache_key):
+        """JSON body of the listing, cached under `cache_key` when complete"""
+        # Not cached if a part of it is missing (suggestions timed out)
+        complete = True
         
         # Instead of making an HTTP request to the data API,
         # we'll directly use the BookViewSet's functionality
         book_view = BookViewSet()
         queryset = book_view.process_book_query(request)
         
-        # Serialize the queryset
-        results = BookSerializer(queryset, many=True).data
-        
-        # Apply centrality-based sorting only if necessary
-        start_time_sort = time.time()
-        sort = request.GET.get('sort')
-        
-        if sort in ['closeness', 'Betweenness']:
-            ordre = request.GET.get('order', 'descending')
-            
-            # Process centrality calculation based on dataset size
-            if results:
-                if len(results) <= 50:  
-                    # Generate cache key using first 5 books
-                    centrality_cache_key = f"centrality_{sort}_{ordre}_{'_'.join(str(b['id']) for b in results[:5])}"
-                    sorted_results = cache.get(centrality_cache_key)
-                    
-                    if sorted_results:
-                        results = sorted_results
-                    elif len(results) <= 20:
-                        # For small datasets, calculate immediately
-                        centrality_timer = time.time()
-                        sorted_results = sort_by_centrality(
-                            results, 
-                            Centrality.CLOSENESS if sort == 'closeness' else Centrality.BETWEENNESS, 
-                            ordre
-                        )
-                        print(f"Centrality calculation completed in {time.time() - centrality_timer:.4f} seconds")
-                        
-                        results = sorted_results
-                        # Cache for longer (24 hours)
-                        # cache.set(centrality_cache_key, sorted_results, timeout=86400)
-                    else:
-                        # For medium datasets (21-50), calculate in background and use unsorted for now
-                        # Submit task to background executor
-                        centrality_timer = time.time()
-                        executor.submit(
-                            self._background_centrality_calculation,
-                            results[:],  # Copy to avoid reference issues
-                            Centrality.CLOSENESS if sort == 'closeness' else Centrality.BETWEENNESS,
-                            ordre,
-                            centrality_cache_key
-                        )
-                        print(f"Background centrality calculation submitted in {time.time() - centrality_timer:.4f} seconds")
-        
-        end_time_sort = time.time()
-        print(f"BookList sorting time: {end_time_sort - start_time_sort:.4f} seconds")
+        # Precomputed cards of the books, already sorted by the query (centralities included).
+        # With a page, the suggestions only see the books of the page
+        paginator = KeysetPaginator.from_request(request)
+        if paginator is None:
+            book_ids = list(queryset.values_list('gutenberg_id', flat=True))
+        else:
+            book_ids = paginator.page_ids(queryset)
+        cards = card_strings(book_ids)
         
         # Get suggestions with optimized approach
         start_time_suggestions = time.time()
         suggestions = []
         
-        if results:
-            book_ids = [b['id'] for b in results]
+        if book_ids:
             # Only use the first 2 books for suggestions (as in original)
             suggestion_ids = book_ids[:2]
             
             # Check for cached suggestions
             suggestions_cache_key = f"suggestions_{'_'.join(str(id) for id in suggestion_ids)}"
-            suggestions = cache.get(suggestions_cache_key)
+            suggestions = cache.get(suggestions_cache_key, version=generation)
             
             if not suggestions:
                 # Use thread pool to limit suggestion generation time
                 try:
                     with ThreadPoolExecutor(max_workers=1) as suggestion_executor:
-                        future = suggestion_executor.submit(suggestion, book_ids)
+                        future = suggestion_executor.submit(suggestion, book_ids, generation)
                         # Wait max 2 seconds for suggestions
                         suggestions = future.result(timeout=2.0)
                     # Cache suggestions for longer (24 hours)
@@ -222,39 +227,26 @@ class BooksList(APIView):
                 except Exception as e:
                     print(f"Suggestion generation timed out or failed: {e}")
                     suggestions = []  # Empty list if timeout or error
+                    complete = False
         
         end_time_suggestions = time.time()  
         print(f"BookList suggestions time: {end_time_suggestions - start_time_suggestions:.4f} seconds")
         
-        # Prepare response
+        # Prepare response, the cards are joined without being decoded
         response_data = {
-            "result": results,
-            "suggestions": suggestions
+            "result": cards_json(book_ids, cards),
+            "suggestions": encode_card(suggestions)
         }
+        if paginator is not None:
+            response_data.update((name, encode_card(value)) for name, value in paginator.links(queryset).items())
+        response_data = json_object(response_data)
         
         # Cache the entire response for longer (4 hours instead of 1)
-        # cache.set(cache_key, response_data, timeout=14400)
-        
-        execution_time = time.time() - start_time
-        print(f"BookList query execution time: {execution_time:.4f} seconds")
-        return Response(response_data)
-    
-    @staticmethod
-    def _background_centrality_calculation(results, centrality_type, ordre, cache_key):
-        """Background task for centrality calculation"""
-        try:
-            print(f"Starting background centrality calculation for {cache_key}")
-            start_time = time.time()
-            
-            # Calculate centrality
-            sorted_results = sort_by_centrality(results, centrality_type, ordre)
-            
-            # Cache the results for 24 hours
-            cache.set(cache_key, sorted_results, timeout=86400)
-            
-            print(f"Background centrality calculation completed in {time.time() - start_time:.4f} seconds")
-        except Exception as e:
-            print(f"Background centrality calculation failed: {e}")
+        if complete:
+            cache.set(cache_key, response_data, timeout=RESPONSE_CACHE_TIMEOUT, version=generation)
+        return response_data
+
+
 class CosinusViewSet(APIView):
   
     """
@@ -278,35 +270,17 @@ class CosinusViewSet(APIView):
         if language in lang_mapping:
             search_language = lang_mapping[language]
             
-        # Author name filter (same as BookViewSet)
-        search_name_author = request.GET.get('author_name')
-        if search_name_author is not None:
-            search_name_authors_type = request.GET.get('author_name_type')
-            search_name_authors_type = "classique" if search_name_authors_type is None else search_name_authors_type
-            
-            if search_name_authors_type == "classique":
-                queryset = queryset.filter(authors__name__icontains=search_name_author)
-            else:
-                queryset = queryset.filter(authors__name__regex=search_name_author)
-        
-        # Title filter (same as BookViewSet)
-        search_title = request.GET.get('title')
-        if search_title is not None:
-            search_title_type = request.GET.get('title_type')
-            search_title_type = "classique" if search_title_type is None else search_title_type
-            
-            if search_title_type == "classique":
-                queryset = queryset.filter(title__icontains=search_title)
-            else:
-                queryset = queryset.filter(title__regex=search_title)
+        # Author name and title filters (same as BookViewSet)
+        book_view = BookViewSet()
+        queryset = book_view._filter_by_author(request, queryset)
+        queryset = book_view._filter_by_title(request, queryset)
         
         # Keyword search with cosine similarity
         search_keyword = request.GET.get('keyword')
         if search_keyword is None:
             # If no keyword is provided, just return the filtered queryset
-            queryset = queryset.distinct()
-            serializer = BookSerializer(queryset, many=True)
-            return Response(serializer.data)
+            content = cards_json(list(queryset.distinct().values_list('gutenberg_id', flat=True)))
+            return HttpResponse(content, content_type='application/json')
         
         # Get parameters for cosine search
         search_keywords_type = request.GET.get('keyword_type', 'classique')
@@ -319,194 +293,35 @@ class CosinusViewSet(APIView):
         # Determine search method based on search_type
         search_method = 'icontains' if search_keywords_type == 'classique' else 'regex'
         
-        # Find keyword objects with the specified term
-        keyword_objects = []
-        
-        if search_language in ['english', 'both']:
-            filter_kwargs = {f'token__{search_method}': search_keyword}
-            english_keywords = KeywordsEnglish.objects.filter(**filter_kwargs)
-            keyword_objects.extend([(kw, 'english') for kw in english_keywords])
-        
-        if search_language in ['french', 'both']:
-            filter_kwargs = {f'token__{search_method}': search_keyword}
-            french_keywords = KeywordsFrench.objects.filter(**filter_kwargs)
-            keyword_objects.extend([(kw, 'french') for kw in french_keywords])
-        
-        if not keyword_objects:
-            return Response([])
-        
-        # Find books containing these keywords
-        books_with_keywords = []
-        books_details = {}
-        
-        for kw, lang in keyword_objects:
-            if lang == 'english':
-                books = Book.objects.filter(keywordbookenglish__keyword=kw)
-                book_keywords = KeywordBookEnglish.objects.filter(keyword=kw).select_related('book')
-            else:
-                books = Book.objects.filter(keywordbookfrench__keyword=kw)
-                book_keywords = KeywordBookFrench.objects.filter(keyword=kw).select_related('book')
-            
-            for book in books:
-                # Only include books that passed the initial filters
-                if book.gutenberg_id not in base_book_ids:
-                    continue
-                    
-                if book.gutenberg_id not in books_details:
-                    books_with_keywords.append(book)
-                    books_details[book.gutenberg_id] = {
-                        "book": book,
-                        "keywords": defaultdict(float),
-                        "similarity_score": 1.0  # Source books have perfect similarity
-                    }
-                
-                # Store TF-IDF score for this book-keyword pair
-                if lang == 'english':
-                    try:
-                        score = KeywordBookEnglish.objects.get(book=book, keyword=kw).tfidf_score
-                    except KeywordBookEnglish.DoesNotExist:
-                        score = 0.0
-                else:
-                    try:
-                        score = KeywordBookFrench.objects.get(book=book, keyword=kw).tfidf_score
-                    except KeywordBookFrench.DoesNotExist:
-                        score = 0.0
-                
-                books_details[book.gutenberg_id]["keywords"][f"{lang}_{kw.token}"] = score
-        
-        if not books_with_keywords:
-            return Response([])
-        
-        # Compute all unique keywords
-        all_keywords = set()
-        for book_id, details in books_details.items():
-            all_keywords.update(details["keywords"].keys())
-        
-        all_keywords = list(all_keywords)
-        
-        # Create vector representations for each book
-        book_vectors = {}
-        for book_id, details in books_details.items():
-            vector = [details["keywords"].get(kw, 0.0) for kw in all_keywords]
-            book_vectors[book_id] = vector
-        
-        # Find all books that are similar to the ones containing the keyword
-        similar_book_ids = set()
-        for source_id, source_details in books_details.items():
-            source_vector = book_vectors[source_id]
-            
-            # Skip if the source vector is all zeros
-            if sum(source_vector) == 0:
-                continue
-                
-            source_norm = np.linalg.norm(source_vector)
-            if source_norm == 0:
-                continue
-            
-            # Add the source book itself
-            similar_book_ids.add(source_id)
-            
-            # Find books in the database that share keywords with this book
-            shared_books = set()
-            for kw_key, score in source_details["keywords"].items():
-                if score <= 0:
-                    continue
-                    
-                lang, token = kw_key.split('_', 1)
-                
-                if lang == 'english':
-                    try:
-                        keyword_obj = KeywordsEnglish.objects.get(token=token)
-                        book_ids = KeywordBookEnglish.objects.filter(
-                            keyword=keyword_obj, 
-                            book_id__in=base_book_ids
-                        ).values_list('book_id', flat=True)
-                        shared_books.update(book_ids)
-                    except KeywordsEnglish.DoesNotExist:
-                        pass
-                else:  # french
-                    try:
-                        keyword_obj = KeywordsFrench.objects.get(token=token)
-                        book_ids = KeywordBookFrench.objects.filter(
-                            keyword=keyword_obj,
-                            book_id__in=base_book_ids
-                        ).values_list('book_id', flat=True)
-                        shared_books.update(book_ids)
-                    except KeywordsFrench.DoesNotExist:
-                        pass
-            
-            # Remove the source book
-            if source_id in shared_books:
-                shared_books.remove(source_id)
-            
-            # For each shared book, compute similarity
-            for target_id in shared_books:
-                if target_id in books_details:
-                    # We've already calculated vectors for this book
-                    target_vector = book_vectors[target_id]
-                else:
-                    # Need to build vector for this book
-                    target_keywords = defaultdict(float)
-                    
-                    if search_language in ['english', 'both']:
-                        english_kws = KeywordBookEnglish.objects.filter(book_id=target_id).select_related('keyword')
-                        for kw_book in english_kws:
-                            token = kw_book.keyword.token
-                            keyword_key = f"english_{token}"
-                            if keyword_key in all_keywords:  # Only include keywords we've seen
-                                target_keywords[keyword_key] = kw_book.tfidf_score
-                    
-                    if search_language in ['french', 'both']:
-                        french_kws = KeywordBookFrench.objects.filter(book_id=target_id).select_related('keyword')
-                        for kw_book in french_kws:
-                            token = kw_book.keyword.token
-                            keyword_key = f"french_{token}"
-                            if keyword_key in all_keywords:  # Only include keywords we've seen
-                                target_keywords[keyword_key] = kw_book.tfidf_score
-                    
-                    target_vector = [target_keywords.get(kw, 0.0) for kw in all_keywords]
-                
-                target_norm = np.linalg.norm(target_vector)
-                if target_norm == 0:
-                    continue
-                
-                # Compute cosine similarity
-                dot_product = np.dot(source_vector, target_vector)
-                similarity = dot_product / (source_norm * target_norm)
-                
-                # If similarity is above threshold, add to results
-                if similarity >= min_score:
-                    similar_book_ids.add(target_id)
-                    
-                    # Store the details if not already present
-                    if target_id not in books_details:
-                        try:
-                            target_book = Book.objects.get(gutenberg_id=target_id)
-                            books_details[target_id] = {
-                                "book": target_book,
-                                "keywords": target_keywords,
-                                "similarity_score": similarity
-                            }
-                        except Book.DoesNotExist:
-                            continue
-                    else:
-                        # Update with highest similarity score
-                        current_score = books_details[target_id].get("similarity_score", 0.0)
-                        if similarity > current_score:
-                            books_details[target_id]["similarity_score"] = similarity
+        # Find the tokens matching the term in the in-memory keyword index,
+        # and their columns in the TF-IDF matrix
+        generation = request_generations(request)['keywords']
+        keyword_index = get_keyword_index(generation)
+        tfidf_matrix = get_tfidf_matrix(generation)
+        columns = []
+        for code, matrix_language in (('en', 'english'), ('fr', 'french')):
+            if search_language in [matrix_language, 'both']:
+                tokens = keyword_index.match_tokens(code, search_keyword, search_method)
+                columns.extend(tfidf_matrix.columns_for(matrix_language, tokens))
+        
+        if not columns:
+            return HttpResponse('[]', content_type='application/json')
+        
+        # Books of the base set containing the keywords, read from the rows of
+        # the TF-IDF matrix restricted to the keyword columns
+        similarities = tfidf_matrix.keyword_similarities(base_book_ids, columns)
+        if not similarities:
+            return HttpResponse('[]', content_type='application/json')
         
         # Sort books by similarity score (descending)
-        sorted_books = []
-        for book_id in similar_book_ids:
-            if book_id in books_details:
-                details = books_details[book_id]
-                sorted_books.append((details["book"], details.get("similarity_score", 0.0)))
-        
-        sorted_books.sort(key=lambda x: x[1], reverse=True)
+        similar_book_ids = sorted(
+            (book_id for book_id, score in similarities.items() if score >= min_score),
+            key=lambda book_id: (-similarities[book_id], book_id)
+        )
         
         # Limit to top_n results if specified
         if top_n > 0:
-            sorted_books = sorted_books[:top_n]
+            similar_book_ids = similar_book_ids[:top_n]
         
         # Apply sort from BookViewSet if requested
         sort = request.GET.get('sort')
@@ -514,22 +329,13 @@ class CosinusViewSet(APIView):
             ord = request.GET.get('order')
             ord = "descending" if ord is None else ord
             
-            # Extract book IDs in the current order
-            book_ids_order = [book.gutenberg_id for book, _ in sorted_books]
-            
             # Apply ordering to the books that passed cosine similarity
-            if ord == "descending":
-                sorted_queryset = Book.objects.filter(gutenberg_id__in=book_ids_order).order_by('-download_count')
-            else:
-                sorted_queryset = Book.objects.filter(gutenberg_id__in=book_ids_order).order_by('download_count')
-                
-            # Extract the books in the new order
-            final_books = list(sorted_queryset)
-        else:
-            # Use cosine similarity ordering
-            final_books = [book for book, _ in sorted_books]
+            download_counts = dict(Book.objects.filter(gutenberg_id__in=similar_book_ids).values_list('gutenberg_id', 'download_count'))
+            sign = -1 if ord == "descending" else 1
+            similar_book_ids = sorted((book_id for book_id in similar_book_ids if book_id in download_counts),
+                                      key=lambda book_id: (sign * download_counts[book_id], book_id))
         
-        # Serialize and return the results
-        serializer = BookSerializer(final_books, many=True)
+        # Join the precomputed cards of the results
+        content = cards_json(similar_book_ids)
         print(f"CosinusViewSet query execution time: {time.time() - start_time:.4f} seconds")
-        return Response(serializer.data)
\ No newline at end of file
+        return HttpResponse(content, content_type='application/json')
\ No newline at end of file